@@ -0,0 +1,202 @@
+"""Compare the plans of the modifications merge before and after its rework.
+
+For every number of sources, builds the bench/changes metadata and data of
+benchmarks/synthetic.py and runs the FROM clause of merge_changes, as it was
+before (UNION and a range join on coalesce) and as it is now, with
+EXPLAIN ANALYZE. Both queries must return the same rows. Every source also
+gets the gist index the index advisor suggests for the range join, which
+needs the btree_gist extension.
+
+    # from the repository root
+    python benchmarks/merge_changes.py --url postgresql://localhost/bench \\
+        --sources 2 4 8 16 --rows 100000
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+from os import path
+
+BENCHMARKS_DIRECTORY = path.dirname(path.abspath(__file__))
+REPOSITORY_DIRECTORY = path.dirname(BENCHMARKS_DIRECTORY)
+sys.path.insert(0, path.join(REPOSITORY_DIRECTORY, 'mgo'))
+
+import sqlalchemy
+from sqlalchemy import text
+from sqlalchemy.sql import select, literal_column, and_
+from sqlalchemy.sql.expression import union
+from sqlalchemy.sql.functions import coalesce, func
+import synthetic
+
+REPEAT = 3
+
+
+# merge_changes before the rework, for reference
+def previous_merge_changes(aliases, by=None, start=None, end=None, rename_to=None):
+    from mgoutils.catalog import STATE_START_COLUMN, STATE_END_COLUMN
+    from mgoutils.dateutils import filter_date_range
+    if isinstance(by, str):
+        by = [by]
+
+    def keys_and_changes(aliases, by_columns, start, end):
+        keys_and_dates = []
+        for alias in aliases:
+            from_clause = sqlalchemy.alias(alias.sql_table, alias.basename)
+            where_clause = filter_date_range(
+                    from_clause.c[alias.modified_date_column],
+                    start, end)
+            if alias.where:
+                where_clause = and_(alias.where, where_clause)
+            for state_date_column in alias.state_date_columns:
+                keys_and_dates.append(
+                        select(
+                            by_columns +
+                            [literal_column(state_date_column)
+                                .label(STATE_START_COLUMN)])
+                        .select_from(from_clause)
+                        .where(where_clause))
+        return union(*keys_and_dates)
+
+    by_columns = [
+            literal_column('{}'.format(c)).label(c)
+            for c in by]
+
+    keys_and_dts_start = sqlalchemy.alias(
+            keys_and_changes(aliases, by, start, end),
+            rename_to)
+
+    from_clause = sqlalchemy.alias(select(
+        [keys_and_dts_start.c[c] for c in by] +
+        [keys_and_dts_start.c[STATE_START_COLUMN],
+        func.lead(literal_column(STATE_START_COLUMN)).over(
+            partition_by=by_columns,
+            order_by=literal_column(STATE_START_COLUMN))
+            .label(STATE_END_COLUMN)],
+        from_obj=keys_and_dts_start), rename_to)
+
+    for alias in aliases:
+        on_conditions = [
+                text('{rename_to}.{c} = {alias_basename}.{c}'
+                    .format(rename_to=rename_to,
+                            c=c,
+                            alias_basename=alias.basename))
+                for c in by]
+        if alias.where is not None:
+            on_conditions.append(alias.where)
+        if alias.state_date_columns:
+            start_state_column, end_state_column = [
+                    sqlalchemy.alias(alias.sql_table, alias.basename).c[c]
+                    for c in alias.state_date_columns]
+            on_conditions.append(
+                    and_(
+                        literal_column('{}.gdw_state_start'.format(rename_to)) >= start_state_column,
+                        literal_column('{}.gdw_state_start'.format(rename_to)) < coalesce(end_state_column, '9999-12-31')))
+
+        from_clause = from_clause.join(
+                sqlalchemy.alias(alias.sql_table, alias.basename),
+                onclause=and_(*on_conditions),
+                isouter=True)
+    return from_clause
+
+
+def merge_query(merge, aliases):
+    from_clause = merge(
+            aliases, by='key',
+            start=synthetic.START, end=synthetic.END,
+            rename_to='changes')
+    if isinstance(from_clause, tuple):
+        from_clause = from_clause[0]
+    columns = [literal_column('changes.key'),
+               literal_column('changes.gdw_state_start'),
+               literal_column('changes.gdw_state_end')]
+    columns += [literal_column('{}.amount'.format(alias.basename)).label(alias.basename)
+                for alias in aliases]
+    return select(columns).select_from(from_clause)
+
+
+def compile_query(query, engine):
+    return str(query.compile(engine, compile_kwargs={'literal_binds': True}))
+
+
+def explain_analyze(engine, sql):
+    best = None
+    for _ in range(REPEAT):
+        plan = engine.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + sql).scalar()
+        if not isinstance(plan, list):
+            plan = json.loads(plan)
+        plan = plan[0]
+        if best is None or plan['Execution Time'] < best['Execution Time']:
+            best = plan
+    return best
+
+
+def same_rows(engine, previous_sql, current_sql):
+    differences = engine.execute(
+            '({0} EXCEPT ALL {1}) UNION ALL ({1} EXCEPT ALL {0})'.format(
+                previous_sql, current_sql)).fetchall()
+    return not differences
+
+
+def run(engine, sources, rows):
+    scale = synthetic.Scale(
+            aliases=1, depth=0, union_width=1, change_sources=sources, rows=rows)
+    work_directory = tempfile.mkdtemp(prefix='mgo_bench_')
+    synthetic.generate_metadata(path.join(work_directory, 'metadata'), scale)
+    synthetic.create_data(engine, scale)
+    cwd = os.getcwd()
+    os.chdir(work_directory)
+    try:
+        # the catalog reads the metadata of the working directory on import
+        from mgoutils.catalog import catalog
+        from mgoutils.merges import merge_changes, state_range_sql
+        catalog.config = {}
+        catalog.engines = {synthetic.DATABASE: engine}
+        aliases = [catalog.aliases['source/' + synthetic.source_name(i)]
+                   for i in range(sources)]
+        engine.execute(text('\n'.join(
+                ['CREATE EXTENSION IF NOT EXISTS btree_gist;'] +
+                ['CREATE INDEX ON {} USING gist (key, {}); ANALYZE {};'.format(
+                    alias.sql_table, state_range_sql(alias), alias.sql_table)
+                 for alias in aliases])).execution_options(autocommit=True))
+
+        previous_sql = compile_query(merge_query(previous_merge_changes, aliases), engine)
+        current_sql = compile_query(merge_query(merge_changes, aliases), engine)
+        previous = explain_analyze(engine, previous_sql)
+        current = explain_analyze(engine, current_sql)
+        return {
+                'sources': sources,
+                'previous_ms': previous['Execution Time'],
+                'current_ms': current['Execution Time'],
+                'previous_plan': previous['Plan']['Node Type'],
+                'current_plan': current['Plan']['Node Type'],
+                'same_rows': same_rows(engine, previous_sql, current_sql)}
+    finally:
+        os.chdir(cwd)
+        synthetic.drop_data(engine)
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', required=True)
+    parser.add_argument('--sources', type=int, nargs='+', default=[2, 4, 8, 16])
+    parser.add_argument('--rows', type=int, default=100000)
+    args = parser.parse_args()
+
+    engine = sqlalchemy.create_engine(args.url)
+    print('{:>8} {:>14} {:>14} {:>8} {:>10}'.format(
+            'sources', 'previous ms', 'current ms', 'ratio', 'same rows'))
+    for sources in args.sources:
+        result = run(engine, sources, args.rows)
+        print('{:>8} {:>14.1f} {:>14.1f} {:>8.2f} {:>10}'.format(
+                result['sources'],
+                result['previous_ms'],
+                result['current_ms'],
+                result['current_ms'] / max(result['previous_ms'], 1e-6),
+                'yes' if result['same_rows'] else 'NO'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+"""Compare the incremental SCD2 load with the SCD2 load it replaced.
+
+Builds a throwaway schema with a dimension of N object keys (three versions
+each) and the same number of changed keys for every size. Both strategies
+load those changes into a fresh copy of the dimension, in a transaction
+that is rolled back, and must leave the same versions in it:
+
+- incremental: the statements of SCD2DimensionStrategy.generate_insert,
+  reading the changed rows only
+- previous: the strategy before the rework, embedded below. it prioritized
+  the ranges of the whole transform output, so it reads the whole history
+  (the versions of the dimension and the changed rows). it never wrote the
+  dimension, so the load completes it the only way its staging allows:
+  the dimension is rebuilt from the staged ranges
+
+The incremental time should stay flat as the dimension grows, the previous
+one grows with it. Both need the prioritize_ranges function of the
+warehouse.
+
+    # from the repository root
+    python benchmarks/scd2_dimension.py --url postgresql://localhost/bench
+"""
+import argparse
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'mgo'))
+
+import sqlalchemy
+from sqlalchemy import Column, DateTime, Integer, Text, text
+from sqlalchemy.dialects.postgresql import ARRAY, TSRANGE
+from sqlalchemy.sql import select, literal_column
+from sqlalchemy.sql.functions import func
+from mgoutils.catalog import GDWTable, STATE_START_COLUMN, STATE_END_COLUMN
+from insert_strategies.dimension import SCD2DimensionStrategy
+
+SCHEMA = 'mgo_bench_scd2'
+WINDOW_START = datetime.datetime(2017, 3, 15)
+WINDOW_END = datetime.datetime(2017, 3, 15, 23, 59, 59, 999999)
+
+
+class BenchSCD2DimensionStrategy(SCD2DimensionStrategy):
+    def __init__(self, dimension_table, staging_table, source_table):
+        self.target_alias = {'load': {'object_key': 'object_key',
+                                      'priority': STATE_START_COLUMN}}
+        self.target_table = dimension_table
+        self._staging_table = staging_table
+        self.col_names = ['object_key', 'attribute', STATE_START_COLUMN, STATE_END_COLUMN]
+        self.select_sql = select([source_table.c[c] for c in self.col_names])
+        self.start, self.end = WINDOW_START, WINDOW_END
+
+    @property
+    def staging_table(self):
+        return self._staging_table
+
+
+# SCD2DimensionStrategy.generate_insert before the rework, for reference
+def previous_generate_insert(strategy):
+    result = []
+    staging_table = strategy.staging_table
+
+    # create a subselect from the transform query and add column
+    # gdw_state_dts_range = all timestamp ranges for which this row is valid
+    select_sql = sqlalchemy.alias(strategy.select_sql, 'source_transform')
+    select_sql_columns = [select_sql.corresponding_column(c) for c in strategy.select_sql.c]
+    gdw_state_dts_range = func.prioritize_ranges(
+            func.array_agg(
+                func.tsrange(
+                    literal_column('gdw_state_start'),
+                    literal_column('gdw_state_end'))
+            ).over(partition_by=[literal_column(c) for c in strategy.object_key_columns],
+                   order_by=strategy.priority_order
+            )).label('gdw_state_dts_range')
+    select_sql_columns.append(gdw_state_dts_range)
+
+    result.append(staging_table
+            .insert()
+            .from_select(
+                strategy.stage_col_names,
+                select(select_sql_columns))
+            )
+
+    # select all from existing dimension. look up the object key in stage and remove from
+    # gdw_state_dts_range that already is calculated on stage
+    select_sql = sqlalchemy.alias(strategy.select_sql, 'source_transform')
+    select_sql_columns = [select_sql.corresponding_column(c) for c in strategy.select_sql.c]
+    gdw_state_dts_range = func.prioritize_ranges(
+            func.array_agg(
+                func.tsrange(
+                    literal_column('gdw_state_start'),
+                    literal_column('gdw_state_end'))
+            ).over(partition_by=[literal_column(c) for c in strategy.object_key_columns],
+                   order_by=strategy.priority_order
+            )).label('gdw_state_dts_range')
+    select_sql_columns.append(gdw_state_dts_range)
+
+    result.append(staging_table
+            .insert()
+            .from_select(
+                strategy.stage_col_names,
+                select(select_sql_columns))
+            )
+    return result
+
+
+# the load of the previous strategy: its staging, then the dimension rebuilt
+# from the versions it staged (staged twice, hence the distinct)
+def previous_load(strategy):
+    dimension = strategy.target_table
+    return previous_generate_insert(strategy) + [
+            text('TRUNCATE {}'.format(dimension)),
+            text("""
+                INSERT INTO {dimension} (object_key, attribute, {start}, {end})
+                SELECT DISTINCT object_key, attribute, lower(version), upper(version)
+                FROM (SELECT object_key, attribute, unnest(gdw_state_dts_range) AS version
+                      FROM {staging}) versions
+                WHERE NOT isempty(version)""".format(
+                    dimension=dimension, staging=strategy.staging_table,
+                    start=STATE_START_COLUMN, end=STATE_END_COLUMN))]
+
+
+def create_tables(engine):
+    metadata = sqlalchemy.MetaData(schema=SCHEMA)
+    dimension = GDWTable(
+            'dimension', metadata,
+            Column('object_key', Integer),
+            Column('attribute', Text),
+            Column(STATE_START_COLUMN, DateTime),
+            Column(STATE_END_COLUMN, DateTime))
+    staging = GDWTable(
+            'staging', metadata,
+            Column('object_key', Integer),
+            Column('attribute', Text),
+            Column(STATE_START_COLUMN, DateTime),
+            Column(STATE_END_COLUMN, DateTime),
+            Column('gdw_state_dts_range', ARRAY(TSRANGE)))
+    sources = [GDWTable(
+            name, metadata,
+            Column('object_key', Integer),
+            Column('attribute', Text),
+            Column(STATE_START_COLUMN, DateTime),
+            Column(STATE_END_COLUMN, DateTime))
+        for name in ('source', 'history')]
+    # the copy each run loads into
+    dimension_copy = GDWTable(
+            'dimension_copy', metadata,
+            Column('object_key', Integer),
+            Column('attribute', Text),
+            Column(STATE_START_COLUMN, DateTime),
+            Column(STATE_END_COLUMN, DateTime))
+    engine.execute(text('DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0};'.format(SCHEMA))
+                   .execution_options(autocommit=True))
+    metadata.create_all(engine)
+    engine.execute(text(
+            'CREATE INDEX ON {}.dimension_copy (object_key, {})'.format(SCHEMA, STATE_START_COLUMN))
+            .execution_options(autocommit=True))
+    return dimension_copy, staging, sources
+
+
+def fill(engine, size, changed):
+    engine.execute(text("""
+        TRUNCATE {0}.dimension, {0}.staging, {0}.source, {0}.history;
+        INSERT INTO {0}.dimension
+        SELECT k, 'v' || v, timestamp '2017-01-01' + v * interval '30 days',
+               CASE WHEN v < 2 THEN timestamp '2017-01-01' + (v + 1) * interval '30 days' END
+        FROM generate_series(1, {1}) k, generate_series(0, 2) v;
+        INSERT INTO {0}.source
+        SELECT k, 'new', timestamp '2017-03-15', NULL
+        FROM generate_series(1, {1}, greatest({1} / {2}, 1)) k;
+        INSERT INTO {0}.history
+        SELECT * FROM {0}.dimension UNION ALL SELECT * FROM {0}.source;
+        ANALYZE {0}.dimension;
+        ANALYZE {0}.source;
+        ANALYZE {0}.history;
+        """.format(SCHEMA, size, changed)).execution_options(autocommit=True))
+
+
+# the time of the statements, loading a fresh copy of the dimension, and a
+# checksum of the versions they leave in it. every run is rolled back, so
+# every run sees the same data
+def timed(engine, statements):
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        connection.execute(text(
+                'TRUNCATE {0}.dimension_copy; '
+                'INSERT INTO {0}.dimension_copy SELECT * FROM {0}.dimension; '
+                'ANALYZE {0}.dimension_copy;'.format(SCHEMA)))
+        started = time.time()
+        for statement in statements:
+            connection.execute(statement)
+        elapsed = time.time() - started
+        checksum = connection.execute(text(
+                "SELECT md5(string_agg(d::text, ',' ORDER BY d::text)) "
+                "FROM {}.dimension_copy d".format(SCHEMA))).scalar()
+        transaction.rollback()
+    return elapsed, checksum
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', required=True)
+    parser.add_argument('--sizes', default='100000,1000000,5000000')
+    parser.add_argument('--changed', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    engine = sqlalchemy.create_engine(args.url)
+    if not engine.execute(text(
+            "SELECT count(*) FROM pg_proc WHERE proname = 'prioritize_ranges'")).scalar():
+        sys.exit('prioritize_ranges not found, it is needed by both strategies')
+    dimension_copy, staging, (source, history) = create_tables(engine)
+    incremental = BenchSCD2DimensionStrategy(dimension_copy, staging, source).generate_insert()
+    previous = previous_load(BenchSCD2DimensionStrategy(dimension_copy, staging, history))
+
+    print('{:>12} {:>10} {:>14} {:>14} {:>10}'.format(
+            'dimension', 'changed', 'incremental s', 'previous s', 'same rows'))
+    for size in [int(s) for s in args.sizes.split(',')]:
+        fill(engine, size, args.changed)
+        incremental_runs = [timed(engine, incremental) for _ in range(args.repeat)]
+        previous_runs = [timed(engine, previous) for _ in range(args.repeat)]
+        print('{:>12} {:>10} {:>14.3f} {:>14.3f} {:>10}'.format(
+                size * 3, args.changed,
+                min(elapsed for elapsed, _ in incremental_runs),
+                min(elapsed for elapsed, _ in previous_runs),
+                'yes' if incremental_runs[0][1] == previous_runs[0][1] else 'NO'))
+
+    engine.execute(text('DROP SCHEMA {} CASCADE'.format(SCHEMA)).execution_options(autocommit=True))
+
+
+if __name__ == '__main__':
+    main()
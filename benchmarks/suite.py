@@ -0,0 +1,318 @@
+"""Measure mgo on synthetic metadata and data, and compare with a baseline.
+
+Generates the metadata of benchmarks/synthetic.py at the given scale in a
+temporary directory, creates its data in a throwaway database and measures
+- reflection of every alias, with a cold and with a warm reflection cache
+- SQL generation of the load of every target, with a warm reflection cache
+- end to end load time and throughput of every target
+
+The results are written as json to benchmarks/results/<commit>.json (or
+--output) so runs of two commits can be compared with --baseline:
+
+    # from the repository root
+    python benchmarks/suite.py --url postgresql://localhost/bench
+    python benchmarks/suite.py --url postgresql://localhost/bench \\
+        --baseline benchmarks/results/5cc8f36.json
+
+--commit measures the mgo of another commit instead of the working tree, it
+is extracted with git archive into the temporary directory. This is how the
+results of the commit before the performance work are made, to be used as
+the baseline of every later run:
+
+    python benchmarks/suite.py --url postgresql://localhost/bench --commit f5a0ac6
+    python benchmarks/suite.py --url postgresql://localhost/bench \\
+        --baseline benchmarks/results/f5a0ac6.json
+
+That commit has no reflection cache (every reflection is cold, there is no
+warm one to measure), generates its statements with GDWLoad.generate_load
+and runs them one by one with autocommit. Targets it cannot load are left
+out of its results and show as - in the comparison.
+
+The scd2 target needs the prioritize_ranges function of the warehouse and
+is skipped on databases without it.
+"""
+import argparse
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from os import path
+
+BENCHMARKS_DIRECTORY = path.dirname(path.abspath(__file__))
+REPOSITORY_DIRECTORY = path.dirname(BENCHMARKS_DIRECTORY)
+RESULTS_DIRECTORY = path.join(BENCHMARKS_DIRECTORY, 'results')
+# the commit before the performance work, see LegacySuite
+LEGACY_COMMIT = 'f5a0ac6'
+sys.path.insert(0, path.join(REPOSITORY_DIRECTORY, 'mgo'))
+
+import sqlalchemy
+from sqlalchemy import text
+import synthetic
+
+
+def git_commit(revision='HEAD'):
+    try:
+        return subprocess.check_output(
+                ['git', 'rev-parse', '--short', revision],
+                cwd=REPOSITORY_DIRECTORY).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+# the mgo directory of commit, extracted into directory
+def extract_mgo(commit, directory):
+    archive = subprocess.Popen(
+            ['git', 'archive', commit, 'mgo'],
+            cwd=REPOSITORY_DIRECTORY, stdout=subprocess.PIPE)
+    subprocess.check_call(['tar', '-x', '-C', directory], stdin=archive.stdout)
+    archive.stdout.close()
+    if archive.wait() != 0:
+        raise RuntimeError('git archive of {} failed'.format(commit))
+    return path.join(directory, 'mgo')
+
+
+def best_of(repeat, setup, measured):
+    times = []
+    for _ in range(repeat):
+        setup()
+        started = time.time()
+        measured()
+        times.append(time.time() - started)
+    return min(times)
+
+
+class Suite(object):
+    def __init__(self, engine, scale, repeat):
+        # the catalog reads metadata/areas.yaml of the working directory when
+        # it is imported, so mgo is only imported once the metadata exists
+        from mgoutils.catalog import catalog
+        self.catalog = catalog
+        self.catalog.config = {}
+        self.catalog.engines = {synthetic.DATABASE: engine}
+        self.engine = engine
+        self.scale = scale
+        self.repeat = repeat
+        self.results = {}
+
+    def reset(self, reflection=False, tables=True):
+        from mgoutils.catalog import GDWAliasDict, GDWPlanCache, REFLECTION_CACHE_DIRECTORY
+        from mgoutils.reflection import GDWReflectionCache
+        catalog = self.catalog
+        catalog.aliases = GDWAliasDict(catalog)
+        catalog.plans = GDWPlanCache()
+        catalog.sql_cache.invalidate()
+        if tables:
+            catalog.metadata = sqlalchemy.MetaData()
+            if reflection:
+                catalog.reflection.invalidate()
+            catalog.reflection = GDWReflectionCache(REFLECTION_CACHE_DIRECTORY)
+
+    def reflect_all(self):
+        for alias_name in self.catalog.alias_names():
+            alias = self.catalog.aliases[alias_name]
+            if alias.area:
+                alias.sql_table
+
+    def measure_reflection(self):
+        self.results['reflection_cold_s'] = best_of(
+                self.repeat, lambda: self.reset(reflection=True), self.reflect_all)
+        self.results['reflection_warm_s'] = best_of(
+                self.repeat, lambda: self.reset(), self.reflect_all)
+
+    def measure_sql_generation(self, targets):
+        from load import GDWLoad
+        from mgoutils.sqlcache import CompiledStatement
+
+        def generate(target):
+            gdw_load = GDWLoad(target, {}, synthetic.START, synthetic.END)
+            return [CompiledStatement.compile(description, sql, self.engine)
+                    for description, sql in gdw_load.load_statements()]
+
+        self.reset()
+        self.reflect_all()
+        for target in targets:
+            self.results['sql_generation_s.' + target] = best_of(
+                    self.repeat,
+                    lambda: self.reset(tables=False),
+                    lambda: generate(target))
+
+    def measure_loads(self, targets):
+        from load import GDWLoad
+        for target in targets:
+            self.reset()
+            gdw_load = GDWLoad(target, {}, synthetic.START, synthetic.END)
+            seconds = best_of(
+                    self.repeat,
+                    lambda: None,
+                    lambda: gdw_load.run())
+            rows = self.engine.execute(
+                    sqlalchemy.select([sqlalchemy.func.count()])
+                    .select_from(gdw_load.target_table)).scalar()
+            self.results['load_s.' + target] = seconds
+            self.results['load_rows_per_s.' + target] = rows / max(seconds, 1e-6)
+
+    def targets(self):
+        has_prioritize_ranges = self.engine.execute(text(
+                "SELECT count(*) FROM pg_proc WHERE proname = 'prioritize_ranges'")).scalar()
+        if has_prioritize_ranges:
+            return synthetic.TARGETS
+        print('prioritize_ranges not found, skipping bench/scd2')
+        return [t for t in synthetic.TARGETS if t != 'bench/scd2']
+
+    def run(self):
+        targets = self.targets()
+        self.measure_reflection()
+        self.measure_sql_generation(targets)
+        self.measure_loads(targets)
+        return self.results
+
+
+class LegacySuite(Suite):
+    """The suite for the mgo of the commit before the performance work.
+
+    Its aliases are reflected when they are created and there is no
+    reflection or SQL cache. generate_load gives the statements of a load
+    and load.py ran them one by one with autocommit."""
+    def reset(self, reflection=False, tables=True):
+        from mgoutils.catalog import GDWAliasDict
+        self.catalog.aliases = GDWAliasDict(self.catalog)
+        self.catalog.metadata = sqlalchemy.MetaData()
+
+    def measure_reflection(self):
+        self.results['reflection_cold_s'] = best_of(
+                self.repeat, self.reset, self.reflect_all)
+
+    def load_statements(self, gdw_load):
+        for _, sqls in gdw_load.generate_load():
+            if not isinstance(sqls, list):
+                sqls = [sqls]
+            for sql in sqls:
+                yield sql
+
+    def loadable(self, targets):
+        from load import GDWLoad
+        for target in targets:
+            self.reset()
+            try:
+                list(self.load_statements(GDWLoad(target, {}, synthetic.START, synthetic.END)))
+            except Exception as e:
+                print('{} not supported by this commit, skipping it: {}'.format(target, e))
+                continue
+            yield target
+
+    def measure_sql_generation(self, targets):
+        from load import GDWLoad
+        from mgoutils.sqlutils import compile_sql
+
+        def generate(target):
+            gdw_load = GDWLoad(target, {}, synthetic.START, synthetic.END)
+            return [compile_sql(sql, self.engine) for sql in self.load_statements(gdw_load)]
+
+        for target in targets:
+            self.results['sql_generation_s.' + target] = best_of(
+                    self.repeat, self.reset, lambda: generate(target))
+
+    def measure_loads(self, targets):
+        from load import GDWLoad
+
+        def load(gdw_load):
+            for sql in self.load_statements(gdw_load):
+                self.engine.execute(sql.execution_options(autocommit=True))
+
+        for target in targets:
+            self.reset()
+            gdw_load = GDWLoad(target, {}, synthetic.START, synthetic.END)
+            seconds = best_of(self.repeat, lambda: None, lambda: load(gdw_load))
+            rows = self.engine.execute(
+                    sqlalchemy.select([sqlalchemy.func.count()])
+                    .select_from(gdw_load.target_table)).scalar()
+            self.results['load_s.' + target] = seconds
+            self.results['load_rows_per_s.' + target] = rows / max(seconds, 1e-6)
+
+    def run(self):
+        targets = list(self.loadable(self.targets()))
+        self.measure_reflection()
+        self.measure_sql_generation(targets)
+        self.measure_loads(targets)
+        return self.results
+
+
+def compare(results, baseline):
+    print('{:<40} {:>14} {:>14} {:>8}'.format('metric', 'baseline', 'current', 'ratio'))
+    for metric in sorted(set(results['results']) | set(baseline['results'])):
+        current = results['results'].get(metric)
+        previous = baseline['results'].get(metric)
+        ratio = current / previous if current is not None and previous else None
+        print('{:<40} {:>14} {:>14} {:>8}'.format(
+                metric,
+                '-' if previous is None else '{:.4f}'.format(previous),
+                '-' if current is None else '{:.4f}'.format(current),
+                '-' if ratio is None else '{:.2f}'.format(ratio)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', required=True)
+    parser.add_argument('--aliases', type=int, default=20)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--union-width', type=int, default=4)
+    parser.add_argument('--change-sources', type=int, default=3)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output')
+    parser.add_argument('--baseline')
+    parser.add_argument('--commit',
+                        help='measure the mgo of this commit instead of the working tree')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the generated metadata and data')
+    args = parser.parse_args()
+
+    scale = synthetic.Scale(
+            aliases=args.aliases, depth=args.depth, union_width=args.union_width,
+            change_sources=args.change_sources, rows=args.rows)
+    commit = git_commit(args.commit or 'HEAD')
+    output = path.abspath(args.output or path.join(RESULTS_DIRECTORY, '{}.json'.format(commit)))
+    baseline = path.abspath(args.baseline) if args.baseline else None
+
+    engine = sqlalchemy.create_engine(args.url)
+    work_directory = tempfile.mkdtemp(prefix='mgo_bench_')
+    suite = Suite
+    if args.commit:
+        sys.path.insert(0, extract_mgo(commit, work_directory))
+        suite = LegacySuite if commit == git_commit(LEGACY_COMMIT) else Suite
+    synthetic.generate_metadata(path.join(work_directory, 'metadata'), scale)
+    synthetic.create_data(engine, scale)
+    cwd = os.getcwd()
+    os.chdir(work_directory)
+    try:
+        results = suite(engine, scale, args.repeat).run()
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print('Metadata kept in {}'.format(work_directory))
+        else:
+            synthetic.drop_data(engine)
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    results = {
+            'commit': commit,
+            'created_at': datetime.datetime.now().isoformat(),
+            'scale': dict(scale._asdict()),
+            'results': results}
+    if not path.isdir(path.dirname(output)):
+        os.makedirs(path.dirname(output))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('Results written to {}'.format(output))
+
+    if baseline:
+        with open(baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""Synthetic mgo metadata and data at a configurable scale.
+
+generate_metadata() writes an areas.yaml and the alias/transform files of
+these targets into a metadata directory:
+
+    bench/insert    SimpleInsert from one source
+    bench/union     union all of `union_width` sources (merge_tables)
+    bench/nested    chain of `depth` transforms without a table
+    bench/changes   modifications merge of `change_sources` sources (merge_changes)
+    bench/daily     DailyDimensionStrategy from one source
+    bench/scd2      SCD2DimensionStrategy from one source
+
+create_data() builds the matching schemas and tables and fills every
+source with `rows` rows, all modified inside the benchmark window.
+"""
+import datetime
+import os
+from collections import namedtuple
+from os import path
+
+import yaml
+from sqlalchemy import text
+
+DATABASE = 'bloodmoondb'
+SCHEMAS = {'source': 'mgo_bench_source', 'stage': 'mgo_bench_stage',
+           'warehouse': 'mgo_bench_warehouse', 'mgo': 'mgo_bench_state'}
+START = datetime.datetime(2018, 1, 1)
+END = datetime.datetime(2018, 1, 2)
+TARGETS = ['bench/insert', 'bench/union', 'bench/nested', 'bench/changes',
+           'bench/daily', 'bench/scd2']
+
+SOURCE_COLUMNS = [
+        ('key', 'integer'),
+        ('amount', 'numeric'),
+        ('modified', 'timestamp'),
+        ('state_start', 'timestamp'),
+        ('state_end', 'timestamp'),
+        ('is_deleted', 'boolean')]
+# transforms from a source with state dates add these columns
+STATE_COLUMNS = [
+        ('gdw_state_start', 'timestamp'),
+        ('gdw_state_end', 'timestamp'),
+        ('gdw_is_deleted', 'boolean')]
+
+
+class Scale(namedtuple('Scale', ['aliases', 'depth', 'union_width', 'change_sources', 'rows'])):
+    __slots__ = ()
+
+    @property
+    def source_count(self):
+        return max(self.aliases, self.union_width, self.change_sources, 1)
+
+
+def source_name(i):
+    return 'src_{:03d}'.format(i)
+
+
+def write_yaml(directory, name, kind, content):
+    file_path = path.join(directory, '{}.{}.yaml'.format(name, kind))
+    if not path.isdir(path.dirname(file_path)):
+        os.makedirs(path.dirname(file_path))
+    with open(file_path, 'w') as f:
+        yaml.safe_dump(content, f, default_flow_style=False)
+
+
+def select_columns(alias, columns):
+    return [{c: '{}.{}'.format(alias, c)} for c in columns]
+
+
+def generate_metadata(directory, scale):
+    areas = dict(
+            (area, {'database': DATABASE, 'schema': schema})
+            for area, schema in SCHEMAS.items())
+    if not path.isdir(directory):
+        os.makedirs(directory)
+    with open(path.join(directory, 'areas.yaml'), 'w') as f:
+        yaml.safe_dump(areas, f, default_flow_style=False)
+
+    for i in range(scale.source_count):
+        write_yaml(directory, 'source/' + source_name(i), 'alias', {
+                'area': 'source',
+                'table': source_name(i),
+                'where': 'amount >= 0',
+                'is_deleted': 'is_deleted',
+                'date': {'modified': 'modified',
+                         'state': ['state_start', 'state_end']}})
+
+    def target(name, table, transform, load=None):
+        alias = {'area': 'warehouse', 'table': table}
+        if load:
+            alias['load'] = load
+        write_yaml(directory, name, 'alias', alias)
+        write_yaml(directory, name, 'transform', transform)
+
+    first = source_name(0)
+    target('bench/insert', 'insert', {
+            'from': ['source/' + first],
+            'select': select_columns(first, ['key', 'amount'])})
+
+    target('bench/union', 'union', {
+            'from': [['source/' + source_name(i) for i in range(scale.union_width)]],
+            'select': select_columns(first, ['key', 'amount'])})
+
+    previous = 'source/' + first
+    for level in range(1, scale.depth + 1):
+        name = 'bench/nested_{}'.format(level)
+        write_yaml(directory, name, 'transform', {
+                'from': [previous],
+                'select': select_columns(previous.split('/')[-1], ['key', 'amount'])})
+        previous = name
+    target('bench/nested', 'nested', {
+            'from': [previous],
+            'select': select_columns(previous.split('/')[-1], ['key', 'amount'])})
+
+    target('bench/changes', 'changes', {
+            'from': [{'alias': ['source/' + source_name(i) for i in range(scale.change_sources)],
+                      'merge': 'modifications',
+                      'by': 'key',
+                      'as': 'changes'}],
+            'select': [{'key': 'changes.key'}] + [
+                {'amount_{}'.format(i): '{}.amount'.format(source_name(i))}
+                for i in range(scale.change_sources)]})
+
+    target('bench/daily', 'daily', {
+            'from': ['source/' + first],
+            'select': select_columns(first, ['key', 'amount'])},
+            load={'how': 'dimension', 'type': 'daily', 'object_key': 'key'})
+
+    write_yaml(directory, 'bench/scd2_staging', 'alias', {'area': 'stage', 'table': 'scd2_staging'})
+    target('bench/scd2', 'scd2', {
+            'from': ['source/' + first],
+            'select': select_columns(first, ['key', 'amount'])},
+            load={'how': 'dimension', 'type': 'scd2', 'object_key': 'key',
+                  'priority': 'amount', 'staging_alias': 'bench/scd2_staging'})
+
+
+def table_ddl(schema, table, columns):
+    return 'CREATE TABLE {}.{} ({});'.format(
+            schema, table, ', '.join('{} {}'.format(c, t) for c, t in columns))
+
+
+def create_data(engine, scale):
+    statements = []
+    for schema in SCHEMAS.values():
+        statements.append('DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0};'.format(schema))
+
+    source, stage, warehouse = SCHEMAS['source'], SCHEMAS['stage'], SCHEMAS['warehouse']
+    keys = max(scale.rows // 4, 1)
+    for i in range(scale.source_count):
+        statements.append(table_ddl(source, source_name(i), SOURCE_COLUMNS))
+        # four versions per key, spread over the window
+        statements.append("""
+            INSERT INTO {schema}.{table}
+            SELECT n % {keys}, n % 1000,
+                   timestamp '{start}' + (n % 86400) * interval '1 second',
+                   timestamp '{start}' + (n / {keys}) * interval '1 hour',
+                   CASE WHEN n / {keys} < 3
+                        THEN timestamp '{start}' + (n / {keys} + 1) * interval '1 hour' END,
+                   false
+            FROM generate_series(0, {rows} - 1) n;
+            CREATE INDEX ON {schema}.{table} (modified);
+            CREATE INDEX ON {schema}.{table} (key);
+            ANALYZE {schema}.{table};""".format(
+                schema=source, table=source_name(i), keys=keys,
+                start=START, rows=scale.rows))
+
+    value_columns = [('key', 'integer'), ('amount', 'numeric')]
+    for table in ('insert', 'union', 'scd2'):
+        statements.append(table_ddl(warehouse, table, value_columns + STATE_COLUMNS))
+    statements.append(table_ddl(warehouse, 'nested', value_columns))
+    statements.append(table_ddl(
+            warehouse, 'changes',
+            [('key', 'integer')] +
+            [('amount_{}'.format(i), 'numeric') for i in range(scale.change_sources)] +
+            STATE_COLUMNS))
+    statements.append(table_ddl(
+            warehouse, 'daily',
+            value_columns + STATE_COLUMNS +
+            [('gdw_row_hash', 'text'), ('gdw_valid_from', 'date'), ('gdw_valid_to', 'date')]))
+    statements.append(table_ddl(
+            stage, 'scd2_staging',
+            value_columns + STATE_COLUMNS + [('gdw_state_dts_range', 'tsrange[]')]))
+
+    engine.execute(text('\n'.join(statements)).execution_options(autocommit=True))
+
+
+def drop_data(engine):
+    engine.execute(text('\n'.join(
+            'DROP SCHEMA IF EXISTS {} CASCADE;'.format(schema)
+            for schema in SCHEMAS.values())).execution_options(autocommit=True))
@@ -0,0 +1,40 @@
+import logging
+from cmdlineutil import CronJob
+import de_common.scriptutil as scriptutil
+from mgoutils.catalog import catalog
+
+__author__ = 'jvalenzuela'
+DISPLAY_NAME = scriptutil.get_display_name(__file__)
+TOOL_NAME = scriptutil.get_tool_name(DISPLAY_NAME)
+_logger = logging.getLogger(TOOL_NAME)
+
+
+# remove the on-disk caches so the next run reflects the tables and
+# compiles the load statements again
+class CronGDWCache(CronJob):
+    def __init__(self):
+        super(CronGDWCache, self).__init__()
+        self.config = self.props
+
+    name = TOOL_NAME
+    display_name = DISPLAY_NAME
+
+    options = [
+        (('-b', '--database'), dict(type=str, dest='database', default=None)),
+        (('-c', '--schema'), dict(type=str, dest='schema', default=None)),
+        (('-w', '--what'), dict(type=str, dest='what', default='all',
+                                choices=['all', 'reflection', 'sql']))]
+
+    def _run_impl(self):
+        if self.opts.what in ('all', 'reflection'):
+            _logger.info("Invalidating reflection cache for database {} schema {}"
+                    .format(self.opts.database or 'all', self.opts.schema or 'all'))
+            catalog.reflection.invalidate(self.opts.database, self.opts.schema)
+        if self.opts.what in ('all', 'sql'):
+            _logger.info("Invalidating generated SQL cache")
+            catalog.sql_cache.invalidate()
+
+
+if __name__ == '__main__':
+    app = CronGDWCache()
+    app.run()
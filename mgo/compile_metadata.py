@@ -0,0 +1,41 @@
+import logging
+from cmdlineutil import CronJob
+import de_common.scriptutil as scriptutil
+from mgoutils.bundle import GDWMetadataBundle, METADATA_DIRECTORY, METADATA_BUNDLE_FILE
+from mgoutils.validation import GDWMetadataValidator
+
+__author__ = 'jvalenzuela'
+DISPLAY_NAME = scriptutil.get_display_name(__file__)
+TOOL_NAME = scriptutil.get_tool_name(DISPLAY_NAME)
+_logger = logging.getLogger(TOOL_NAME)
+
+
+class CronGDWCompileMetadata(CronJob):
+    def __init__(self):
+        super(CronGDWCompileMetadata, self).__init__()
+        self.config = self.props
+
+    name = TOOL_NAME
+    display_name = DISPLAY_NAME
+
+    options = [
+        (('-c', '--check'), dict(type=bool, dest='check', default=False))]
+
+    def _run_impl(self):
+        bundle = GDWMetadataBundle.build(METADATA_DIRECTORY)
+        errors = GDWMetadataValidator(bundle).errors()
+        for error in errors:
+            _logger.error(error)
+        if errors:
+            raise RuntimeError('{} errors in the metadata, bundle not written'.format(len(errors)))
+        if self.opts.check:
+            _logger.info("Metadata is valid, {} files".format(len(bundle.files)))
+            return
+        bundle.save(METADATA_BUNDLE_FILE)
+        _logger.info("Metadata bundle of {} files written to {}"
+                .format(len(bundle.files), METADATA_BUNDLE_FILE))
+
+
+if __name__ == '__main__':
+    app = CronGDWCompileMetadata()
+    app.run()
@@ -4,7 +4,10 @@ import de_common.scriptutil as scriptutil
 from mgoutils.catalog import catalog
 from mgoutils.sqlutils import compile_sql
 from sqlalchemy import text
-from mgoutils.dateutils import DEFAULT_START, DEFAULT_END, filter_date_range, parse_date
+from mgoutils.dateutils import default_start, default_end, filter_date_range, parse_date, window_params
+from mgoutils.deletes import KEYED_LOADS, deleted_by_load
+from mgoutils.explain import GDWExplain
+from mgoutils.sqlcache import CompiledStatement
 from sqlalchemy.sql.expression import delete
 
 __author__ = 'jvalenzuela'
@@ -26,7 +29,8 @@ class CronGDWDelete(CronJob):
         (('-t', '--target'), dict(type=str, dest='target', required=True)),
         (('-s', '--start'), dict(type=str, dest='start_datetime', required=False)),
         (('-e', '--end'), dict(type=str, dest='end_datetime', required=False)),
-        (('-d', '--dry-run'), dict(type=bool, dest='dry_run', default=False))]
+        (('-d', '--dry-run'), dict(type=bool, dest='dry_run', default=False)),
+        (('-c', '--cost'), dict(type=bool, dest='cost', default=False))]
 
     def _run_impl(self):
         catalog.configure(self.config)
@@ -34,22 +38,51 @@ class CronGDWDelete(CronJob):
                 self.target_alias,
                 self.opts.start_datetime,
                 self.opts.end_datetime)
-        engine = catalog.engine_from_alias(self.target_alias)
-        delete_sqls = gdw_delete.generate_delete()
+        if self.opts.cost:
+            gdw_delete.explain_plans()
+        else:
+            gdw_delete.run(dry_run=self.opts.dry_run)
 
-        for delete_sql in delete_sqls:
-            if self.opts.dry_run:
+class GDWDelete():
+    def __init__(self, target_alias_name, start=None, end=None):
+        self.target_alias = catalog.aliases[target_alias_name]
+        self.start = parse_date(start or default_start())
+        self.end = parse_date(end or default_end())
+
+    # true when the delete does not depend on the date window
+    @property
+    def deletes_everything(self):
+        if self.target_alias.get('load', {}).get('how') in KEYED_LOADS:
+            return False
+        delete_definition = self.target_alias.get('delete', {})
+        return delete_definition.get('what', 'all') == 'all'
+
+    @property
+    def deleted_by_load(self):
+        return deleted_by_load(self.target_alias)
+
+    @property
+    def engine(self):
+        return catalog.engine_from_alias(self.target_alias.name)
+
+    def run(self, dry_run=False):
+        engine = self.engine
+        for delete_sql in self.generate_delete():
+            if dry_run:
                 _logger.info("Dry run. DELETE SQL statement not run:")
                 _logger.info(compile_sql(delete_sql, engine))
             else:
                 _logger.info("Executing DELETE process in database")
                 engine.execute(delete_sql.execution_options(autocommit=True))
 
-class GDWDelete():
-    def __init__(self, target_alias_name, start=None, end=None):
-        self.target_alias = catalog.aliases[target_alias_name]
-        self.start = parse_date(start or DEFAULT_START)
-        self.end = parse_date(end or DEFAULT_END)
+    def explain_plans(self):
+        engine = self.engine
+        with engine.connect() as connection:
+            return GDWExplain(self.target_alias.name).run(
+                    connection,
+                    [CompiledStatement.compile('DELETE', delete_sql, engine)
+                     for delete_sql in self.generate_delete()],
+                    window_params(self.start, self.end))
 
     def generate_delete(self):
         target_table = self.target_alias.sql_table
@@ -64,8 +97,9 @@ class GDWDelete():
                     self.end)
             delete_sqls += staging_delete.generate_delete()
 
-        # dont delete dimensions. The load will take care of deletes
-        if self.target_alias.get('load', {}).get('how') == 'dimension':
+        # dont delete dimensions, upserts or loads comparing row hashes.
+        # The load will take care of deletes
+        if self.deleted_by_load:
             return delete_sqls
 
         # by default, truncate table
@@ -73,17 +107,25 @@ class GDWDelete():
         how = delete_definition.get('how', 'truncate')
         what = delete_definition.get('what', 'all')
 
+        # partitioned tables delete whole partitions whenever they can
+        partitioning = self.target_alias.partitioning
+        if what in ('partition', 'date_range') and partitioning:
+            delete_sqls += partitioning.generate_delete(
+                    self.start, self.end,
+                    how='drop' if how == 'drop' else 'truncate')
+            return delete_sqls
+        elif what == 'partition':
+            raise RuntimeError('{} declares no partition'.format(self.target_alias.name))
+
         if how == 'truncate':
             if what == 'all':
                 delete_sqls.append(text('TRUNCATE TABLE {};'.format(target_table)))
-            elif what == 'partition':
-                raise RuntimeError('TODO: No truncate partition developed yet')
             else:
                 raise RuntimeError('Truncate must specify date_range or all')
 
         elif how == 'delete':
             if what == 'all':
-                delete_sqls.append(delete(table))
+                delete_sqls.append(delete(target_table))
             elif what == 'date_range':
                 date_column_names = self.target_alias.date_columns
                 date_fields = [target_table.c[col] for col in date_column_names]
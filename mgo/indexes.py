@@ -0,0 +1,222 @@
+import logging
+import re
+from collections import namedtuple
+from cmdlineutil import CronJob
+import de_common.scriptutil as scriptutil
+from mgoutils.catalog import catalog, STATE_START_COLUMN, VALID_TO_COLUMN
+from mgoutils.merges import join_columns, state_range_sql
+from sqlalchemy import text
+
+__author__ = 'jvalenzuela'
+DISPLAY_NAME = scriptutil.get_display_name(__file__)
+TOOL_NAME = scriptutil.get_tool_name(DISPLAY_NAME)
+_logger = logging.getLogger(TOOL_NAME)
+
+# date columns whose physical order follows their values this closely are
+# filled in date order (append only) and a small BRIN index is enough
+BRIN_CORRELATION = 0.9
+MAX_IDENTIFIER_LENGTH = 63
+
+GDWIndex = namedtuple('GDWIndex', [
+    'alias', 'columns', 'method', 'unique', 'where', 'reason'])
+
+
+class CronGDWIndexes(CronJob):
+    def __init__(self):
+        super(CronGDWIndexes, self).__init__()
+        self.config = self.props
+
+    name = TOOL_NAME
+    display_name = DISPLAY_NAME
+
+    options = [
+        (('-t', '--target'), dict(type=str, dest='target', default=None)),
+        (('-a', '--apply'), dict(type=bool, dest='apply', default=False))]
+
+    def _run_impl(self):
+        catalog.configure(self.config)
+        advisor = GDWIndexAdvisor(self.opts.target)
+        advisor.run(apply=self.opts.apply)
+
+
+# works out the indexes the access paths described in the metadata need:
+# - date.modified and date.columns, filtered by every load window
+# - date.state, joined by range in the modification merges (gist, with the
+#   btree_gist extension for the by keys)
+# - load.object_key of dimensions and load.primary_key of upserts
+# - the columns of the relationships joins
+# - the by keys of the modification merges of every transform
+# and prints the DDL of the ones no existing index covers
+class GDWIndexAdvisor():
+    def __init__(self, alias_name=None):
+        if alias_name:
+            self.alias_names = catalog.alias_closure(alias_name)
+        else:
+            self.alias_names = sorted(
+                    set(catalog.alias_names('alias')) | set(catalog.alias_names('transform')))
+        self._indexes = {}
+        self._correlations = {}
+
+    def table_key(self, alias):
+        return alias.area['database'], alias.area['schema']
+
+    def existing(self, alias):
+        key = self.table_key(alias)
+        if key not in self._indexes:
+            self._indexes[key] = catalog.reflection.indexes(
+                    catalog.engines[key[0]], key[1])
+        return self._indexes[key].get(alias['table'], [])
+
+    def correlation(self, alias, column):
+        key = self.table_key(alias)
+        if key not in self._correlations:
+            self._correlations[key] = catalog.reflection.correlations(
+                    catalog.engines[key[0]], key[1])
+        return self._correlations[key].get((alias['table'], column))
+
+    def date_index(self, alias, column, reason):
+        correlation = self.correlation(alias, column)
+        if correlation is not None and abs(correlation) >= BRIN_CORRELATION:
+            return GDWIndex(alias, (column,), 'brin', False, None,
+                            '{} (append only, correlation {:.2f})'.format(reason, correlation))
+        return GDWIndex(alias, (column,), 'btree', False, None, reason)
+
+    def alias_indexes(self, alias):
+        if alias.modified_date_column:
+            yield self.date_index(alias, alias.modified_date_column, 'date.modified')
+        for column in alias.date_columns or []:
+            yield self.date_index(alias, column, 'date.columns')
+
+        load_definition = alias.get('load', {})
+        how = load_definition.get('how')
+        if how == 'dimension':
+            object_key = load_definition['object_key']
+            if isinstance(object_key, str):
+                object_key = [object_key]
+            if load_definition.get('type') == 'daily':
+                yield GDWIndex(alias, tuple(object_key), 'btree', False,
+                               '{} IS NULL'.format(VALID_TO_COLUMN),
+                               'load.object_key (open versions)')
+            else:
+                yield GDWIndex(alias, tuple(object_key) + (STATE_START_COLUMN,),
+                               'btree', False, None, 'load.object_key')
+        elif how == 'upsert':
+            primary_key = load_definition.get('primary_key')
+            if primary_key:
+                if isinstance(primary_key, str):
+                    primary_key = [primary_key]
+                yield GDWIndex(alias, tuple(primary_key), 'btree', True, None,
+                               'load.primary_key (ON CONFLICT needs it unique)')
+
+        for related_name, relationship in alias.get('relationships', {}).items():
+            related = catalog.aliases[related_name]
+            for side in (alias, related):
+                if not side.area:
+                    continue
+                for column in join_columns(relationship['join_on'], side.basename):
+                    yield GDWIndex(side, (column,), 'btree', False, None,
+                                   'relationship {} - {}'.format(alias.name, related.name))
+
+    def merge_indexes(self, alias_name):
+        for single_from in catalog.from_definitions(alias_name):
+            if single_from.get('merge') != 'modifications':
+                continue
+            by = single_from['by']
+            if isinstance(by, str):
+                by = [by]
+            for source_name in single_from['alias']:
+                source = catalog.aliases[source_name]
+                if not source.area:
+                    continue
+                if source.state_date_columns:
+                    yield GDWIndex(source, tuple(by) + (state_range_sql(source),),
+                                   'gist', False, None,
+                                   'modifications by of {} (needs btree_gist)'.format(alias_name))
+                else:
+                    yield GDWIndex(source, tuple(by), 'btree', False, None,
+                                   'modifications by of {}'.format(alias_name))
+
+    def wanted(self):
+        wanted = []
+        for alias_name in self.alias_names:
+            alias = catalog.aliases[alias_name]
+            indexes = list(self.merge_indexes(alias_name))
+            if alias.area:
+                indexes += self.alias_indexes(alias)
+            for index in indexes:
+                same = [w for w in wanted
+                        if w.alias.name == index.alias.name and w.columns == index.columns]
+                if not same:
+                    wanted.append(index)
+        return wanted
+
+    # a partial index only covers the same partial index. the predicate is
+    # read back from postgres in parentheses
+    @staticmethod
+    def same_predicate(predicate, where):
+        def normalize(condition):
+            condition = ' '.join((condition or '').split())
+            while condition.startswith('(') and condition.endswith(')'):
+                condition = condition[1:-1].strip()
+            return condition.lower()
+        return normalize(predicate) == normalize(where)
+
+    def covered(self, index):
+        for existing in self.existing(index.alias):
+            if not self.same_predicate(existing['predicate'], index.where):
+                continue
+            # expression columns are not reflected, the name was ours
+            if existing['name'] == self.index_name(index):
+                return True
+            columns = tuple(existing['columns'])
+            if index.unique:
+                if existing['unique'] and set(columns) == set(index.columns):
+                    return True
+            elif index.method == 'brin':
+                if columns[:1] == index.columns[:1]:
+                    return True
+            elif existing['method'] == 'btree' and columns[:len(index.columns)] == index.columns:
+                return True
+        return False
+
+    def missing(self):
+        return [index for index in self.wanted() if not self.covered(index)]
+
+    def index_name(self, index):
+        index_name = '{}_{}_{}'.format(
+                index.alias['table'], '_'.join(index.columns), 'key' if index.unique else 'idx')
+        return re.sub(r'\W+', '_', index_name).strip('_')[:MAX_IDENTIFIER_LENGTH]
+
+    def ddl(self, index):
+        sql = 'CREATE {}INDEX CONCURRENTLY IF NOT EXISTS {} ON {}.{} USING {} ({})'.format(
+                'UNIQUE ' if index.unique else '',
+                self.index_name(index),
+                index.alias.area['schema'], index.alias['table'],
+                index.method,
+                ', '.join(index.columns))
+        if index.where:
+            sql += ' WHERE {}'.format(index.where)
+        return sql + ';'
+
+    def run(self, apply=False):
+        missing = self.missing()
+        if not missing:
+            _logger.info("No missing indexes")
+        for index in missing:
+            ddl = self.ddl(index)
+            print('-- {}: {}'.format(index.alias.name, index.reason))
+            print(ddl)
+            if apply:
+                _logger.info("Creating index on {}".format(index.alias.name))
+                # CONCURRENTLY can not run inside a transaction
+                engine = catalog.engines[index.alias.area['database']]
+                with engine.connect() as connection:
+                    (connection
+                        .execution_options(isolation_level='AUTOCOMMIT')
+                        .execute(text(ddl)))
+        return missing
+
+
+if __name__ == '__main__':
+    app = CronGDWIndexes()
+    app.run()
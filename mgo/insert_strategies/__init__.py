@@ -4,6 +4,8 @@ def choose_insert_strategy(load_definition):
     how = load_definition.get('how', 'insert')
     if how == 'insert':
         insert_strategy = 'simple_insert.SimpleInsert'
+    elif how == 'upsert':
+        insert_strategy = 'upsert.UpsertStrategy'
     elif how == 'dimension':
         type = load_definition.get('type', 'insert')
         if type == 'scd2':
@@ -1,11 +1,13 @@
 from .insert_strategy import InsertStrategy
-from sqlalchemy.sql import select, literal_column, and_
+from sqlalchemy.sql import select, literal_column, and_, not_
 from sqlalchemy.sql.functions import coalesce, func
-from sqlalchemy import exists
+from sqlalchemy import exists, bindparam, cast, text, Date
 import sqlalchemy
 from datetime import timedelta
-from mgoutils.dateutils import filter_date_range
-from mgoutils.catalog import GDWTable, catalog, STATE_START_COLUMN, STATE_END_COLUMN
+from mgoutils.dateutils import filter_date_range, END_PARAM
+from mgoutils.sqlutils import row_hash
+from mgoutils.catalog import GDWTable, catalog, STATE_START_COLUMN, STATE_END_COLUMN, \
+        VALID_FROM_COLUMN, VALID_TO_COLUMN, ROW_HASH_COLUMN
 
 class DimensionStrategy(InsertStrategy):
     @property
@@ -32,6 +34,10 @@ class DimensionStrategy(InsertStrategy):
             object_key_columns = [object_key_columns]
         return object_key_columns
 
+    @property
+    def key_columns(self):
+        return self.object_key_columns
+
     @property
     def priority_order(self):
         priority_columns = self.target_alias['load']['priority']
@@ -52,12 +58,23 @@ class DimensionStrategy(InsertStrategy):
         return order_by
 
 
+# incremental type 2 load. only the object keys with changes in the window
+# are touched, and only from their first new range to the end of the window
+# (or their last new range, if later). loading an older window again leaves
+# the versions written by later windows alone:
+# 1. the transform rows go to the staging table with the ranges each row is
+#    valid for, after resolving overlaps by priority
+# 2. versions of the changed keys starting inside that interval are
+#    superseded and deleted
+# 3. the versions still open at the first new range are closed with one update
+# 4. the new versions are inserted with one insert. a new version open or
+#    ending after the start of the next version kept ends there instead
 class SCD2DimensionStrategy(DimensionStrategy):
-    def generate_insert(self):
-        result = []
-        # first insert fields for which we have no change record
-        staging_alias = catalog.aliases[self.target_alias['load']['staging_alias']]
+    @property
+    def staging_table(self):
+        return catalog.aliases[self.target_alias['load']['staging_alias']].sql_table
 
+    def generate_staging_insert(self):
         # create a subselect from the transform query and add column
         # gdw_state_dts_range = all timestamp ranges for which this row is valid
         select_sql = sqlalchemy.alias(self.select_sql, 'source_transform')
@@ -65,38 +82,224 @@ class SCD2DimensionStrategy(DimensionStrategy):
         gdw_state_dts_range = func.prioritize_ranges(
                 func.array_agg(
                     func.tsrange(
-                        literal_column('gdw_state_start'),
-                        literal_column('gdw_state_end'))
+                        literal_column(STATE_START_COLUMN),
+                        literal_column(STATE_END_COLUMN))
                 ).over(partition_by=[literal_column(c) for c in self.object_key_columns],
                        order_by=self.priority_order
                 )).label('gdw_state_dts_range')
         select_sql_columns.append(gdw_state_dts_range)
 
-        result.append(staging_alias.sql_table
+        return (self.staging_table
                 .insert()
                 .from_select(
                     self.stage_col_names,
-                    select(select_sql_columns))
-                )
+                    select(select_sql_columns)))
 
-        # select all from existing dimension. look up the object key in stage and remove from
-        # gdw_state_dts_range that already is calculated on stage
-        select_sql = sqlalchemy.alias(self.select_sql, 'source_transform')
-        select_sql_columns = [select_sql.corresponding_column(c) for c in self.select_sql.c]
-        gdw_state_dts_range = func.prioritize_ranges(
-                func.array_agg(
-                    func.tsrange(
-                        literal_column('gdw_state_start'),
-                        literal_column('gdw_state_end'))
-                ).over(partition_by=[literal_column(c) for c in self.object_key_columns],
-                       order_by=self.priority_order
-                )).label('gdw_state_dts_range')
-        select_sql_columns.append(gdw_state_dts_range)
+    @property
+    def versions(self):
+        # one row per valid range of each staged row
+        staging_table = self.staging_table
+        versions = select(
+                [staging_table.c[c] for c in self.col_names] +
+                [func.unnest(staging_table.c.gdw_state_dts_range).label('gdw_state_range')])
+        return sqlalchemy.alias(versions, 'versions')
+
+    @property
+    def changes(self):
+        # changed object keys, the start of their first new version and the
+        # end of the window, or the start of their last one if it is later
+        versions = self.versions
+        window_end = bindparam(END_PARAM, str(self.end))
+        changes = (select(
+                [versions.c[c] for c in self.object_key_columns] +
+                [func.min(func.lower(versions.c.gdw_state_range)).label('gdw_change_start'),
+                 func.greatest(func.max(func.lower(versions.c.gdw_state_range)), window_end)
+                     .label('gdw_change_end')])
+                .where(not_(func.isempty(versions.c.gdw_state_range)))
+                .group_by(*[versions.c[c] for c in self.object_key_columns]))
+        return sqlalchemy.alias(changes, 'changes')
+
+    def same_object_key(self, changes):
+        return and_(*[self.target_table.c[c] == changes.c[c]
+                      for c in self.object_key_columns])
+
+    def generate_delete_superseded(self, changes):
+        target_table = self.target_table
+        superseded = (select([literal_column('1')])
+                .select_from(changes)
+                .where(and_(
+                    self.same_object_key(changes),
+                    target_table.c[STATE_START_COLUMN] >= changes.c.gdw_change_start,
+                    target_table.c[STATE_START_COLUMN] <= changes.c.gdw_change_end))
+                .correlate(target_table))
+        return target_table.delete().where(exists(superseded))
 
-        result.append(staging_alias.sql_table
+    def generate_close_versions(self, changes):
+        target_table = self.target_table
+        return (target_table
+                .update()
+                .where(and_(
+                    self.same_object_key(changes),
+                    target_table.c[STATE_START_COLUMN] < changes.c.gdw_change_start,
+                    coalesce(
+                        target_table.c[STATE_END_COLUMN],
+                        literal_column("'infinity'::timestamp")) > changes.c.gdw_change_start))
+                .values({STATE_END_COLUMN: changes.c.gdw_change_start}))
+
+    def generate_insert_versions(self):
+        versions = self.versions
+        target_table = self.target_table
+        version_start = func.lower(versions.c.gdw_state_range)
+        # the first version left after the new ones, loaded by a later window.
+        # least() ignores the null of an open range or of no next version
+        next_start = (select([func.min(target_table.c[STATE_START_COLUMN])])
+                .where(and_(
+                    and_(*[target_table.c[c] == versions.c[c]
+                           for c in self.object_key_columns]),
+                    target_table.c[STATE_START_COLUMN] > version_start))
+                .correlate(versions)
+                .as_scalar())
+        # dimension columns not in the transform (surrogate keys, load
+        # timestamps...) are left to their defaults
+        col_names = []
+        columns = []
+        for c in self.dim_col_names:
+            if c == STATE_START_COLUMN:
+                columns.append(version_start)
+            elif c == STATE_END_COLUMN:
+                columns.append(func.least(func.upper(versions.c.gdw_state_range), next_start))
+            elif c in versions.c:
+                columns.append(versions.c[c])
+            else:
+                continue
+            col_names.append(c)
+        return (self.target_table
                 .insert()
                 .from_select(
-                    self.stage_col_names,
-                    select(select_sql_columns))
-                )
-        return result
+                    col_names,
+                    select(columns)
+                    .where(not_(func.isempty(versions.c.gdw_state_range)))))
+
+    def generate_insert(self):
+        changes = self.changes
+        return [self.generate_staging_insert(),
+                self.generate_delete_superseded(changes),
+                self.generate_close_versions(changes),
+                self.generate_insert_versions()]
+
+
+# daily snapshot stored as validity ranges. each row of the snapshot of a day
+# is only written when its attribute hash differs from the open version of
+# its object key. versions of keys missing from the snapshot or changed are
+# closed on that day. the snapshot day is the end of the window and days
+# must be loaded in order: the last day loaded can be loaded again, an
+# earlier one is refused. <table>_as_of(date) returns the snapshot of a day
+class DailyDimensionStrategy(DimensionStrategy):
+    @property
+    def snapshot_date(self):
+        return cast(bindparam(END_PARAM, str(self.end)), Date)
+
+    # load.hash_columns, by default (or true) every column but the object
+    # key and the gdw_ ones, so the state columns never make a day look changed
+    @property
+    def attribute_columns(self):
+        hash_columns = self.target_alias['load'].get('hash_columns')
+        if hash_columns and hash_columns is not True:
+            return self.hash_columns
+        return [c for c in self.col_names
+                if c not in self.object_key_columns and not c.startswith('gdw_')]
+
+    @property
+    def snapshot(self):
+        source = sqlalchemy.alias(self.select_sql, 'source_transform')
+        snapshot = select(
+                [source.c[c] for c in self.col_names] +
+                [row_hash([source.c[c] for c in self.attribute_columns]).label(ROW_HASH_COLUMN)])
+        return sqlalchemy.alias(snapshot, 'snapshot')
+
+    def same_object_key(self, snapshot):
+        return and_(*[self.target_table.c[c] == snapshot.c[c]
+                      for c in self.object_key_columns])
+
+    # <table>_as_of and <table>_check_day, created only when missing
+    def generate_functions(self):
+        target_table = self.target_table
+        return text("""
+            DO $do$ BEGIN
+                IF to_regprocedure('{table}_as_of(date)') IS NULL THEN
+                    CREATE FUNCTION {table}_as_of(as_of date)
+                    RETURNS SETOF {table} LANGUAGE sql STABLE AS $$
+                        SELECT * FROM {table}
+                        WHERE {valid_from} <= as_of
+                          AND ({valid_to} IS NULL OR {valid_to} > as_of)
+                    $$;
+                END IF;
+                IF to_regprocedure('{table}_check_day(date)') IS NULL THEN
+                    CREATE FUNCTION {table}_check_day(day date)
+                    RETURNS void LANGUAGE plpgsql STABLE AS $$ BEGIN
+                        IF EXISTS (SELECT 1 FROM {table}
+                                   WHERE {valid_from} > day OR {valid_to} > day) THEN
+                            RAISE EXCEPTION USING MESSAGE = 'days after ' || day
+                                || ' are loaded in {table}, load the days in order';
+                        END IF;
+                    END $$;
+                END IF;
+            END $do$;""".format(
+                table=target_table,
+                valid_from=VALID_FROM_COLUMN,
+                valid_to=VALID_TO_COLUMN))
+
+    # loading the last day again first undoes what it wrote: the versions
+    # it started and the ones it closed
+    def generate_undo_day(self):
+        target_table = self.target_table
+        valid_from = target_table.c[VALID_FROM_COLUMN]
+        valid_to = target_table.c[VALID_TO_COLUMN]
+        return [text('SELECT {}_check_day(CAST(:{} AS DATE));'
+                     .format(target_table, END_PARAM)),
+                target_table.delete().where(valid_from == self.snapshot_date),
+                target_table
+                .update()
+                .where(valid_to == self.snapshot_date)
+                .values({VALID_TO_COLUMN: None})]
+
+    def generate_close_versions(self, snapshot):
+        target_table = self.target_table
+        unchanged = (select([literal_column('1')])
+                .select_from(snapshot)
+                .where(and_(
+                    self.same_object_key(snapshot),
+                    snapshot.c[ROW_HASH_COLUMN] == target_table.c[ROW_HASH_COLUMN]))
+                .correlate(target_table))
+        return (target_table
+                .update()
+                .where(and_(
+                    target_table.c[VALID_TO_COLUMN] == None,
+                    not_(exists(unchanged))))
+                .values({VALID_TO_COLUMN: self.snapshot_date}))
+
+    def generate_insert_versions(self, snapshot):
+        target_table = self.target_table
+        open_version = (select([literal_column('1')])
+                .select_from(target_table)
+                .where(and_(
+                    self.same_object_key(snapshot),
+                    target_table.c[VALID_TO_COLUMN] == None,
+                    target_table.c[ROW_HASH_COLUMN] == snapshot.c[ROW_HASH_COLUMN]))
+                .correlate(snapshot))
+        col_names = [c for c in self.col_names if c in target_table.c]
+        return (target_table
+                .insert()
+                .from_select(
+                    col_names + [ROW_HASH_COLUMN, VALID_FROM_COLUMN],
+                    select(
+                        [snapshot.c[c] for c in col_names] +
+                        [snapshot.c[ROW_HASH_COLUMN], self.snapshot_date])
+                    .where(not_(exists(open_version)))))
+
+    def generate_insert(self):
+        snapshot = self.snapshot
+        return ([self.generate_functions()] +
+                self.generate_undo_day() +
+                [self.generate_close_versions(snapshot),
+                 self.generate_insert_versions(snapshot)])
@@ -1,17 +1,80 @@
 from abc import ABCMeta, abstractmethod
-from mgoutils.catalog import catalog
+import sqlalchemy
+from sqlalchemy import Column, text
+from sqlalchemy.sql import select
+from mgoutils.catalog import GDWTable, catalog, ROW_HASH_COLUMN
+from mgoutils.sqlutils import CreateTableAs, row_hash
 
 class InsertStrategy():
     __metaclass__ = ABCMeta
 
-    def __init__(self, gdw_transform):
+    def __init__(self, gdw_transform, target_table=None):
         self.gdw_transform = gdw_transform
         self.target_alias = gdw_transform.target_alias
-        self.target_table = self.target_alias.sql_table
+        # the table to write into. by default the table of the target alias
+        self.target_table = target_table if target_table is not None else self.target_alias.sql_table
         self.col_names = gdw_transform.col_names()
         self.select_sql = gdw_transform.generate_sql()
         self.start, self.end = gdw_transform.start, gdw_transform.end
 
+    @property
+    def primary_key_columns(self):
+        primary_key = self.target_alias.get('load', {}).get('primary_key')
+        if isinstance(primary_key, str):
+            primary_key = [primary_key]
+        if not primary_key:
+            primary_key = [c.name for c in self.target_table.primary_key.columns]
+        if not primary_key:
+            raise RuntimeError('{} needs a load.primary_key'
+                    .format(self.target_alias.name))
+        return primary_key
+
+    # the columns that identify a row of the target
+    @property
+    def key_columns(self):
+        return self.primary_key_columns
+
+    # load.hash_columns: the columns whose md5 is kept in gdw_row_hash, so
+    # rows that did not change are not written again. true hashes every
+    # column but the key
+    @property
+    def hash_columns(self):
+        hash_columns = self.target_alias.get('load', {}).get('hash_columns')
+        if hash_columns is True:
+            return [c for c in self.col_names if c not in self.key_columns]
+        if isinstance(hash_columns, str):
+            hash_columns = [hash_columns]
+        return hash_columns or []
+
+    @property
+    def hashes_rows(self):
+        if not self.hash_columns:
+            return False
+        if ROW_HASH_COLUMN not in self.target_table.c:
+            raise RuntimeError('{} needs a {} column for its load.hash_columns'
+                    .format(self.target_alias.name, ROW_HASH_COLUMN))
+        return True
+
+    # the transform rows and their hash
+    def hashed_select(self):
+        source = sqlalchemy.alias(self.select_sql, 'source_transform')
+        return select(
+                [source.c[c] for c in self.col_names] +
+                [row_hash([source.c[c] for c in self.hash_columns]).label(ROW_HASH_COLUMN)])
+
+    # the hashed transform rows in a temporary table, read by the next
+    # statements of the load on the same connection
+    def generate_new_rows(self):
+        col_names = self.col_names + [ROW_HASH_COLUMN]
+        new_rows = GDWTable(
+                '{}__mgo_rows'.format(self.target_table.name), sqlalchemy.MetaData(),
+                *[Column(c) for c in col_names])
+        return new_rows, [
+                text('DROP TABLE IF EXISTS pg_temp.{};'.format(new_rows.name)),
+                CreateTableAs(new_rows, self.hashed_select(), prefix='TEMPORARY'),
+                text('CREATE INDEX ON {} ({});'.format(new_rows, ', '.join(self.key_columns))),
+                text('ANALYZE {};'.format(new_rows))]
+
     @abstractmethod
     def generate_insert():
         raise NotImplementedError("You should implement this!")
@@ -1,8 +1,68 @@
 from .insert_strategy import InsertStrategy
+from sqlalchemy import exists
+from sqlalchemy.sql import select, literal_column, and_, not_
+from mgoutils.catalog import ROW_HASH_COLUMN
+from mgoutils.deletes import delete_scope
 
 class SimpleInsert(InsertStrategy):
     def generate_insert(self):
-        return (self
-                .target_table
+        if not self.hashes_rows:
+            return (self
+                    .target_table
+                    .insert()
+                    .from_select(self.col_names, self.select_sql))
+        if self.target_table is not self.target_alias.sql_table:
+            # a shadow table starts empty, every row is new
+            return (self
+                    .target_table
+                    .insert()
+                    .from_select(self.col_names + [ROW_HASH_COLUMN], self.hashed_select()))
+        return self.generate_changed_rows()
+
+    # with load.hash_columns nothing is deleted before the insert. the rows
+    # of the delete scope are compared by key and hash with the new ones and
+    # only the changed rows are deleted and inserted again. rows whose key is
+    # gone are deleted, or flagged when the target declares its is_deleted
+    # column. the transform must return each key only once
+    def generate_changed_rows(self):
+        target_table = self.target_table
+        new_rows, statements = self.generate_new_rows()
+        scope = delete_scope(self.target_alias, target_table, self.start, self.end)
+
+        def in_scope(*clauses):
+            return and_(*[c for c in (scope,) + clauses if c is not None])
+
+        same_key = and_(*[target_table.c[c] == new_rows.c[c] for c in self.key_columns])
+        new_key = (select([literal_column('1')])
+                .select_from(new_rows)
+                .where(same_key)
+                .correlate(target_table))
+        changed_hash = (new_rows.c[ROW_HASH_COLUMN]
+                .op('IS DISTINCT FROM')(target_table.c[ROW_HASH_COLUMN]))
+
+        is_deleted_column = self.target_alias.is_deleted_column
+        if is_deleted_column:
+            is_deleted = target_table.c[is_deleted_column]
+            statements.append(target_table.delete().where(in_scope(
+                    exists(new_key.where(changed_hash | (is_deleted == True))))))
+            statements.append(target_table
+                    .update()
+                    .where(in_scope(is_deleted.isnot(True), not_(exists(new_key))))
+                    .values({is_deleted_column: True}))
+        else:
+            statements.append(target_table.delete().where(in_scope(
+                    not_(exists(new_key.where(not_(changed_hash)))))))
+
+        # what is left of the scope with a new key did not change
+        kept = (select([literal_column('1')])
+                .select_from(target_table)
+                .where(in_scope(same_key))
+                .correlate(new_rows))
+        col_names = self.col_names + [ROW_HASH_COLUMN]
+        statements.append(target_table
                 .insert()
-                .from_select(self.col_names, self.select_sql))
+                .from_select(
+                    col_names,
+                    select([new_rows.c[c] for c in col_names])
+                    .where(not_(exists(kept)))))
+        return statements
@@ -0,0 +1,36 @@
+from .insert_strategy import InsertStrategy
+from mgoutils.catalog import ROW_HASH_COLUMN
+from mgoutils.sqlutils import InsertOnConflict
+
+
+# insert new keys and update existing ones with INSERT ... ON CONFLICT.
+# rows whose columns did not change are not written at all, with
+# load.hash_columns only their hashes are compared. the transform must return
+# each key only once
+class UpsertStrategy(InsertStrategy):
+    def generate_insert(self):
+        primary_key = self.primary_key_columns
+        col_names = self.col_names
+        select_sql = self.select_sql
+        if self.hashes_rows:
+            col_names = col_names + [ROW_HASH_COLUMN]
+            select_sql = self.hashed_select()
+        update_columns = [c for c in col_names if c not in primary_key]
+        table_name = self.target_table.name
+
+        update = dict((c, 'EXCLUDED.{}'.format(c)) for c in update_columns)
+        where = None
+        if self.hashes_rows:
+            where = '{0}.{1} IS DISTINCT FROM EXCLUDED.{1}'.format(table_name, ROW_HASH_COLUMN)
+        elif update_columns:
+            where = '({}) IS DISTINCT FROM ({})'.format(
+                    ', '.join('{}.{}'.format(table_name, c) for c in update_columns),
+                    ', '.join('EXCLUDED.{}'.format(c) for c in update_columns))
+
+        return InsertOnConflict(
+                self.target_table
+                .insert()
+                .from_select(col_names, select_sql),
+                primary_key,
+                update=update,
+                where=where)
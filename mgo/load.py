@@ -1,14 +1,25 @@
 import logging
 import collections
+import datetime
+from os import path
+from itertools import groupby
+from multiprocessing.pool import ThreadPool
 from cmdlineutil import CronJob
 import de_common.scriptutil as scriptutil
-from mgoutils.catalog import catalog
-from mgoutils.sqlutils import compile_sql
-from mgoutils.dateutils import DEFAULT_START, DEFAULT_END, filter_date_range, parse_date
+from mgoutils.catalog import catalog, METADATA_DIRECTORY
+from mgoutils.sqlutils import compile_sql, InsertOnConflict
+from mgoutils.sqlcache import CompiledStatement, source_fingerprint
+from mgoutils.dateutils import default_start, default_end, filter_date_range, parse_date, window_params, \
+        range_chunks, align_to_chunks
+from mgoutils.state import checkpoints, watermarks, create_state_tables, state_engine, STATE_AREA
+from mgoutils.instrument import GDWInstrument
+from mgoutils.explain import GDWExplain
+from mgoutils.federation import GDWFederation
 from transform import GDWTransform
 from delete import GDWDelete
+import sqlalchemy
 from sqlalchemy import text
-from sqlalchemy.sql import select, case, and_, or_, not_, literal_column
+from sqlalchemy.sql import select, case, and_, or_, not_, literal, literal_column, func
 from sqlalchemy.sql.expression import union_all, alias
 from sqlalchemy.sql.functions import concat, coalesce
 from insert_strategies import get_insert_strategy
@@ -18,6 +29,93 @@ DISPLAY_NAME = scriptutil.get_display_name(__file__)
 TOOL_NAME = scriptutil.get_tool_name(DISPLAY_NAME)
 _logger = logging.getLogger(TOOL_NAME)
 
+SHADOW_SUFFIX = '__mgo_shadow'
+OLD_SUFFIX = '__mgo_old'
+# phases whose statements must commit or fail together
+ATOMIC_PHASES = ('MATERIALIZE', 'SWAP')
+# load.lookback when none is given: rows committed late with an older
+# modified date are still read by the next watermark load
+DEFAULT_LOOKBACK = {'hours': 1}
+
+# a swapped in table is a new relation: views would keep pointing at the old
+# one and foreign keys referencing it would go with it, so those are refused
+SWAP_CHECK_SQL = """
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1
+               FROM pg_catalog.pg_depend d
+               JOIN pg_catalog.pg_rewrite r ON r.oid = d.objid
+               WHERE d.classid = 'pg_catalog.pg_rewrite'::regclass
+                 AND d.refobjid = '{table}'::regclass
+                 AND r.ev_class <> d.refobjid) THEN
+        RAISE EXCEPTION 'Swap load of {table}: views depend on it';
+    END IF;
+    IF EXISTS (SELECT 1
+               FROM pg_catalog.pg_constraint
+               WHERE contype = 'f' AND confrelid = '{table}'::regclass) THEN
+        RAISE EXCEPTION 'Swap load of {table}: foreign keys reference it';
+    END IF;
+END $$;
+"""
+
+# CREATE TABLE LIKE copies neither the grants nor the foreign keys
+SWAP_COPY_SQL = """
+DO $$
+DECLARE
+    copy_sql text;
+BEGIN
+    FOR copy_sql IN
+        SELECT format('GRANT %s ON {shadow} TO %s%s', a.privilege_type,
+                      CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(r.rolname) END,
+                      CASE WHEN a.is_grantable THEN ' WITH GRANT OPTION' ELSE '' END)
+        FROM pg_catalog.pg_class c
+        CROSS JOIN LATERAL aclexplode(c.relacl) a
+        LEFT JOIN pg_catalog.pg_roles r ON r.oid = a.grantee
+        WHERE c.oid = '{table}'::regclass
+        UNION ALL
+        SELECT format('ALTER TABLE {shadow} ADD CONSTRAINT %I %s',
+                      conname, pg_catalog.pg_get_constraintdef(oid))
+        FROM pg_catalog.pg_constraint
+        WHERE contype = 'f' AND conrelid = '{table}'::regclass
+    LOOP
+        EXECUTE copy_sql;
+    END LOOP;
+END $$;
+"""
+
+# the indexes of the shadow table (and so its primary key and unique
+# constraints) get their names from it. once swapped, every index takes the
+# name of the same index of the old table, which moves out of the way
+SWAP_INDEX_NAMES_SQL = """
+DO $$
+DECLARE
+    i record;
+BEGIN
+    FOR i IN
+        SELECT DISTINCT ON (o.indexrelid)
+               o.indexrelid AS old_oid, oi.relname AS name, ni.relname AS shadow_name
+        FROM pg_catalog.pg_index o
+        JOIN pg_catalog.pg_class oi ON oi.oid = o.indexrelid
+        JOIN pg_catalog.pg_index n
+          ON n.indrelid = '{table}'::regclass
+         AND n.indkey::text = o.indkey::text
+         AND n.indclass::text = o.indclass::text
+         AND n.indisunique = o.indisunique
+         AND n.indisprimary = o.indisprimary
+         AND coalesce(pg_catalog.pg_get_expr(n.indexprs, n.indrelid), '')
+             = coalesce(pg_catalog.pg_get_expr(o.indexprs, o.indrelid), '')
+         AND coalesce(pg_catalog.pg_get_expr(n.indpred, n.indrelid), '')
+             = coalesce(pg_catalog.pg_get_expr(o.indpred, o.indrelid), '')
+        JOIN pg_catalog.pg_class ni ON ni.oid = n.indexrelid
+        WHERE o.indrelid = '{old}'::regclass
+        ORDER BY o.indexrelid, n.indexrelid
+    LOOP
+        EXECUTE format('ALTER INDEX {schema}.%I RENAME TO %I', i.name, 'mgo_old_' || i.old_oid);
+        EXECUTE format('ALTER INDEX {schema}.%I RENAME TO %I', i.shadow_name, i.name);
+    END LOOP;
+END $$;
+"""
+
 
 class CronGDWLoad(CronJob):
     def __init__(self):
@@ -32,45 +130,206 @@ class CronGDWLoad(CronJob):
         (('-t', '--target'), dict(type=str, dest='target', required=True)),
         (('-s', '--start'), dict(type=str, dest='start_datetime', required=False)),
         (('-e', '--end'), dict(type=str, dest='end_datetime', required=False)),
-        (('-d', '--dry-run'), dict(type=bool, dest='dry_run', default=False))]
+        (('-d', '--dry-run'), dict(type=bool, dest='dry_run', default=False)),
+        (('-p', '--prepare'), dict(type=bool, dest='prepare', default=False)),
+        (('-b', '--backfill'), dict(type=str, dest='backfill', default=None,
+                                    choices=['day', 'week', 'month'])),
+        (('-j', '--parallel'), dict(type=int, dest='parallel', default=1)),
+        (('-w', '--swap'), dict(type=bool, dest='swap', default=False)),
+        (('-m', '--watermark'), dict(type=bool, dest='watermark', default=False)),
+        (('-x', '--explain-analyze'), dict(type=bool, dest='explain_analyze', default=False)),
+        (('-f', '--metrics-file'), dict(type=str, dest='metrics_file', default=None)),
+        (('-r', '--history'), dict(type=bool, dest='history', default=False)),
+        (('-c', '--cost'), dict(type=bool, dest='cost', default=False))]
 
     def _run_impl(self):
         catalog.configure(self.config)
+        if self.opts.history:
+            create_state_tables()
+        instrument = GDWInstrument(
+                self.target_alias,
+                explain=self.opts.explain_analyze,
+                metrics_file=self.opts.metrics_file,
+                history=self.opts.history)
+
+        if self.opts.backfill:
+            gdw_backfill = GDWBackfill(
+                    self.target_alias, self.config,
+                    self.opts.start_datetime,
+                    self.opts.end_datetime,
+                    chunk=self.opts.backfill,
+                    parallel=self.opts.parallel,
+                    instrument=instrument)
+            gdw_backfill.run(dry_run=self.opts.dry_run, prepare=self.opts.prepare)
+            return
+
         gdw_load = GDWLoad(
                 self.target_alias, self.config,
                 self.opts.start_datetime,
-                self.opts.end_datetime)
-        engine = gdw_load.engine
-        for description, sqls in gdw_load.generate_load():
-            if not isinstance(sqls, collections.Iterable):
-                sqls = [sqls]
-            for sql in sqls:
-                if self.opts.dry_run:
-                    _logger.info("Dry run. {} SQL statement not run:"
-                            .format(description))
-                    _logger.info(compile_sql(sql, engine))
-                else:
-                    _logger.info("Executing {} process in database"
-                            .format(description))
-                    engine.execute(sql.execution_options(autocommit=True))
+                self.opts.end_datetime,
+                swap=self.opts.swap,
+                watermark=self.opts.watermark,
+                instrument=instrument)
+        if self.opts.cost:
+            gdw_load.explain_plans()
+            return
+        gdw_load.run(dry_run=self.opts.dry_run, prepare=self.opts.prepare)
 
 
 # delete the data for the specified day
 class GDWLoad():
-    def __init__(self, target_alias_name, config, start=None, end=None):
+    def __init__(self, target_alias_name, config, start=None, end=None,
+                 swap=False, watermark=False, instrument=None):
         self.target_alias = catalog.aliases[target_alias_name]
         self.config = config
+        self.instrument = instrument or GDWInstrument(self.target_alias.name)
         self.target_table = self.target_alias.sql_table
+        load_definition = self.target_alias.get('load', {})
+        self.swap = swap or load_definition.get('swap', False)
+        self.watermark = watermark or load_definition.get('incremental') == 'watermark'
 
-        self.start = parse_date(start or DEFAULT_START)
-        self.end = parse_date(end or DEFAULT_END)
+        self.start = parse_date(start or default_start())
+        self.end = parse_date(end or default_end())
+        # in watermark mode the window runs until now unless an end is given
+        if self.watermark and not end:
+            self.end = datetime.datetime.now()
+        # start of the window of each source, see watermark_starts
+        self.source_starts = {}
+        # copies of the sources in other databases, see federate
+        self.local_tables = {}
 
     @property
     def engine(self):
         return catalog.engine_from_alias(self.target_alias.name)
 
-    def generate_insert(self, gdw_transform):
-        insert_strategy = get_insert_strategy(gdw_transform)
+    # the compiled statements only depend on the metadata files, the
+    # reflected tables and the mgo code. never on the date window
+    def cache_key(self):
+        def file_contents(file_path):
+            try:
+                with open(file_path, 'rb') as f:
+                    return f.read()
+            except IOError:
+                return b''
+
+        parts = [
+                self.target_alias.name,
+                self.swap,
+                self.watermark,
+                source_fingerprint(),
+                file_contents(path.join(METADATA_DIRECTORY, 'areas.yaml')),
+                catalog.relationships.fingerprint]
+        if self.window_dependent:
+            parts += [self.start, self.end]
+        for alias_name in catalog.alias_closure(self.target_alias.name):
+            parts += [
+                    alias_name,
+                    file_contents(catalog.alias_file(alias_name)),
+                    file_contents(catalog.transform_file(alias_name)),
+                    catalog.aliases[alias_name].fingerprint]
+        return catalog.sql_cache.key(*parts)
+
+    def load_statements(self):
+        for description, sqls in self.generate_load():
+            if not isinstance(sqls, collections.Iterable):
+                sqls = [sqls]
+            for sql in sqls:
+                yield description, sql
+
+    def compiled_statements(self):
+        key = self.cache_key()
+        statements = catalog.sql_cache.get(key)
+        if statements is None:
+            engine = self.engine
+            statements = [
+                    CompiledStatement.compile(description, sql, engine)
+                    for description, sql in self.load_statements()]
+            catalog.sql_cache.put(key, statements)
+        return statements
+
+    def run(self, dry_run=False, prepare=False):
+        engine = self.engine
+        if self.watermark:
+            create_state_tables()
+            self.source_starts = self.watermark_starts()
+            if self.source_starts:
+                self.start = min(self.source_starts.values())
+            for source, source_start in sorted(self.source_starts.items()):
+                _logger.info("Loading {} changes of {} from {} to {}"
+                        .format(self.target_alias.name, source, source_start, self.end))
+
+        self.federate(dry_run=dry_run)
+        with self.table_scope():
+            if dry_run:
+                for description, sql in self.load_statements():
+                    _logger.info("Dry run. {} SQL statement not run:"
+                            .format(description))
+                    _logger.info(compile_sql(sql, engine))
+                plan = GDWTransform(
+                        self.target_alias.name, self.config,
+                        self.start, self.end).plan
+                for window_filter in plan.filters:
+                    _logger.info("Date window on {}".format(window_filter))
+                return
+
+            with engine.connect() as connection:
+                if self.watermark:
+                    # the watermarks only move if the whole load commits.
+                    # one snapshot for the whole load, so the max modified
+                    # date is read from the same rows the insert read
+                    connection = connection.execution_options(
+                            isolation_level='REPEATABLE READ')
+                    with connection.begin():
+                        self.execute(connection, prepare=prepare)
+                else:
+                    self.execute(connection, prepare=prepare)
+
+    # the sources in other databases are copied for this load only
+    def federate(self, start=None, end=None, dry_run=False):
+        self.local_tables = GDWFederation(
+                self.target_alias.name,
+                start or self.start,
+                end or self.end).run(dry_run=dry_run)
+
+    # the statements of the load are generated and run in this scope, where
+    # the aliases of the copied sources read from their copies
+    def table_scope(self):
+        return catalog.table_scope(
+                self.target_alias.name, self.local_tables, self.engine)
+
+    # dry run that asks postgres for the plan of every statement, see GDWExplain
+    def explain_plans(self):
+        self.federate(dry_run=True)
+        with self.table_scope():
+            froms, joins = (), ()
+            if path.exists(catalog.transform_file(self.target_alias.name)):
+                plan = GDWTransform(
+                        self.target_alias.name, self.config,
+                        self.start, self.end).plan
+                froms, joins = plan.froms, plan.joins
+            gdw_explain = GDWExplain(self.target_alias.name)
+            with self.engine.connect() as connection:
+                return gdw_explain.run(
+                        connection, self.compiled_statements(),
+                        window_params(self.start, self.end),
+                        froms=froms, joins=joins)
+
+    def execute(self, connection, statements=None, start=None, end=None, prepare=False):
+        window = window_params(start or self.start, end or self.end, self.source_starts)
+        statements = statements or self.compiled_statements()
+        for description, group in groupby(statements, lambda s: s.description):
+            _logger.info("Executing {} process in database"
+                    .format(description))
+            if description in ATOMIC_PHASES and not connection.in_transaction():
+                with connection.begin():
+                    for statement in group:
+                        self.instrument.execute(statement, connection, window, prepare)
+            else:
+                for statement in group:
+                    self.instrument.execute(statement, connection, window, prepare)
+
+    def generate_insert(self, gdw_transform, target_table=None):
+        insert_strategy = get_insert_strategy(gdw_transform, target_table=target_table)
         return insert_strategy.generate_insert()
 
     # this function generates a list of sql statements needed to load target alias
@@ -79,6 +338,8 @@ class GDWLoad():
     # 3. generate the insert part. The insert will depend on whether we want to update
     #      fields based on a PK, whether is a SCD type field, etc.
     def generate_load(self):
+        if self.swap:
+            return self.generate_swap_load()
 
         gdw_delete = GDWDelete(
                 self.target_alias.name,
@@ -92,8 +353,337 @@ class GDWLoad():
                 self.end)
 
         insert_sql = self.generate_insert(gdw_transform)
-        return [('DELETE', delete_sql),
+        load_sql = self.generate_partitions() + self.generate_materialize(gdw_transform) + [
+                ('DELETE', delete_sql),
                 ('INSERT', insert_sql)]
+        if self.watermark:
+            load_sql.append(('WATERMARK', self.generate_watermark()))
+        return load_sql + self.generate_drop(gdw_transform)
+
+    # source aliases with a modified date the target reads, directly or
+    # through transforms without a table
+    def watermark_sources(self):
+        sources = []
+        for alias_name in catalog.read_alias_names(self.target_alias.name):
+            alias = catalog.aliases[alias_name]
+            if (alias_name not in sources and not alias.is_transform
+                    and alias.modified_date_column):
+                sources.append(alias_name)
+        return sources
+
+    # start of the window of every source: its watermark minus the lookback
+    # (load.lookback, a timedelta like {hours: 6}, DEFAULT_LOOKBACK if not
+    # given) so late rows are read again. sources never loaded start at the
+    # requested start.
+    # loads deleting a date range before inserting can not start each source
+    # on its own: a source starting later would not insert again what the
+    # delete removed from the earlier days. there every source starts at the
+    # oldest watermark, or at the requested start if one was never loaded
+    def watermark_starts(self):
+        gdw_delete = GDWDelete(self.target_alias.name)
+        if gdw_delete.deletes_everything:
+            raise RuntimeError(
+                    'Watermark load of {} can not delete the whole table'
+                    .format(self.target_alias.name))
+
+        rows = state_engine().execute(
+                select([watermarks.c.source_alias, watermarks.c.modified_max])
+                .where(watermarks.c.target == self.target_alias.name))
+        marks = dict((row.source_alias, row.modified_max) for row in rows)
+        lookback = datetime.timedelta(
+                **self.target_alias.get('load', {}).get('lookback', DEFAULT_LOOKBACK))
+        sources = self.watermark_sources()
+        starts = dict(
+                (source, marks[source] - lookback if source in marks else self.start)
+                for source in sources)
+
+        if sources and not gdw_delete.deleted_by_load:
+            if any(source not in marks for source in sources):
+                start = self.start
+            else:
+                start = min(starts.values())
+            starts = dict.fromkeys(sources, start)
+        return starts
+
+    # move the watermark of every source to the max modified date read. run
+    # executes it in the snapshot of the insert
+    def generate_watermark(self):
+        watermark_sqls = []
+        for alias_name in self.watermark_sources():
+            alias = catalog.aliases[alias_name]
+            modified = alias.sql_table.c[alias.modified_date_column]
+            max_modified = select([
+                    literal(self.target_alias.name),
+                    literal(alias_name),
+                    func.max(modified),
+                    func.now()])
+            max_modified = (max_modified
+                    .where(filter_date_range(modified, self.start, self.end, source=alias_name))
+                    .having(func.max(modified) != None))
+            watermark_sqls.append(InsertOnConflict(
+                    watermarks.insert().from_select(
+                        ['target', 'source_alias', 'modified_max', 'updated_at'],
+                        max_modified),
+                    ['target', 'source_alias'],
+                    update={
+                        'modified_max': 'greatest({}.modified_max, EXCLUDED.modified_max)'
+                                        .format(watermarks.name),
+                        'updated_at': 'EXCLUDED.updated_at'}))
+        return watermark_sqls
+
+    # build the materialized transforms the target reads before loading it
+    def generate_materialize(self, gdw_transform):
+        materialized = list(gdw_transform.plan.materialized)
+        if not materialized:
+            return []
+        return [('MATERIALIZE', materialized)]
+
+    # and drop the unlogged ones after the last statement of the load
+    def generate_drop(self, gdw_transform):
+        dropped = list(gdw_transform.plan.dropped)
+        if not dropped:
+            return []
+        return [('DROP', dropped)]
+
+    # create the partitions of the window (and the ones ahead) before loading
+    def generate_partitions(self):
+        partitioning = self.target_alias.partitioning
+        if not partitioning:
+            return []
+        return [('PARTITIONS', partitioning.generate_create(self.start, self.end))]
+
+    # partition names and bounds depend on the dates, so the statements of
+    # partitioned targets can not be shared between windows
+    @property
+    def window_dependent(self):
+        return self.target_alias.partitioning is not None
+
+    # instead of truncating the live table, build the new content into a
+    # shadow copy of the target (same columns, constraints, indexes, foreign
+    # keys and grants), analyze it and swap it in with two renames in one
+    # short transaction, giving the indexes back their names. readers keep
+    # seeing the old content until the swap commits. targets with views
+    # depending on them or foreign keys referencing them are refused
+    def generate_swap_load(self):
+        partitioning = self.target_alias.partitioning
+        if partitioning:
+            return self.generate_partition_swap_load(partitioning)
+
+        gdw_delete = GDWDelete(self.target_alias.name, self.start, self.end)
+        load_how = self.target_alias.get('load', {}).get('how', 'insert')
+        if not gdw_delete.deletes_everything or load_how != 'insert':
+            raise RuntimeError(
+                    'Swap load of {} needs a simple insert that replaces the whole table'
+                    .format(self.target_alias.name))
+
+        target_table = self.target_table
+        shadow_table = target_table.tometadata(
+                sqlalchemy.MetaData(),
+                name='{}{}'.format(target_table.name, SHADOW_SUFFIX))
+        old_name = '{}{}'.format(target_table.name, OLD_SUFFIX)
+        lock_timeout = self.target_alias.get('load', {}).get('swap_lock_timeout', '5s')
+
+        shadow_sql = [
+                self.generate_swap_check(target_table),
+                text('DROP TABLE IF EXISTS {};'.format(shadow_table)),
+                text('CREATE TABLE {} (LIKE {} INCLUDING ALL);'
+                     .format(shadow_table, target_table)),
+                self.generate_swap_copy(target_table, shadow_table)]
+
+        gdw_transform = GDWTransform(
+                self.target_alias.name, self.config,
+                self.start,
+                self.end)
+        insert_sql = self.generate_insert(gdw_transform, target_table=shadow_table)
+
+        swap_sql = [
+                text("SET LOCAL lock_timeout = '{}';".format(lock_timeout)),
+                text('ALTER TABLE {} RENAME TO {};'.format(target_table, old_name)),
+                text('ALTER TABLE {} RENAME TO {};'.format(shadow_table, target_table.name)),
+                self.generate_swap_index_names(target_table.schema, old_name, target_table.name),
+                text('DROP TABLE {}.{};'.format(target_table.schema, old_name))]
+
+        return self.generate_materialize(gdw_transform) + [
+                ('SHADOW', shadow_sql),
+                ('INSERT', insert_sql),
+                ('ANALYZE', text('ANALYZE {};'.format(shadow_table))),
+                ('SWAP', swap_sql)]
+
+    def generate_swap_check(self, table):
+        return text(SWAP_CHECK_SQL.format(table=table))
+
+    def generate_swap_copy(self, table, shadow_table):
+        return text(SWAP_COPY_SQL.format(table=table, shadow=shadow_table))
+
+    def generate_swap_index_names(self, schema, old_name, table_name):
+        return text(SWAP_INDEX_NAMES_SQL.format(
+                schema=schema,
+                old='{}.{}'.format(schema, old_name),
+                table='{}.{}'.format(schema, table_name)))
+
+    # partitioned targets only swap the partitions of the window. each one is
+    # built into its own shadow table, which gets the partition bounds as a
+    # check constraint so attaching it does not need to scan it
+    def generate_partition_swap_load(self, partitioning):
+        load_how = self.target_alias.get('load', {}).get('how', 'insert')
+        if load_how != 'insert' or not partitioning.covers_whole_partitions(self.start, self.end):
+            raise RuntimeError(
+                    'Swap load of {} needs a simple insert over whole partitions'
+                    .format(self.target_alias.name))
+
+        target_table = self.target_table
+        lock_timeout = self.target_alias.get('load', {}).get('swap_lock_timeout', '5s')
+        gdw_transform = GDWTransform(
+                self.target_alias.name, self.config,
+                self.start,
+                self.end)
+        source = sqlalchemy.alias(gdw_transform.generate_sql(), 'source_transform')
+        partition_column = source.c[partitioning.column]
+
+        shadow_sql = []
+        insert_sql = []
+        analyze_sql = []
+        swap_sql = [text("SET LOCAL lock_timeout = '{}';".format(lock_timeout))]
+        for lower, upper in partitioning.bounds(self.start, self.end):
+            partition_name = partitioning.name(lower)
+            partition_table = partitioning.full_name(lower)
+            shadow_table = target_table.tometadata(
+                    sqlalchemy.MetaData(),
+                    name='{}{}'.format(partition_name, SHADOW_SUFFIX))
+
+            old_name = '{}{}'.format(partition_name, OLD_SUFFIX)
+
+            shadow_sql += [
+                    self.generate_swap_check(partition_table),
+                    text('DROP TABLE IF EXISTS {};'.format(shadow_table)),
+                    text('CREATE TABLE {} (LIKE {} INCLUDING ALL);'
+                         .format(shadow_table, partition_table)),
+                    self.generate_swap_copy(partition_table, shadow_table),
+                    text("ALTER TABLE {} ADD CONSTRAINT {}_bounds "
+                         "CHECK ({} >= '{}' AND {} < '{}');"
+                         .format(shadow_table, shadow_table.name,
+                                 partitioning.column, lower,
+                                 partitioning.column, upper))]
+            insert_sql.append(shadow_table
+                    .insert()
+                    .from_select(
+                        gdw_transform.col_names(),
+                        select([source]).where(and_(
+                            partition_column >= lower,
+                            partition_column < upper))))
+            analyze_sql.append(text('ANALYZE {};'.format(shadow_table)))
+            swap_sql += [
+                    text('ALTER TABLE {} DETACH PARTITION {};'.format(target_table, partition_table)),
+                    text('ALTER TABLE {} RENAME TO {};'.format(partition_table, old_name)),
+                    text('ALTER TABLE {} RENAME TO {};'.format(shadow_table, partition_name)),
+                    self.generate_swap_index_names(target_table.schema, old_name, partition_name),
+                    text('DROP TABLE {}.{};'.format(target_table.schema, old_name)),
+                    text("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM ('{}') TO ('{}');"
+                         .format(target_table, partition_table, lower, upper))]
+
+        return self.generate_partitions() + self.generate_materialize(gdw_transform) + [
+                ('SHADOW', shadow_sql),
+                ('INSERT', insert_sql),
+                ('ANALYZE', analyze_sql),
+                ('SWAP', swap_sql)] + self.generate_drop(gdw_transform)
+
+
+# load a long window as a series of day/week/month chunks. each chunk deletes
+# and inserts in one transaction and is recorded in the checkpoint table in
+# that same transaction, so a rerun only loads the chunks still missing. the
+# window is widened to whole chunks, so a rerun with another start or end
+# finds the chunks it shares with the first one
+class GDWBackfill():
+    def __init__(self, target_alias_name, config, start=None, end=None,
+                 chunk='day', parallel=1, instrument=None):
+        self.gdw_load = GDWLoad(target_alias_name, config, start, end, instrument=instrument)
+        self.config = config
+        self.instrument = instrument
+        self.target_name = self.gdw_load.target_alias.name
+        self.start, self.end = align_to_chunks(self.gdw_load.start, self.gdw_load.end, chunk)
+        self.chunk = chunk
+        self.parallel = parallel
+
+        if GDWDelete(self.target_name).deletes_everything:
+            raise RuntimeError(
+                    'Backfill of {} needs a date_range or partition delete, '
+                    'each chunk would delete the whole table'
+                    .format(self.target_name))
+        # the versions of a dimension are built in date order
+        if parallel > 1 and self.gdw_load.target_alias.get('load', {}).get('how') == 'dimension':
+            raise RuntimeError(
+                    'Backfill of {} can not load chunks in parallel, '
+                    'a dimension loads its chunks in date order'
+                    .format(self.target_name))
+        # the checkpoint is written in the transaction of its chunk
+        state_database = catalog.areas[STATE_AREA]['database']
+        if self.gdw_load.target_alias.area['database'] != state_database:
+            raise RuntimeError(
+                    'Backfill of {} needs the target in database {}, '
+                    'where the checkpoints are written with each chunk'
+                    .format(self.target_name, state_database))
+
+    def loaded_chunks(self):
+        rows = state_engine().execute(
+                select([checkpoints.c.chunk_start, checkpoints.c.chunk_end])
+                .where(checkpoints.c.target == self.target_name))
+        return set((row.chunk_start, row.chunk_end) for row in rows)
+
+    def load_chunk(self, chunk, statements, prepare):
+        chunk_start, chunk_end = chunk
+        _logger.info("Loading {} chunk {} - {}"
+                .format(self.target_name, chunk_start, chunk_end))
+        gdw_load = self.gdw_load
+        if statements is None:
+            gdw_load = GDWLoad(
+                    self.target_name, self.config, chunk_start, chunk_end,
+                    instrument=self.instrument)
+            gdw_load.local_tables = self.gdw_load.local_tables
+        # every thread enters the scope of the load
+        with gdw_load.table_scope(), gdw_load.engine.connect() as connection:
+            with connection.begin():
+                gdw_load.execute(
+                        connection, statements,
+                        start=chunk_start, end=chunk_end,
+                        prepare=prepare)
+                connection.execute(checkpoints.insert().values(
+                        target=self.target_name,
+                        chunk_start=chunk_start,
+                        chunk_end=chunk_end))
+
+    def run(self, dry_run=False, prepare=False):
+        create_state_tables()
+        chunks = list(range_chunks(self.start, self.end, self.chunk))
+        loaded = self.loaded_chunks()
+        missing = [chunk for chunk in chunks if chunk not in loaded]
+        _logger.info("Backfill of {}: {} chunks, {} already loaded"
+                .format(self.target_name, len(chunks), len(chunks) - len(missing)))
+
+        if dry_run:
+            for chunk_start, chunk_end in missing:
+                _logger.info("Dry run. Chunk {} - {} not loaded"
+                        .format(chunk_start, chunk_end))
+            return
+
+        # sources in other databases are copied once for the whole backfill
+        if missing:
+            self.gdw_load.federate(missing[0][0], missing[-1][1])
+
+        # unless the statements depend on the window, compile them only once
+        statements = None
+        if not self.gdw_load.window_dependent:
+            with self.gdw_load.table_scope():
+                statements = self.gdw_load.compiled_statements()
+        if self.parallel > 1:
+            pool = ThreadPool(self.parallel)
+            try:
+                pool.map(lambda chunk: self.load_chunk(chunk, statements, prepare), missing)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for chunk in missing:
+                self.load_chunk(chunk, statements, prepare)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,87 @@
+import logging
+import os
+import pickle
+from os import path
+import yaml
+
+_logger = logging.getLogger(__name__)
+
+METADATA_DIRECTORY = 'metadata'
+CACHE_DIRECTORY = '.mgo_cache'
+METADATA_BUNDLE_FILE = path.join(CACHE_DIRECTORY, 'metadata.bundle')
+# the libyaml loader when pyyaml was built with it, same documents
+YAML_LOADER = getattr(yaml, 'CLoader', yaml.Loader)
+BUNDLE_VERSION = 1
+
+
+def read_yaml(file_path):
+    with open(file_path) as f:
+        return yaml.load(f, Loader=YAML_LOADER)
+
+
+# every yaml file of the metadata directory (paths relative to it, with /)
+# and its mtime and size
+def metadata_files(directory):
+    files = {}
+    for dirpath, _, file_names in os.walk(directory):
+        for file_name in file_names:
+            if file_name.endswith('.yaml'):
+                file_path = path.join(dirpath, file_name)
+                stat = os.stat(file_path)
+                name = path.relpath(file_path, directory).replace(os.sep, '/')
+                files[name] = (stat.st_mtime, stat.st_size)
+    return files
+
+
+class GDWMetadataBundle(object):
+    """Every yaml file of the metadata directory parsed once and pickled into
+    a single file, see compile_metadata.py.
+
+    The bundle keeps the mtime and size of the files it was built from and is
+    only used while all of them match: editing, adding or removing a metadata
+    file makes the catalog read the yaml files again until the bundle is
+    compiled again. Checking costs one stat per file, no parsing."""
+    def __init__(self, documents, files):
+        self.documents = documents
+        self.files = files
+
+    @classmethod
+    def build(cls, directory):
+        files = metadata_files(directory)
+        documents = dict(
+                (name, read_yaml(path.join(directory, name)))
+                for name in files)
+        return cls(documents, files)
+
+    @classmethod
+    def load(cls, bundle_file, directory):
+        try:
+            with open(bundle_file, 'rb') as f:
+                version, documents, files = pickle.load(f)
+        except IOError:
+            return None
+        except Exception as e:
+            _logger.warning("Metadata bundle {} not readable: {}".format(bundle_file, e))
+            return None
+
+        if version != BUNDLE_VERSION:
+            return None
+        if metadata_files(directory) != files:
+            _logger.warning("Metadata bundle {} is out of date, reading the yaml files"
+                    .format(bundle_file))
+            return None
+        return cls(documents, files)
+
+    def save(self, bundle_file):
+        directory = path.dirname(bundle_file)
+        if directory and not path.isdir(directory):
+            os.makedirs(directory)
+        # written aside and renamed, so a job starting meanwhile never reads half of it
+        temp_file = '{}.{}'.format(bundle_file, os.getpid())
+        with open(temp_file, 'wb') as f:
+            pickle.dump((BUNDLE_VERSION, self.documents, self.files), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_file, bundle_file)
+
+    # names of the files with this suffix, without it
+    def names(self, suffix):
+        return sorted(name[:-len(suffix)] for name in self.files if name.endswith(suffix))
@@ -1,15 +1,30 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from os import path
-import yaml
-from fido.common.db import get_orm_engine
 import sqlalchemy
 from sqlalchemy import sql
 from sqlalchemy.schema import Table
 from sqlalchemy import text
+from mgoutils.reflection import GDWReflectionCache
+from mgoutils.sqlcache import GDWSQLCache
+from mgoutils.partitions import GDWPartitioning
+from mgoutils.engines import GDWEngineRegistry
+from mgoutils.bundle import GDWMetadataBundle, read_yaml, \
+        METADATA_DIRECTORY, CACHE_DIRECTORY, METADATA_BUNDLE_FILE
+from mgoutils.relationships import GDWRelationshipGraph
 
-METADATA_DIRECTORY = 'metadata'
+REFLECTION_CACHE_DIRECTORY = path.join(CACHE_DIRECTORY, 'reflection')
+SQL_CACHE_DIRECTORY = path.join(CACHE_DIRECTORY, 'sql')
 PSA_PATH = 'psa'
 STATE_START_COLUMN = 'gdw_state_start'
 STATE_END_COLUMN = 'gdw_state_end'
+VALID_FROM_COLUMN = 'gdw_valid_from'
+VALID_TO_COLUMN = 'gdw_valid_to'
+ROW_HASH_COLUMN = 'gdw_row_hash'
+# compiled plans kept by the catalog, the least recently used go first
+PLAN_CACHE_SIZE = 256
 
 class GDWTable(Table):
     @property
@@ -32,37 +47,46 @@ class GDWAlias(dict):
         self._where = None
 
         # load the yaml file into this object dictionary
-        if alias_yaml:
-            alias_yaml = alias_yaml
-        else:
-            file_path = path.join(
-                        METADATA_DIRECTORY,
-                        '{}.alias.yaml'.format(name))
-            try:
-                with open(file_path) as f:
-                    alias_yaml = yaml.load(f)
-            except IOError:
-                alias_yaml = {}
+        if not alias_yaml:
+            alias_yaml = catalog.read_metadata('{}.alias.yaml'.format(name)) or {}
 
         super(GDWAlias, self).__init__(alias_yaml)
 
-        # create a sqlalchemy Table into the sql_table property
+        # the sqlalchemy Table is only reflected the first time sql_table is used
         try:
-            area = catalog.areas[self['area']]
+            self.area = catalog.areas[self['area']]
         except KeyError:
-            area = None
-        if area:
-            table_name = self['table']
-            database = catalog.engines[area['database']]
-            self.sql_table = GDWTable(
-                    table_name,
-                    catalog.metadata,
-                    schema=area['schema'],
-                    autoload=True,
-                    autoload_with=database
-                    )
-        else:
-            self.sql_table = None
+            self.area = None
+        self._sql_table = None
+
+        # aliases without a table are built from their own transform
+        self.is_transform = self.area is None
+
+    def get_sql_table(self):
+        scoped_table = self.catalog.scoped_table(self.name)
+        if scoped_table is not None:
+            return scoped_table[0]
+        if self._sql_table is None and self.area:
+            self._sql_table = self.catalog.reflect_table(
+                    self.area['database'],
+                    self.area['schema'],
+                    self['table'])
+        return self._sql_table
+
+    def set_sql_table(self, sql_table):
+        self._sql_table = sql_table
+
+    sql_table = property(get_sql_table, set_sql_table)
+
+    @property
+    def fingerprint(self):
+        if not self.area:
+            return None
+        return self.catalog.reflection.fingerprint(
+                self.area['database'],
+                self.catalog.engines[self.area['database']],
+                self.area['schema'],
+                self['table'])
 
     @property
     def where(self):
@@ -82,6 +106,19 @@ class GDWAlias(dict):
     def modified_date_column(self):
         return self.get('date', {}).get('modified')
 
+    @property
+    def date_columns(self):
+        date_columns = self.get('date', {}).get('columns')
+        if isinstance(date_columns, str):
+            date_columns = [date_columns]
+        return date_columns
+
+    @property
+    def partitioning(self):
+        if 'partition' not in self:
+            return None
+        return GDWPartitioning(self)
+
     @property
     def state_date_columns(self):
         state_date_columns = self.get('date', {}).get('state')
@@ -90,6 +127,9 @@ class GDWAlias(dict):
         return state_date_columns
 
     def get_engine(self):
+        scoped_table = self.catalog.scoped_table(self.name)
+        if scoped_table is not None:
+            return scoped_table[1]
         if self._engine is None:
             try:
                 area = self.catalog.areas[self['area']]
@@ -110,25 +150,285 @@ class GDWAliasDict(dict):
 
     def __getitem__(self, alias_name):
         try:
-            alias = dict.__getitem__(self, alias_name)
+            return dict.__getitem__(self, alias_name)
         except KeyError:
-            alias = GDWAlias(alias_name, self.catalog)
-            dict.__setitem__(self, alias_name, alias)
+            pass
+        with self.catalog.lock:
+            try:
+                alias = dict.__getitem__(self, alias_name)
+            except KeyError:
+                alias = GDWAlias(alias_name, self.catalog)
+                dict.__setitem__(self, alias_name, alias)
         return alias
 
 
+# the compiled transform plans. every window is a new key, so a long running
+# service keeps only the most recently used
+class GDWPlanCache(OrderedDict):
+    def __init__(self, maxsize=PLAN_CACHE_SIZE):
+        super(GDWPlanCache, self).__init__()
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                plan = self.pop(key)
+            except KeyError:
+                return default
+            OrderedDict.__setitem__(self, key, plan)
+            return plan
+
+    def __setitem__(self, key, plan):
+        with self._lock:
+            self.pop(key, None)
+            OrderedDict.__setitem__(self, key, plan)
+            while len(self) > self.maxsize:
+                self.popitem(last=False)
+
+
 class GDWCatalog():
     def __init__(self, config=None):
-        with open('metadata/areas.yaml') as f:
-            self.areas = yaml.load(f)
+        # see compile_metadata.py. without an up to date bundle every
+        # metadata file is parsed when first needed
+        self.bundle = GDWMetadataBundle.load(METADATA_BUNDLE_FILE, METADATA_DIRECTORY)
+        self.areas = self.read_metadata('areas.yaml')
+        if self.areas is None:
+            raise IOError('No {} found'.format(path.join(METADATA_DIRECTORY, 'areas.yaml')))
+        # pool settings per database, optional
+        self.databases = self.read_metadata('databases.yaml') or {}
+        # several loads can share the catalog from different threads
+        self.lock = threading.RLock()
         self.aliases = GDWAliasDict(self)
         self.metadata = sqlalchemy.MetaData()
+        # compiled transform plans by (target, start, end, scope)
+        self.plans = GDWPlanCache()
+        # the table scope of the load running in each thread
+        self._scope = threading.local()
+        self.reflection = GDWReflectionCache(REFLECTION_CACHE_DIRECTORY)
+        self.sql_cache = GDWSQLCache(SQL_CACHE_DIRECTORY)
+        self._relationships = None
+
+    # built the first time a transform joins anything
+    @property
+    def relationships(self):
+        if self._relationships is None:
+            with self.lock:
+                if self._relationships is None:
+                    self._relationships = GDWRelationshipGraph(self)
+        return self._relationships
+
+    # within the scope of a load, the aliases of tables ({alias name: table},
+    # copies made by the load in the database of engine) read from those
+    # tables, in this thread only. plans compiled in a scope are only used
+    # in the same scope
+    @contextmanager
+    def table_scope(self, scope, tables=None, engine=None):
+        previous = getattr(self._scope, 'current', None)
+        self._scope.current = (scope, dict(
+                (alias_name, (table, engine))
+                for alias_name, table in (tables or {}).items()))
+        try:
+            yield
+        finally:
+            self._scope.current = previous
+
+    @property
+    def scope(self):
+        current = getattr(self._scope, 'current', None)
+        return current[0] if current else None
+
+    # (table, engine) of an alias in the current scope, None if not scoped
+    def scoped_table(self, alias_name):
+        current = getattr(self._scope, 'current', None)
+        return current[1].get(alias_name) if current else None
+
+    # point an alias to another table (or select), for the current scope or
+    # for the whole process outside of any
+    def set_scoped_table(self, alias_name, table, engine):
+        current = getattr(self._scope, 'current', None)
+        if current:
+            current[1][alias_name] = (table, engine)
+        else:
+            alias = self.aliases[alias_name]
+            alias.sql_table = table
+            alias.engine = engine
 
     def configure(self, config):
         self.config = config
-        self.engines = {
-                'bloodmoondb': get_orm_engine(database='eravana_db', config=self.config)
-                }
+        self.engines = GDWEngineRegistry(config, self.databases)
+
+    # the parsed content of a metadata file (path relative to the metadata
+    # directory, with /), from the bundle when there is one. None when the
+    # file does not exist
+    def read_metadata(self, file_name):
+        if self.bundle is not None:
+            try:
+                return self.bundle.documents[file_name]
+            except KeyError:
+                return None
+        try:
+            return read_yaml(path.join(METADATA_DIRECTORY, file_name))
+        except IOError:
+            return None
+
+    # forget what was read from the changed metadata files (paths relative
+    # to the metadata directory). plans and the transforms without a table
+    # depend on other aliases, so they are always built again. reflected
+    # tables and engines are kept unless their own settings changed
+    def reload(self, file_names):
+        suffixes = ('.alias.yaml', '.transform.yaml')
+        with self.lock:
+            # the bundle no longer matches the files
+            self.bundle = None
+            if 'areas.yaml' in file_names:
+                self.areas = self.read_metadata('areas.yaml')
+                self.aliases = GDWAliasDict(self)
+            if 'databases.yaml' in file_names:
+                self.databases = self.read_metadata('databases.yaml') or {}
+                self.engines.dispose()
+                self.configure(self.config)
+                self.aliases = GDWAliasDict(self)
+
+            changed = set()
+            for file_name in file_names:
+                for suffix in suffixes:
+                    if file_name.endswith(suffix):
+                        changed.add(file_name[:-len(suffix)].replace(os.sep, '/'))
+            for alias_name, alias in list(self.aliases.items()):
+                if alias_name in changed or alias.is_transform:
+                    del self.aliases[alias_name]
+            self.plans = GDWPlanCache()
+            self._relationships = None
+
+    # reflect again the tables that changed in the database since they were
+    # reflected. the fingerprints are read again, one query per schema, and
+    # the aliases of the changed or dropped tables are forgotten along with
+    # the transforms and plans built on them
+    def refresh(self):
+        with self.lock:
+            fingerprints = self.reflection.refresh()
+            stale = []
+            for alias_name, alias in list(self.aliases.items()):
+                if alias._sql_table is None:
+                    continue
+                key = (alias.area['database'], alias.area['schema'])
+                try:
+                    fingerprint = alias.fingerprint
+                except KeyError:
+                    fingerprint = None
+                if fingerprint != fingerprints.get(key, {}).get(alias['table']):
+                    stale.append(alias_name)
+            if not stale:
+                return stale
+
+            for alias_name in stale:
+                table = self.aliases[alias_name]._sql_table
+                self.metadata.remove(table)
+                del self.aliases[alias_name]
+            for alias_name, alias in list(self.aliases.items()):
+                if alias.is_transform:
+                    del self.aliases[alias_name]
+            self.plans = GDWPlanCache()
+            self._relationships = None
+            return stale
+
+    def reflect_table(self, database, schema, table_name):
+        key = '{}.{}'.format(schema, table_name)
+        with self.lock:
+            if key in self.metadata.tables:
+                return self.metadata.tables[key]
+            engine = self.engines[database]
+            columns = self.reflection.columns(database, engine, schema, table_name)
+            table = GDWTable(table_name, self.metadata, *columns, schema=schema)
+            self.reflection.add_constraints(database, engine, schema, table)
+            return table
+
+    # names of every alias with a metadata file of this kind (alias or transform)
+    def alias_names(self, kind='alias'):
+        suffix = '.{}.yaml'.format(kind)
+        if self.bundle is not None:
+            return self.bundle.names(suffix)
+        alias_names = []
+        for directory, _, file_names in os.walk(METADATA_DIRECTORY):
+            for file_name in file_names:
+                if file_name.endswith(suffix):
+                    file_path = path.join(directory, file_name[:-len(suffix)])
+                    alias_names.append(
+                            path.relpath(file_path, METADATA_DIRECTORY)
+                            .replace(os.sep, '/'))
+        return sorted(alias_names)
+
+    def alias_file(self, alias_name):
+        return path.join(METADATA_DIRECTORY, '{}.alias.yaml'.format(alias_name))
+
+    def transform_file(self, alias_name):
+        return path.join(METADATA_DIRECTORY, '{}.transform.yaml'.format(alias_name))
+
+    # the from of the transform of alias_name, every part as a dict with
+    # the list of its aliases, as read from the transform file
+    def from_definitions(self, alias_name):
+        transforms = self.read_metadata('{}.transform.yaml'.format(alias_name))
+        if transforms is None:
+            return []
+
+        froms = transforms.get('from', [])
+        if not isinstance(froms, list):
+            froms = [froms]
+
+        from_definitions = []
+        for single_from in froms:
+            if isinstance(single_from, str):
+                single_from = {'alias': [single_from]}
+            elif isinstance(single_from, list):
+                single_from = {'alias': single_from}
+            elif isinstance(single_from['alias'], str):
+                single_from = dict(single_from, alias=[single_from['alias']])
+            from_definitions.append(single_from)
+        return from_definitions
+
+    # alias names read by the transform of alias_name, in the order of its
+    # from, then the bridge aliases its joins go through
+    def from_alias_names(self, alias_name):
+        from_definitions = self.from_definitions(alias_name)
+        alias_names = [alias for single_from in from_definitions
+                       for alias in single_from['alias']]
+        if len(from_definitions) > 1:
+            try:
+                joins = self.relationships.joins(
+                        [single_from.get('as') or single_from['alias'][0]
+                         for single_from in from_definitions])
+            except RuntimeError:
+                # the transform itself reports the missing relationship
+                joins = []
+            alias_names += [name for name, _, bridge in joins
+                            if bridge and name not in alias_names]
+        return alias_names
+
+    # alias names read by the transform of alias_name, looking inside the
+    # transforms without a table as those are inlined in its statement
+    def read_alias_names(self, alias_name):
+        for from_alias in self.from_alias_names(alias_name):
+            yield from_alias
+            if self.aliases[from_alias].is_transform:
+                for nested_alias in self.read_alias_names(from_alias):
+                    yield nested_alias
+
+    # every alias a load of alias_name depends on: itself, its staging alias
+    # and recursively everything its transform reads from
+    def alias_closure(self, alias_name, seen=None):
+        if seen is None:
+            seen = []
+        if alias_name in seen:
+            return seen
+        seen.append(alias_name)
+
+        staging_alias = self.aliases[alias_name].get('load', {}).get('staging_alias')
+        if staging_alias:
+            self.alias_closure(staging_alias, seen)
+        for from_alias in self.from_alias_names(alias_name):
+            self.alias_closure(from_alias, seen)
+        return seen
 
     def engine_from_alias(self, alias_list):
         engines = set()
@@ -0,0 +1,113 @@
+import os
+import threading
+import time
+
+
+class CopyReader(object):
+    """File-like object to feed COPY ... FROM STDIN from a line stream.
+
+    Lines are handed over as they are read so nothing is kept in memory.
+    Every row is checked to have as many fields as the target table columns
+    and rows and bytes are counted to report the throughput."""
+    def __init__(self, stream, column_count, source_name, header=False):
+        self.stream = stream
+        self.column_count = column_count
+        self.source_name = source_name
+        self.rows = 0
+        self.bytes = 0
+        self.started = time.time()
+        if header:
+            self.stream.readline()
+
+    def readline(self, size=-1):
+        line = self.stream.readline()
+        if not line:
+            return line
+        # end-of-data marker of the text format
+        if line.rstrip(b'\r\n') == b'\\.':
+            return line
+
+        field_count = line.count(b'\t') + 1
+        if field_count != self.column_count:
+            raise ValueError(
+                    '{} line {}: {} fields found, table has {} columns'
+                    .format(self.source_name, self.rows + 1,
+                            field_count, self.column_count))
+        self.rows += 1
+        self.bytes += len(line)
+        return line
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = 8192
+        lines = []
+        length = 0
+        while length < size:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+            length += len(line)
+        return b''.join(lines)
+
+    @property
+    def elapsed(self):
+        return max(time.time() - self.started, 1e-6)
+
+    def report(self):
+        return '{}: {} rows in {:.1f}s ({:.0f} rows/s, {:.2f} MB/s)'.format(
+                self.source_name, self.rows, self.elapsed,
+                self.rows / self.elapsed,
+                self.bytes / self.elapsed / 1024 / 1024)
+
+
+def copy_from_stream(raw_connection, table, columns, reader):
+    cursor = raw_connection.cursor()
+    try:
+        cursor.copy_expert(
+                'COPY {} ({}) FROM STDIN'.format(table, ', '.join(columns)),
+                reader)
+    finally:
+        cursor.close()
+
+
+def copy_to_stream(raw_connection, query, stream):
+    cursor = raw_connection.cursor()
+    try:
+        cursor.copy_expert('COPY ({}) TO STDOUT'.format(query), stream)
+    finally:
+        cursor.close()
+
+
+# stream the rows of a query in one database into a table of another. the
+# extraction runs in its own thread writing into a pipe the load reads from,
+# so both run at the same time and only the pipe buffer is held in memory
+def copy_between(source_connection, query, target_connection, table, columns, source_name):
+    read_fd, write_fd = os.pipe()
+    read_stream = os.fdopen(read_fd, 'rb')
+    write_stream = os.fdopen(write_fd, 'wb')
+    errors = []
+
+    def extract():
+        try:
+            copy_to_stream(source_connection, query, write_stream)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            try:
+                write_stream.close()
+            except (IOError, OSError):
+                pass
+
+    extraction = threading.Thread(target=extract)
+    extraction.start()
+    reader = CopyReader(read_stream, len(columns), source_name)
+    try:
+        copy_from_stream(target_connection, table, columns, reader)
+    finally:
+        # if the load failed the extraction stops on the closed pipe
+        read_stream.close()
+        extraction.join()
+    if errors:
+        raise errors[0]
+    return reader
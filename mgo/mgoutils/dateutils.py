@@ -1,10 +1,17 @@
 import datetime
+import re
 from de_common.datetimeutil import days_ago, parse_date_string, date_range
-from sqlalchemy.sql import or_
+from sqlalchemy.sql import or_, bindparam, cast
+from sqlalchemy.types import Date
 import collections
 
-DEFAULT_START = days_ago(1)
-DEFAULT_END = parse_date_string(days_ago(1)) + datetime.timedelta(days=1, microseconds=-1)
+# yesterday, computed on every call: the service runs for days
+def default_start():
+    return days_ago(1)
+
+
+def default_end():
+    return parse_date_string(days_ago(1)) + datetime.timedelta(days=1, microseconds=-1)
 
 
 def parse_date(dt):
@@ -16,29 +23,103 @@ def parse_date(dt):
 
 def range_days(start, end):
     for n in range((end - start).days + 1):
-        yield start + timedelta(n)
+        yield start + datetime.timedelta(n)
+
+
+CHUNK_KEYS = {
+        'day': lambda d: d.date(),
+        'week': lambda d: d.isocalendar()[:2],
+        'month': lambda d: (d.year, d.month),
+        }
+
+
+# split [start, end] into consecutive day/week/month windows. the first and
+# last windows are cut to start and end
+def range_chunks(start, end, unit='day'):
+    chunk_key = CHUNK_KEYS[unit]
+    days = list(range_days(start, end))
+    if days and days[-1].date() < end.date():
+        days.append(end)
+
+    chunk_days = []
+    for day in days:
+        if chunk_days and chunk_key(day) != chunk_key(chunk_days[0]):
+            yield _chunk_window(chunk_days, start, end)
+            chunk_days = []
+        chunk_days.append(day)
+    if chunk_days:
+        yield _chunk_window(chunk_days, start, end)
+
+
+# [start, end] widened to whole day/week/month windows, so the chunks of
+# range_chunks are the same whatever start and end are inside them
+def align_to_chunks(start, end, unit='day'):
+    chunk_key = CHUNK_KEYS[unit]
+    one_day = datetime.timedelta(days=1)
+    first_day = datetime.datetime.combine(start.date(), datetime.time())
+    while chunk_key(first_day - one_day) == chunk_key(first_day):
+        first_day -= one_day
+    last_day = datetime.datetime.combine(end.date(), datetime.time())
+    while chunk_key(last_day + one_day) == chunk_key(last_day):
+        last_day += one_day
+    return first_day, last_day + datetime.timedelta(days=1, microseconds=-1)
+
 
+def _chunk_window(chunk_days, start, end):
+    chunk_start = datetime.datetime.combine(chunk_days[0].date(), datetime.time())
+    chunk_end = (datetime.datetime.combine(chunk_days[-1].date(), datetime.time())
+                 + datetime.timedelta(days=1, microseconds=-1))
+    return max(chunk_start, start), min(chunk_end, end)
 
-def filter_date_range(table_columns, start_date=None, end_date=None):
+
+# the date window is always bound with these names so the compiled statement
+# text does not depend on the dates and can be cached and prepared
+START_PARAM = 'gdw_start'
+END_PARAM = 'gdw_end'
+# the start of each source is bound with a name of its own, so watermark
+# loads can read every source from its own watermark. sources without a
+# start of their own read from the window start
+SOURCE_START_PREFIX = 'gdw_start__'
+
+
+def source_start_param(alias_name):
+    return SOURCE_START_PREFIX + re.sub(r'\W', '_', alias_name)
+
+
+def window_params(start, end, source_starts=None):
+    params = {START_PARAM: start, END_PARAM: end}
+    for alias_name, source_start in (source_starts or {}).items():
+        params[source_start_param(alias_name)] = source_start
+    return params
+
+
+# the window is inclusive on both ends. date columns are compared by day,
+# the start and end days included, as before the window was bound. timestamp
+# columns are compared to the full start and end timestamps: comparing them
+# to the days only kept the rows at midnight of the end day
+def filter_date_range(table_columns, start_date=None, end_date=None, source=None):
     if not isinstance(table_columns, collections.Iterable):
         table_columns = [table_columns]
 
+    # the values here are only used to render --dry-run output. the real
+    # window is passed as parameters when the statement is executed
+    start_param = source_start_param(source) if source else START_PARAM
+    start = bindparam(start_param, str(start_date)) if start_date else None
+    end = bindparam(END_PARAM, str(end_date)) if end_date else None
+
     filters = []
     for c in table_columns:
-        # TODO: depending on type of column format the start and end differently
-        if 'DATE' in str(c.type) or 1==1:
-            start = start_date.strftime('%Y-%m-%d')
-            end = end_date.strftime('%Y-%m-%d')
-
-        if start and end:
-            if start == end:
-                filters.append(c == start)
-            else:
-                filters.append(c.between(start, end))
-        elif start:
-            filters.append(c >= start)
-        elif end:
-            filters.append(c <= end)
+        column_start, column_end = start, end
+        if isinstance(c.type, Date):
+            column_start = cast(start, Date) if start is not None else None
+            column_end = cast(end, Date) if end is not None else None
+
+        if column_start is not None and column_end is not None:
+            filters.append(c.between(column_start, column_end))
+        elif column_start is not None:
+            filters.append(c >= column_start)
+        elif column_end is not None:
+            filters.append(c <= column_end)
         else:
             filters.append(None)
 
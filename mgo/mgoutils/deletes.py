@@ -0,0 +1,28 @@
+from mgoutils.dateutils import filter_date_range
+
+# loads that find the existing rows by key, so nothing is deleted beforehand
+KEYED_LOADS = ('dimension', 'upsert')
+
+
+# true when the load of alias removes the rows it replaces itself:
+# dimensions, upserts and loads comparing row hashes
+def deleted_by_load(alias):
+    load_definition = alias.get('load', {})
+    return (load_definition.get('how') in KEYED_LOADS
+            or bool(load_definition.get('hash_columns')))
+
+
+# the rows of the target alias the delete would remove, as a where clause
+# on the given table (None for all of them). loads comparing row hashes only
+# replace or delete the rows of this scope
+def delete_scope(alias, table, start, end):
+    delete_definition = alias.get('delete', {})
+    what = delete_definition.get('what', 'all')
+    if what == 'all':
+        return None
+    elif what == 'date_range':
+        return filter_date_range(
+                [table.c[col] for col in alias.date_columns],
+                start, end)
+    raise RuntimeError('{} can only compare row hashes with delete what all or date_range'
+            .format(alias.name))
@@ -0,0 +1,81 @@
+import threading
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+from fido.common.db import get_orm_engine
+
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_POOL_RECYCLE = 3600
+
+
+class GDWEngineRegistry(object):
+    """One pooled engine per database of areas.yaml, created the first time
+    the database is used and shared by every statement and target of the run.
+
+    databases.yaml can set for each database:
+        bloodmoondb:
+            config_database: eravana_db   # name in the config, defaults to the key
+            pool_size: 10
+            max_overflow: 5
+            pool_recycle: 3600            # seconds
+            statement_timeout: 3600000    # milliseconds, none by default"""
+    def __init__(self, config, databases=None):
+        self.config = config
+        self.databases = databases or {}
+        self._engines = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, database):
+        try:
+            return self._engines[database]
+        except KeyError:
+            pass
+        with self._lock:
+            if database not in self._engines:
+                self._engines[database] = self.create_engine(database)
+        return self._engines[database]
+
+    def __contains__(self, database):
+        return database in self._engines
+
+    def settings(self, database):
+        return self.databases.get(database) or {}
+
+    def create_engine(self, database):
+        settings = self.settings(database)
+        # the engine of the config keeps its connect arguments, ssl and
+        # dialect options. only its pool is replaced by one sized here, with
+        # the same connection creator, listeners and dialect
+        engine = get_orm_engine(
+                database=settings.get('config_database', database),
+                config=self.config)
+        pool = engine.pool
+        engine.pool = QueuePool(
+                pool._creator,
+                pool_size=settings.get('pool_size', DEFAULT_POOL_SIZE),
+                max_overflow=settings.get('max_overflow', DEFAULT_MAX_OVERFLOW),
+                recycle=settings.get('pool_recycle', DEFAULT_POOL_RECYCLE),
+                timeout=getattr(pool, '_timeout', 30),
+                echo=pool.echo,
+                logging_name=pool._orig_logging_name,
+                use_threadlocal=pool._use_threadlocal,
+                reset_on_return=pool._reset_on_return,
+                _dispatch=pool.dispatch,
+                _dialect=pool._dialect)
+        pool.dispose()
+
+        statement_timeout = settings.get('statement_timeout')
+        if statement_timeout is not None:
+            @event.listens_for(engine, 'connect')
+            def set_statement_timeout(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                cursor.execute('SET statement_timeout = {:d}'.format(int(statement_timeout)))
+                cursor.close()
+                dbapi_connection.commit()
+        return engine
+
+    def dispose(self):
+        with self._lock:
+            for engine in self._engines.values():
+                engine.dispose()
+            self._engines = {}
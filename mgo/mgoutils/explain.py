@@ -0,0 +1,174 @@
+import json
+import logging
+from sqlalchemy import text
+from mgoutils.catalog import catalog
+from mgoutils.merges import join_columns
+
+_logger = logging.getLogger(__name__)
+
+# tables with fewer estimated rows are cheap to scan whatever the filter
+LARGE_TABLE_ROWS = 100000
+
+TABLE_STATS_SQL = text("""
+    SELECT c.reltuples,
+           array_remove(array_agg(a.attname::text), NULL) AS leading_columns
+    FROM pg_class c
+    LEFT JOIN pg_index i ON i.indrelid = c.oid
+    LEFT JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = i.indkey[0]
+    WHERE c.oid = to_regclass(:table_name)
+    GROUP BY c.reltuples
+    """)
+
+
+def plan_nodes(node, parents=()):
+    yield node, parents
+    for child in node.get('Plans', []):
+        for found in plan_nodes(child, parents + (node,)):
+            yield found
+
+
+# qualified names of the relations scanned under node, in plan order
+def relation_names(node):
+    names = []
+    for child, _ in plan_nodes(node):
+        if 'Relation Name' not in child:
+            continue
+        name = '{}.{}'.format(child['Schema'], child['Relation Name']) \
+                if 'Schema' in child else child['Relation Name']
+        if name not in names:
+            names.append(name)
+    return names
+
+
+def estimated_rows(plan):
+    # modify nodes estimate 0 rows, take the rows they get from their input
+    node = plan['Plan']
+    if node.get('Node Type') == 'ModifyTable' and node.get('Plans'):
+        node = node['Plans'][0]
+    return int(node.get('Plan Rows', 0))
+
+
+# the unions of merge_tables are flattened into an Append, or kept in a
+# Subquery Scan. on the inner side of a nested loop they are scanned
+# again for every outer row unless a Hash or Materialize keeps them
+def nested_loop_warnings(plan):
+    for node, _ in plan_nodes(plan['Plan']):
+        if node.get('Node Type') != 'Nested Loop':
+            continue
+        for child in node.get('Plans', []):
+            if child.get('Parent Relationship') != 'Inner':
+                continue
+            if child.get('Node Type') not in ('Append', 'Subquery Scan'):
+                continue
+            yield ('nested loop over the union of {}'
+                    .format(', '.join(relation_names(child))))
+
+
+class GDWExplain(object):
+    """Plain EXPLAIN of the statements of a target, to review their plans
+    without running them.
+
+    The statements are explained VERBOSE, which gives the schema of every
+    scanned relation to match the sources on, in a read only transaction that
+    is rolled back, every one in its own savepoint so a statement on a table
+    that does not exist yet (staging or shadow tables) does not stop the
+    others. Each plan is summarized with its estimated rows and cost and
+    checked for:
+    - sequential scans of large source tables filtered on their modified date
+    - nested loops over the unions built by merge_tables
+    - relationship joins on columns that lead no index"""
+    def __init__(self, target_alias_name):
+        self.target_alias = catalog.aliases[target_alias_name]
+        self.sources = {}
+        for alias_name in catalog.alias_closure(target_alias_name):
+            alias = catalog.aliases[alias_name]
+            if alias.area:
+                self.sources[(alias.area['schema'], alias['table'])] = alias
+        self._table_stats = {}
+
+    def table_stats(self, connection, alias):
+        key = (alias.area['schema'], alias['table'])
+        if key not in self._table_stats:
+            row = connection.execute(
+                    TABLE_STATS_SQL,
+                    table_name='{}.{}'.format(*key)).first()
+            self._table_stats[key] = (row[0], set(row[1])) if row else (0, set())
+        return self._table_stats[key]
+
+    def explain(self, connection, statement, window):
+        params = statement.bind(window)
+        plan = connection.execute(
+                'EXPLAIN (VERBOSE, FORMAT JSON) ' + statement.sql, params).scalar()
+        if not isinstance(plan, list):
+            plan = json.loads(plan)
+        return plan[0]
+
+    def seq_scan_warnings(self, connection, plan):
+        for node, _ in plan_nodes(plan['Plan']):
+            if node.get('Node Type') != 'Seq Scan':
+                continue
+            alias = self.sources.get((node.get('Schema'), node.get('Relation Name')))
+            if alias is None or not alias.modified_date_column:
+                continue
+            if alias.modified_date_column not in node.get('Filter', ''):
+                continue
+            rows = self.table_stats(connection, alias)[0]
+            if rows >= LARGE_TABLE_ROWS:
+                yield ('sequential scan of {} ({:.0f} rows) filtered on {}'
+                        .format(alias.name, rows, alias.modified_date_column))
+
+    # the columns of the joined side of every relationship should lead an index
+    def join_index_warnings(self, connection, froms, joins):
+        for from_definition, join in zip(froms[1:], joins):
+            rename_to = from_definition.as_alias.split('/')[-1]
+            columns = join_columns(join['join_on'], rename_to)
+            for alias_name in from_definition.alias:
+                alias = catalog.aliases[alias_name]
+                if not alias.area:
+                    continue
+                indexed = self.table_stats(connection, alias)[1]
+                for column in columns:
+                    if column not in indexed:
+                        yield ('no index on {}.{} for the join with {}'
+                                .format(alias.name, column, rename_to))
+
+    def run(self, connection, statements, window, froms=(), joins=()):
+        reports = []
+        transaction = connection.begin()
+        try:
+            connection.execute('SET TRANSACTION READ ONLY')
+            for statement in statements:
+                report = {'phase': statement.description, 'warnings': []}
+                reports.append(report)
+                if not statement.preparable:
+                    report['error'] = 'not explainable'
+                    continue
+                savepoint = connection.begin_nested()
+                try:
+                    plan = self.explain(connection, statement, window)
+                except Exception as e:
+                    savepoint.rollback()
+                    report['error'] = str(e).split('\n')[0]
+                    continue
+                savepoint.commit()
+                report['rows'] = estimated_rows(plan)
+                report['cost'] = plan['Plan'].get('Total Cost')
+                report['warnings'] += self.seq_scan_warnings(connection, plan)
+                report['warnings'] += nested_loop_warnings(plan)
+
+            if joins:
+                reports.append({
+                        'phase': 'JOINS',
+                        'warnings': list(self.join_index_warnings(connection, froms, joins))})
+        finally:
+            transaction.rollback()
+
+        for report in reports:
+            if 'error' in report:
+                _logger.info("{} not explained: {}".format(report['phase'], report['error']))
+            elif 'rows' in report:
+                _logger.info("{}: {} estimated rows, cost {}"
+                        .format(report['phase'], report['rows'], report['cost']))
+            for warning in report['warnings']:
+                _logger.warning("{}: {}".format(report['phase'], warning))
+        return reports
@@ -0,0 +1,132 @@
+import logging
+from sqlalchemy import Column, text
+from sqlalchemy.sql import select
+from mgoutils.catalog import GDWTable, catalog
+from mgoutils.copyutils import copy_between
+from mgoutils.dateutils import filter_date_range
+from mgoutils.sqlutils import compile_sql, table_identifier
+
+_logger = logging.getLogger(__name__)
+
+# local copies of the sources of a database live in schema mgo_fed_<database>,
+# one table per target and source
+FEDERATION_SCHEMA = 'mgo_fed_{}'
+
+
+class GDWFederation(object):
+    """Copies the sources of a target that live in another database into
+    unlogged tables of the target database, so its transform runs locally.
+
+    The sources the transform filters on date.modified (see
+    windowed_alias_names) are copied with only the rows of the window, the
+    joined ones whole, streaming COPY TO STDOUT of the source into COPY FROM
+    STDIN of the copy. Every
+    target has its own copies, so targets loaded in parallel never truncate
+    a copy another one reads. run returns them by alias name, the load reads
+    them through catalog.table_scope."""
+    def __init__(self, target_alias_name, start, end):
+        self.target_alias = catalog.aliases[target_alias_name]
+        self.database = self.target_alias.area['database']
+        self.start = start
+        self.end = end
+
+    @property
+    def engine(self):
+        return catalog.engines[self.database]
+
+    def remote_aliases(self):
+        remote_aliases = []
+        for alias_name in catalog.read_alias_names(self.target_alias.name):
+            alias = catalog.aliases[alias_name]
+            if alias.is_transform or alias_name in remote_aliases:
+                continue
+            if alias.area['database'] != self.database:
+                remote_aliases.append(alias_name)
+        return remote_aliases
+
+    # the sources the window filters, as GDWTransform.window_filters places
+    # it: the driving from of the target and of every transform without a
+    # table it reads. the others are joined and need all their rows
+    def windowed_alias_names(self):
+        transform_names = [self.target_alias.name] + [
+                alias_name for alias_name in catalog.read_alias_names(self.target_alias.name)
+                if catalog.aliases[alias_name].is_transform]
+        alias_names = set()
+        for transform_name in transform_names:
+            from_definitions = catalog.from_definitions(transform_name)
+            if from_definitions:
+                alias_names.update(from_definitions[0]['alias'])
+        return alias_names
+
+    def local_table_name(self, alias):
+        return table_identifier('{}__{}'.format(
+                self.target_alias.name.replace('/', '__'), alias.basename))
+
+    def local_table(self, alias, remote_table):
+        schema = FEDERATION_SCHEMA.format(alias.area['database'])
+        name = self.local_table_name(alias)
+        key = '{}.{}'.format(schema, name)
+        with catalog.lock:
+            if key in catalog.metadata.tables:
+                return catalog.metadata.tables[key]
+            # the same columns and types, none of the constraints
+            return GDWTable(
+                    name, catalog.metadata,
+                    *[Column(c.name, c.type) for c in remote_table.c],
+                    schema=schema,
+                    prefixes=['UNLOGGED'])
+
+    def window_query(self, alias, remote_table, windowed):
+        query = select([remote_table])
+        if not windowed:
+            _logger.info("{} is joined, copying all its rows".format(alias.name))
+        elif alias.modified_date_column:
+            query = query.where(filter_date_range(
+                    remote_table.c[alias.modified_date_column],
+                    self.start, self.end))
+        else:
+            _logger.warning("{} has no date.modified, copying all its rows"
+                    .format(alias.name))
+        return compile_sql(query, alias.engine)
+
+    def copy(self, alias, remote_table, local_table, windowed):
+        self.engine.execute(text('CREATE SCHEMA IF NOT EXISTS {}'.format(local_table.schema))
+                            .execution_options(autocommit=True))
+        local_table.create(self.engine, checkfirst=True)
+
+        source_connection = alias.engine.raw_connection()
+        target_connection = self.engine.raw_connection()
+        try:
+            cursor = target_connection.cursor()
+            cursor.execute('TRUNCATE TABLE {}'.format(local_table))
+            cursor.close()
+            reader = copy_between(
+                    source_connection, self.window_query(alias, remote_table, windowed),
+                    target_connection, local_table, local_table.column_names,
+                    alias.name)
+            target_connection.commit()
+        except Exception:
+            target_connection.rollback()
+            raise
+        finally:
+            source_connection.close()
+            target_connection.close()
+        _logger.info(reader.report())
+
+    # copies every remote source, outside of any table scope. returns the
+    # copies by alias name
+    def run(self, dry_run=False):
+        local_tables = {}
+        windowed_alias_names = self.windowed_alias_names()
+        for alias_name in self.remote_aliases():
+            alias = catalog.aliases[alias_name]
+            remote_table = alias.sql_table
+            local_table = self.local_table(alias, remote_table)
+            if dry_run:
+                _logger.info("Dry run. {} not copied into {}".format(alias_name, local_table))
+            else:
+                _logger.info("Copying {} into {}".format(alias_name, local_table))
+                self.copy(alias, remote_table, local_table,
+                          alias_name in windowed_alias_names)
+            local_tables[alias_name] = local_table
+        return local_tables
@@ -0,0 +1,77 @@
+import datetime
+import json
+import logging
+import threading
+import time
+from mgoutils.dateutils import START_PARAM, END_PARAM
+from mgoutils.state import run_history, state_engine
+
+_logger = logging.getLogger(__name__)
+
+
+def plan_rows(plan):
+    # rows of the top node. modify nodes report 0 rows unless they return
+    # something, so take the rows they got from their input
+    node = plan['Plan']
+    if node.get('Node Type') == 'ModifyTable' and node.get('Plans'):
+        node = node['Plans'][0]
+    return int(node.get('Actual Rows', 0) * node.get('Actual Loops', 1))
+
+
+class GDWInstrument(object):
+    """Runs the statements of a target and records how each one went.
+
+    Every statement gives one json record with the target, phase, date chunk,
+    wall time and row count, written to the log, optionally appended to a
+    json lines file and inserted into the run history table. With explain
+    the statements run through EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON), which
+    also executes them, and the plan is kept in the record."""
+    def __init__(self, target, explain=False, metrics_file=None, history=False):
+        self.target = target
+        self.explain = explain
+        self.metrics_file = metrics_file
+        self.history = history
+        self._lock = threading.Lock()
+
+    def execute(self, statement, connection, window, prepare=False):
+        started_at = datetime.datetime.now()
+        started = time.time()
+        plan = None
+        if self.explain and statement.preparable:
+            params = statement.bind(window)
+            result = (connection
+                    .execution_options(autocommit=True)
+                    .execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + statement.sql, params))
+            plan = result.scalar()
+            if not isinstance(plan, list):
+                plan = json.loads(plan)
+            plan = plan[0]
+            rowcount = plan_rows(plan)
+        else:
+            result = statement.execute(connection, window, prepare)
+            rowcount = result.rowcount
+
+        self.record({
+                'target': self.target,
+                'phase': statement.description,
+                'statement': statement.prepared_name,
+                'chunk_start': str(window[START_PARAM]),
+                'chunk_end': str(window[END_PARAM]),
+                'started_at': str(started_at),
+                'seconds': round(time.time() - started, 6),
+                'rowcount': rowcount,
+                'plan': plan,
+                })
+        return result
+
+    def record(self, record):
+        line = json.dumps(record, sort_keys=True)
+        _logger.info(line)
+        if self.metrics_file:
+            with self._lock:
+                with open(self.metrics_file, 'a') as f:
+                    f.write(line + '\n')
+        if self.history:
+            values = dict(record)
+            values['plan'] = json.dumps(record['plan']) if record['plan'] else None
+            state_engine().execute(run_history.insert().values(**values))
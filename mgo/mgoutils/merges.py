@@ -1,17 +1,26 @@
 import sqlalchemy
-from sqlalchemy.sql import select, literal_column, and_
+from sqlalchemy.sql import select, literal_column, and_, or_, tuple_
 from sqlalchemy.sql.expression import union, union_all, alias
-from sqlalchemy import text
+from sqlalchemy import text, cast, Date, DateTime
 from mgoutils.catalog import catalog, STATE_START_COLUMN, STATE_END_COLUMN
 from mgoutils.dateutils import filter_date_range
-from sqlalchemy.sql.functions import coalesce, func
+from mgoutils.relationships import JOIN_COLUMN, join_columns
+from sqlalchemy.sql.functions import func
 
 
-# return a merge of several tables (union/union all)
+# return a merge of several tables (union/union all). with push_window every
+# branch of a source with date.modified only reads the rows of the window
 def merge_tables(aliases, merge_type, as_alias, *args, **kwargs):
     sql_tables = []
     for alias in aliases:
-        sql_tables.append(select([alias.sql_table]).where(alias.where))
+        branch = select([alias.sql_table])
+        if alias.where is not None:
+            branch = branch.where(alias.where)
+        if kwargs.get('push_window') and alias.modified_date_column:
+            branch = branch.where(filter_date_range(
+                    alias.sql_table.c[alias.modified_date_column],
+                    kwargs.get('start'), kwargs.get('end'), source=alias.name))
+        sql_tables.append(branch)
 
     rename_to = as_alias.split('/')[-1]
     if merge_type == 'union all':
@@ -32,78 +41,143 @@ def merge_tables(aliases, merge_type, as_alias, *args, **kwargs):
     return sql, state_date_columns, is_deleted_clause
 
 
+# the range type of state date columns of the given type
+def range_function(column_type):
+    if isinstance(column_type, DateTime):
+        return 'tstzrange' if column_type.timezone else 'tsrange'
+    if isinstance(column_type, Date):
+        return 'daterange'
+    raise RuntimeError('State date columns must be dates or timestamps, not {}'
+            .format(column_type))
+
+
+# the state of a row as a range. least() keeps rows with the end before the
+# start as empty ranges instead of failing the whole statement. an open end
+# is an unbounded range
+def state_range(start_column, end_column):
+    return getattr(func, range_function(start_column.type))(
+            func.least(start_column, end_column), end_column, literal_column("'[)'"))
+
+
+# the same range as an index expression on the columns of alias, see
+# GDWIndexAdvisor.merge_indexes
+def state_range_sql(alias):
+    start_column, end_column = alias.state_date_columns
+    return "{}(least({}, {}), {}, '[)')".format(
+            range_function(alias.sql_table.c[start_column].type),
+            start_column, end_column, end_column)
+
+
+# the rows of a source modified in the window. from_clause is the source
+# table aliased as its basename
+def window_where(alias, from_clause, start, end):
+    where_clause = filter_date_range(
+            from_clause.c[alias.modified_date_column],
+            start, end, source=alias.name)
+    if alias.where:
+        where_clause = and_(text(alias.where), where_clause)
+    return where_clause
+
+
 def merge_changes(aliases, by=None, start=None, end=None, rename_to=None):
     # TODO add code to check inclusive/exclusive ranges
     if isinstance(by, str):
         by = [by]
 
-    # we are trying to get a list of distinct keys (by columns)
-    # and dates (which correspond to the state changes)
-    # once we have that we can find the different values in each of the source tables
-    # for those keys and date ranges
-    def keys_and_changes(aliases, by_columns, start, end):
-        keys_and_dates = []
+    # every state start and end of the rows modified in the window is a
+    # change point of its key. union all, the duplicates are removed below
+    # by comparing each point with the previous one of its key, which needs
+    # the same order as the lead() and so no sort of its own
+    def change_points(aliases, by_columns, start, end):
+        points = []
         for alias in aliases:
             from_clause = sqlalchemy.alias(alias.sql_table, alias.basename)
-            where_clause = filter_date_range(
-                    from_clause.c[alias.modified_date_column],
-                    start, end)
-            if alias.where:
-                where_clause = and_(alias.where, where_clause)
+            where_clause = window_where(alias, from_clause, start, end)
 
             # one row for state start and one for end
             for state_date_column in alias.state_date_columns:
-                keys_and_dates.append(
+                points.append(
                         select(
-                            by_columns + 
-                            [literal_column(state_date_column)
+                            [from_clause.c[c] for c in by_columns] +
+                            [from_clause.c[state_date_column]
                                 .label(STATE_START_COLUMN)])
-                        .select_from(from_clause)
                         .where(where_clause))
-        return union(*keys_and_dates)
-
-    by_columns = [
-            literal_column('{}'.format(c)).label(c)
-            for c in by]
-
-    keys_and_dts_start = sqlalchemy.alias(
-            keys_and_changes(aliases, by, start, end),
-            rename_to)
+        return sqlalchemy.alias(union_all(*points), 'gdw_points')
+
+    points = change_points(aliases, by, start, end)
+    point_keys = [points.c[c] for c in by]
+    point_start = points.c[STATE_START_COLUMN]
+    ordered_points = sqlalchemy.alias(select(
+        point_keys +
+        [point_start,
+         func.lag(point_start).over(
+             partition_by=point_keys, order_by=point_start)
+             .label('gdw_previous_start'),
+         func.row_number().over(
+             partition_by=point_keys, order_by=point_start)
+             .label('gdw_point')]), 'gdw_ordered_points')
+    distinct_points = sqlalchemy.alias(select(
+        [ordered_points.c[c] for c in by] +
+        [ordered_points.c[STATE_START_COLUMN]])
+        .where(or_(
+            ordered_points.c.gdw_point == 1,
+            ordered_points.c[STATE_START_COLUMN]
+                .op('IS DISTINCT FROM')(ordered_points.c.gdw_previous_start))),
+        'gdw_distinct_points')
 
     # add an end state date as the value for the next row with lead function
+    distinct_keys = [distinct_points.c[c] for c in by]
+    distinct_start = distinct_points.c[STATE_START_COLUMN]
     from_clause = sqlalchemy.alias(select(
-        [keys_and_dts_start.c[c] for c in by] +
-        [keys_and_dts_start.c[STATE_START_COLUMN],
-        func.lead(literal_column(STATE_START_COLUMN)).over(
-            partition_by=by_columns,
-            order_by=literal_column(STATE_START_COLUMN))
-            .label(STATE_END_COLUMN)],
-        from_obj=keys_and_dts_start), rename_to)
-
-    # TODO improve code below
+        distinct_keys +
+        [distinct_start,
+         func.lead(distinct_start).over(
+             partition_by=distinct_keys,
+             order_by=distinct_start)
+             .label(STATE_END_COLUMN)]), rename_to)
+
+    # each source is restricted up front to the keys changed in the window,
+    # in any of the sources, and its state is the range containing the change
+    # point. the gist index of the index advisor on (by, state_range) serves
+    # both
+    changed_keys = []
+    for alias in aliases:
+        source_table = sqlalchemy.alias(alias.sql_table, alias.basename)
+        changed_keys.append(
+                select([source_table.c[c] for c in by])
+                .where(window_where(alias, source_table, start, end)))
+    changed_keys = union_all(*changed_keys)
+
     is_deleted_clause = []
     for alias in aliases:
+        source_table = sqlalchemy.alias(alias.sql_table, alias.basename)
+        source = select([source_table]).where(
+                tuple_(*[source_table.c[c] for c in by]).in_(changed_keys))
+        if alias.where is not None:
+            source = source.where(text(alias.where))
+        source = sqlalchemy.alias(source, alias.basename)
+
         on_conditions = [
                 text('{rename_to}.{c} = {alias_basename}.{c}'
                     .format(rename_to=rename_to,
                             c=c,
                             alias_basename=alias.basename))
                 for c in by]
-        if alias.where is not None:
-            on_conditions.append(alias.where)
         if alias.state_date_columns:
             start_state_column, end_state_column = [
-                    sqlalchemy.alias(alias.sql_table, alias.basename).c[c]
-                    for c in alias.state_date_columns]
+                    source.c[c] for c in alias.state_date_columns]
+            change_point = cast(
+                    literal_column('{}.{}'.format(rename_to, STATE_START_COLUMN)),
+                    start_state_column.type)
+            on_conditions.append(start_state_column != None)
             on_conditions.append(
-                    and_(
-                        literal_column('{}.gdw_state_start'.format(rename_to)) >= start_state_column,
-                        literal_column('{}.gdw_state_start'.format(rename_to)) < coalesce(end_state_column, '9999-12-31')))
+                    state_range(start_state_column, end_state_column)
+                    .op('@>')(change_point))
         on_conditions = and_(*on_conditions)
 
         from_clause = from_clause.join(
-                sqlalchemy.alias(alias.sql_table, alias.basename),
-                onclause=and_(*on_conditions),
+                source,
+                onclause=on_conditions,
                 isouter=True)
 
         for object_key_column in by:
@@ -114,24 +188,15 @@ def merge_changes(aliases, by=None, start=None, end=None, rename_to=None):
 
 
 def relationship_with(alias, with_alias):
-    for relation_with, relation_dict in alias.get('relationships').items():
-        if relation_with == with_alias.name:
-            return relation_dict
-        return None
+    return catalog.relationships.relationship(alias.name, with_alias.name)
 
 
 # return a list of joins required to join each of the aliases pased as parameters
 # it will return a list with one element less than the aliases (as the first table is not joined)
+# aliases only related through other aliases need GDWRelationshipGraph.joins
 def find_joins(aliases):
-    joins = []
-    joined = [aliases[0]]
-    # starting from the second alias, find joins with all previously checked aliases
-    for pos, alias in enumerate(aliases[1:], 1):
-        join_dicts = [relationship_with(j, alias) for j in joined]
-        if len(join_dicts) > 1:
-            raise RuntimeError('Join loop found in the relationships')
-        elif len(join_dicts) == 0:
-            raise RuntimeError('No relationship found')
-        joins.append(join_dicts[0])
-        joined.append(alias)
-    return joins
+    joins = catalog.relationships.joins([alias.name for alias in aliases])
+    if any(bridge for _, _, bridge in joins):
+        raise RuntimeError('Joining {} needs bridge aliases'
+                .format(', '.join(alias.name for alias in aliases)))
+    return [relationship for _, relationship, _ in joins]
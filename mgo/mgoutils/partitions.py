@@ -0,0 +1,108 @@
+import datetime
+from sqlalchemy import text
+from sqlalchemy.sql import and_
+from sqlalchemy.sql.expression import delete
+
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def _month_start(d):
+    return datetime.datetime(d.year, d.month, 1)
+
+
+def _next_month(d):
+    if d.month == 12:
+        return datetime.datetime(d.year + 1, 1, 1)
+    return datetime.datetime(d.year, d.month + 1, 1)
+
+
+# for each interval: first moment of the partition containing d, next partition
+INTERVALS = {
+        'day': (
+            lambda d: datetime.datetime(d.year, d.month, d.day),
+            lambda d: d + datetime.timedelta(days=1)),
+        'week': (
+            lambda d: datetime.datetime(d.year, d.month, d.day) - datetime.timedelta(days=d.weekday()),
+            lambda d: d + datetime.timedelta(days=7)),
+        'month': (_month_start, _next_month),
+        }
+
+NAME_FORMATS = {'day': '%Y%m%d', 'week': '%Y%m%d', 'month': '%Y%m'}
+
+
+class GDWPartitioning(object):
+    """Date range partitions of an alias table (postgres declarative partitioning).
+
+    Declared in the alias yaml:
+        partition:
+            column: load_date   # defaults to the first of date.columns
+            interval: day       # day, week or month
+            ahead: 7            # partitions created after the load window
+    """
+    def __init__(self, alias):
+        definition = alias['partition']
+        self.alias = alias
+        self.column = definition.get('column') or alias.date_columns[0]
+        self.interval = definition.get('interval', 'day')
+        self.ahead = definition.get('ahead', 0)
+        self.partition_start, self.next_partition = INTERVALS[self.interval]
+
+    @property
+    def table(self):
+        return self.alias.sql_table
+
+    # list of (lower, upper) bounds of every partition touching [start, end]
+    def bounds(self, start, end, ahead=0):
+        lower = self.partition_start(start)
+        result = []
+        while lower <= end:
+            upper = self.next_partition(lower)
+            result.append((lower, upper))
+            lower = upper
+        for _ in range(ahead):
+            upper = self.next_partition(lower)
+            result.append((lower, upper))
+            lower = upper
+        return result
+
+    def name(self, lower):
+        return '{}_p{}'.format(self.table.name, lower.strftime(NAME_FORMATS[self.interval]))
+
+    def full_name(self, lower):
+        return '{}.{}'.format(self.table.schema, self.name(lower))
+
+    def create_sql(self, lower, upper):
+        return text(
+                "CREATE TABLE IF NOT EXISTS {} PARTITION OF {} "
+                "FOR VALUES FROM ('{}') TO ('{}');"
+                .format(self.full_name(lower), self.table, lower, upper))
+
+    # partitions of the window plus the ones ahead, so inserts never fail
+    def generate_create(self, start, end):
+        return [self.create_sql(lower, upper)
+                for lower, upper in self.bounds(start, end, self.ahead)]
+
+    # whole partitions inside the window are truncated (or dropped and created
+    # again). the partitions at the edges of the window only lose the rows
+    # inside the window with a normal delete
+    def generate_delete(self, start, end, how='truncate'):
+        delete_sqls = []
+        column = self.table.c[self.column]
+        for lower, upper in self.bounds(start, end):
+            if start <= lower and end >= upper - ONE_MICROSECOND:
+                if how == 'drop':
+                    delete_sqls.append(text('DROP TABLE IF EXISTS {};'.format(self.full_name(lower))))
+                    delete_sqls.append(self.create_sql(lower, upper))
+                else:
+                    delete_sqls.append(text('TRUNCATE TABLE {};'.format(self.full_name(lower))))
+            else:
+                delete_sqls.append(delete(
+                        self.table,
+                        whereclause=and_(
+                            column >= max(start, lower),
+                            column <= min(end, upper - ONE_MICROSECOND))))
+        return delete_sqls
+
+    def covers_whole_partitions(self, start, end):
+        return all(start <= lower and end >= upper - ONE_MICROSECOND
+                   for lower, upper in self.bounds(start, end))
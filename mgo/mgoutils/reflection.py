@@ -0,0 +1,303 @@
+import json
+import os
+import shutil
+import threading
+from os import path
+from sqlalchemy import text
+from sqlalchemy.schema import Column, DefaultClause, ForeignKeyConstraint, Index
+from sqlalchemy.exc import NoSuchTableError
+
+# one cheap row per table: the catalog rows get a new xmin on every DDL change
+# so oid + pg_class.xmin + max(pg_attribute.xmin) changes whenever the table
+# does. creating an index or a constraint does not always touch the pg_class
+# row, so their oids are part of it too
+FINGERPRINT_SQL = text("""
+SELECT c.relname AS table_name,
+       c.oid::text || ':' || c.xmin::text || ':' || max(a.xmin::text::bigint)::text
+       || ':' || coalesce((SELECT string_agg(i.indexrelid::text, ',' ORDER BY i.indexrelid)
+                           FROM pg_catalog.pg_index i WHERE i.indrelid = c.oid), '')
+       || ':' || coalesce((SELECT string_agg(con.oid::text, ',' ORDER BY con.oid)
+                           FROM pg_catalog.pg_constraint con WHERE con.conrelid = c.oid), '')
+       AS fingerprint
+FROM pg_catalog.pg_class c
+JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+JOIN pg_catalog.pg_attribute a ON a.attrelid = c.oid
+WHERE n.nspname = :schema
+  AND c.relkind IN ('r', 'v', 'm', 'f', 'p')
+GROUP BY c.relname, c.oid, c.xmin
+""")
+
+# all the columns of the stale tables of a schema in a single round-trip
+COLUMNS_SQL = text("""
+SELECT c.relname AS table_name,
+       a.attname AS name,
+       pg_catalog.format_type(a.atttypid, a.atttypmod) AS format_type,
+       pg_catalog.pg_get_expr(d.adbin, d.adrelid) AS "default",
+       a.attnotnull AS notnull,
+       coalesce(a.attnum = ANY(i.indkey), false) AS primary_key
+FROM pg_catalog.pg_class c
+JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+JOIN pg_catalog.pg_attribute a
+  ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+LEFT JOIN pg_catalog.pg_attrdef d
+  ON d.adrelid = c.oid AND d.adnum = a.attnum
+LEFT JOIN pg_catalog.pg_index i
+  ON i.indrelid = c.oid AND i.indisprimary
+WHERE n.nspname = :schema
+  AND c.relname = ANY(:tables)
+ORDER BY c.relname, a.attnum
+""")
+
+# the foreign keys of the stale tables of a schema, columns in key order
+FOREIGN_KEYS_SQL = text("""
+SELECT c.relname AS table_name,
+       con.conname AS name,
+       array(SELECT a.attname::text
+             FROM unnest(con.conkey) WITH ORDINALITY k(attnum, position)
+             JOIN pg_catalog.pg_attribute a
+               ON a.attrelid = con.conrelid AND a.attnum = k.attnum
+             ORDER BY k.position) AS constrained_columns,
+       rn.nspname AS referred_schema,
+       rc.relname AS referred_table,
+       array(SELECT a.attname::text
+             FROM unnest(con.confkey) WITH ORDINALITY k(attnum, position)
+             JOIN pg_catalog.pg_attribute a
+               ON a.attrelid = con.confrelid AND a.attnum = k.attnum
+             ORDER BY k.position) AS referred_columns
+FROM pg_catalog.pg_constraint con
+JOIN pg_catalog.pg_class c ON c.oid = con.conrelid
+JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+JOIN pg_catalog.pg_class rc ON rc.oid = con.confrelid
+JOIN pg_catalog.pg_namespace rn ON rn.oid = rc.relnamespace
+WHERE con.contype = 'f'
+  AND n.nspname = :schema
+  AND c.relname = ANY(:tables)
+ORDER BY c.relname, con.conname
+""")
+
+# every index of a schema with its columns in index order. expression
+# columns have no attribute and come as NULL
+INDEXES_SQL = text("""
+SELECT c.relname AS table_name,
+       ic.relname AS index_name,
+       am.amname AS method,
+       i.indisunique AS is_unique,
+       pg_catalog.pg_get_expr(i.indpred, i.indrelid) AS predicate,
+       array(SELECT a.attname::text
+             FROM unnest(i.indkey) WITH ORDINALITY k(attnum, position)
+             LEFT JOIN pg_catalog.pg_attribute a
+               ON a.attrelid = c.oid AND a.attnum = k.attnum
+             ORDER BY k.position) AS columns
+FROM pg_catalog.pg_index i
+JOIN pg_catalog.pg_class c ON c.oid = i.indrelid
+JOIN pg_catalog.pg_class ic ON ic.oid = i.indexrelid
+JOIN pg_catalog.pg_am am ON am.oid = ic.relam
+JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+WHERE n.nspname = :schema
+""")
+
+# how close the physical order of each column is to its sorted order
+CORRELATION_SQL = text("""
+SELECT tablename AS table_name, attname AS name, correlation
+FROM pg_catalog.pg_stats
+WHERE schemaname = :schema
+""")
+
+
+class GDWReflectionCache(object):
+    """Table definitions per database and schema, persisted as json files.
+
+    A schema is loaded the first time one of its tables is needed: one query
+    gets the fingerprint of every table and only the tables whose fingerprint
+    changed are reflected again, all of them in one query per kind (columns,
+    foreign keys, indexes). Enum and domain types are read once per database,
+    the dialect needs them to reflect the columns using them."""
+    def __init__(self, directory):
+        self.directory = directory
+        self._schemas = {}
+        self._types = {}
+        self._lock = threading.RLock()
+
+    def schema_file(self, database, schema):
+        return path.join(self.directory, database, '{}.json'.format(schema))
+
+    def fingerprint(self, database, engine, schema, table_name):
+        return self.schema(database, engine, schema)[table_name]['fingerprint']
+
+    def table(self, database, engine, schema, table_name):
+        try:
+            return self.schema(database, engine, schema)[table_name]
+        except KeyError:
+            raise NoSuchTableError('{}.{}'.format(schema, table_name))
+
+    def columns(self, database, engine, schema, table_name):
+        table = self.table(database, engine, schema, table_name)
+        domains, enums = self.types(database, engine)
+        columns = []
+        for name, format_type, default, notnull, primary_key in table['columns']:
+            column_info = engine.dialect._get_column_info(
+                    name, format_type, default, notnull, domains, enums, schema)
+            server_default = None
+            if column_info['default'] is not None:
+                server_default = DefaultClause(text(column_info['default']))
+            columns.append(Column(
+                    name,
+                    column_info['type'],
+                    nullable=column_info['nullable'],
+                    primary_key=primary_key,
+                    server_default=server_default))
+        return columns
+
+    # add the foreign keys and indexes of a table once its columns are in place
+    def add_constraints(self, database, engine, schema, sql_table):
+        table = self.table(database, engine, schema, sql_table.name)
+        for foreign_key in table.get('foreign_keys', []):
+            sql_table.append_constraint(ForeignKeyConstraint(
+                    foreign_key['constrained_columns'],
+                    ['{}.{}.{}'.format(foreign_key['referred_schema'],
+                                       foreign_key['referred_table'], c)
+                     for c in foreign_key['referred_columns']],
+                    name=foreign_key['name']))
+        for index in table.get('indexes', []):
+            # like the dialect, expression indexes are left out
+            if None in index['columns']:
+                continue
+            kwargs = {'postgresql_using': index['method']}
+            if index['predicate']:
+                kwargs['postgresql_where'] = text(index['predicate'])
+            # bound to the columns, the index is added to the table
+            Index(index['name'],
+                  *[sql_table.c[c] for c in index['columns']],
+                  unique=index['unique'],
+                  **kwargs)
+
+    # enum and domain types as the dialect reflects them, by database
+    def types(self, database, engine):
+        try:
+            return self._types[database]
+        except KeyError:
+            pass
+        with self._lock:
+            if database not in self._types:
+                with engine.connect() as connection:
+                    domains = engine.dialect._load_domains(connection)
+                    enums = dict(
+                            (enum['name'] if enum['visible']
+                             else '{}.{}'.format(enum['schema'], enum['name']), enum)
+                            for enum in engine.dialect._load_enums(connection, schema='*'))
+                self._types[database] = (domains, enums)
+        return self._types[database]
+
+    def schema(self, database, engine, schema):
+        try:
+            return self._schemas[(database, schema)]
+        except KeyError:
+            pass
+        with self._lock:
+            if (database, schema) not in self._schemas:
+                self._schemas[(database, schema)] = self._load(database, engine, schema)
+        return self._schemas[(database, schema)]
+
+    def _load(self, database, engine, schema):
+        cached = self._read(database, schema)
+        fingerprints = dict(engine.execute(FINGERPRINT_SQL, schema=schema).fetchall())
+        tables = dict(
+                (name, cached[name])
+                for name, fingerprint in fingerprints.items()
+                if cached.get(name, {}).get('fingerprint') == fingerprint)
+
+        stale = [name for name in fingerprints if name not in tables]
+        if stale:
+            for name in stale:
+                tables[name] = {
+                        'fingerprint': fingerprints[name],
+                        'columns': [],
+                        'foreign_keys': [],
+                        'indexes': []}
+            rows = engine.execute(COLUMNS_SQL, schema=schema, tables=stale)
+            for row in rows:
+                tables[row['table_name']]['columns'].append([
+                        row['name'], row['format_type'], row['default'],
+                        row['notnull'], row['primary_key']])
+            rows = engine.execute(FOREIGN_KEYS_SQL, schema=schema, tables=stale)
+            for row in rows:
+                tables[row['table_name']]['foreign_keys'].append({
+                        'name': row['name'],
+                        'constrained_columns': row['constrained_columns'],
+                        'referred_schema': row['referred_schema'],
+                        'referred_table': row['referred_table'],
+                        'referred_columns': row['referred_columns']})
+            for table_name, indexes in self.indexes(engine, schema).items():
+                if table_name in stale:
+                    tables[table_name]['indexes'] = indexes
+            self._write(database, schema, tables)
+        return tables
+
+    # the index advisor reads indexes and statistics straight from the
+    # database, they are not worth a fingerprint check there
+    def indexes(self, engine, schema):
+        indexes = {}
+        for row in engine.execute(INDEXES_SQL, schema=schema):
+            indexes.setdefault(row['table_name'], []).append({
+                    'name': row['index_name'],
+                    'method': row['method'],
+                    'unique': row['is_unique'],
+                    'predicate': row['predicate'],
+                    'columns': row['columns']})
+        return indexes
+
+    def correlations(self, engine, schema):
+        correlations = {}
+        for row in engine.execute(CORRELATION_SQL, schema=schema):
+            correlations[(row['table_name'], row['name'])] = row['correlation']
+        return correlations
+
+    # forget the schemas and types read so far, keeping the files, so the
+    # next use reads the fingerprints again. returns the fingerprints that
+    # were known, {(database, schema): {table name: fingerprint}}
+    def refresh(self):
+        with self._lock:
+            fingerprints = dict(
+                    (key, dict((name, table['fingerprint']) for name, table in tables.items()))
+                    for key, tables in self._schemas.items())
+            self._schemas = {}
+            self._types = {}
+        return fingerprints
+
+    def invalidate(self, database=None, schema=None):
+        for key in list(self._types):
+            if database is None or key == database:
+                del self._types[key]
+        if database and schema:
+            self._schemas.pop((database, schema), None)
+            try:
+                os.remove(self.schema_file(database, schema))
+            except OSError:
+                pass
+        else:
+            for key in list(self._schemas):
+                if database is None or key[0] == database:
+                    del self._schemas[key]
+            directory = self.directory
+            if database:
+                directory = path.join(directory, database)
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def _read(self, database, schema):
+        try:
+            with open(self.schema_file(database, schema)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write(self, database, schema, tables):
+        file_path = self.schema_file(database, schema)
+        try:
+            os.makedirs(path.dirname(file_path))
+        except OSError:
+            pass
+        # write and rename so concurrent runs never read half a file
+        tmp_path = '{}.{}.tmp'.format(file_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(tables, f)
+        os.rename(tmp_path, file_path)
@@ -0,0 +1,116 @@
+import json
+import re
+import threading
+
+JOIN_COLUMN = re.compile(r'\b(\w+)\.(\w+)\b')
+
+
+# columns of a relationship join_on qualified by prefix (alias basename or as)
+def join_columns(join_on, prefix):
+    return [column for column_prefix, column in JOIN_COLUMN.findall(join_on)
+            if column_prefix == prefix]
+
+
+class GDWRelationshipGraph(object):
+    """The relationships of every alias file as one undirected graph, built
+    once per catalog and indexed by alias pair.
+
+    A relationship can be declared in the alias file of either side. The
+    joins of a transform are resolved in the order of its from: every alias
+    is joined to the closest alias already joined, through the shortest path
+    of relationships, or after the alias it is related through. The aliases
+    in between (bridge aliases) are joined too, so they must have a table.
+    Ties go to the alias joined first. Resolved joins are cached by from."""
+    def __init__(self, catalog):
+        self.relationships = {}
+        self.neighbours = {}
+        for alias_name in catalog.alias_names('alias'):
+            relationships = catalog.aliases[alias_name].get('relationships') or {}
+            for related_name, relationship in sorted(relationships.items()):
+                key = self.key(alias_name, related_name)
+                # declared on both sides, the first one found wins
+                if key in self.relationships:
+                    continue
+                self.relationships[key] = relationship
+                self.neighbours.setdefault(alias_name, set()).add(related_name)
+                self.neighbours.setdefault(related_name, set()).add(alias_name)
+        self.bridges = set(
+                alias_name for alias_name in self.neighbours
+                if catalog.aliases[alias_name].area)
+        self._joins = {}
+        self._lock = threading.Lock()
+
+    # changes whenever any relationship does, for the compiled statement cache
+    @property
+    def fingerprint(self):
+        return json.dumps(
+                sorted([list(key), relationship] for key, relationship in self.relationships.items()),
+                sort_keys=True, default=str)
+
+    @staticmethod
+    def key(alias_name, other_alias_name):
+        return tuple(sorted((alias_name, other_alias_name)))
+
+    def relationship(self, alias_name, other_alias_name):
+        return self.relationships.get(self.key(alias_name, other_alias_name))
+
+    # shortest path from one of the joined aliases to alias_name, going only
+    # through bridges that are not part of the from. None if there is none
+    def shortest_path(self, joined, alias_name, excluded=()):
+        order = dict((name, position) for position, name in enumerate(joined))
+        closer = {alias_name: None}
+        frontier = [alias_name]
+        while frontier:
+            found = [name for name in frontier if name in order and name != alias_name]
+            if found:
+                path = [min(found, key=order.get)]
+                while closer[path[-1]] is not None:
+                    path.append(closer[path[-1]])
+                return path
+
+            next_frontier = []
+            for name in frontier:
+                if name != alias_name and name not in self.bridges:
+                    continue
+                for neighbour in sorted(self.neighbours.get(name, ())):
+                    if neighbour in closer or neighbour in excluded:
+                        continue
+                    if neighbour not in order and neighbour not in self.bridges:
+                        continue
+                    closer[neighbour] = name
+                    next_frontier.append(neighbour)
+            frontier = next_frontier
+        return None
+
+    # the joins of the aliases of a from after the first one, as a list of
+    # (alias name, relationship, bridge) in join order. bridges come right
+    # before the alias that needs them. an alias only related through a later
+    # one of the from is joined after it
+    def joins(self, alias_names):
+        alias_names = tuple(alias_names)
+        try:
+            return self._joins[alias_names]
+        except KeyError:
+            pass
+
+        joins = []
+        joined = list(alias_names[:1])
+        pending = list(alias_names[1:])
+        while pending:
+            for alias_name in pending:
+                path = self.shortest_path(
+                        joined, alias_name,
+                        excluded=[p for p in pending if p != alias_name])
+                if path is not None:
+                    break
+            else:
+                raise RuntimeError('No relationship found between {} and {}'
+                        .format(', '.join(pending), ', '.join(joined)))
+            pending.remove(alias_name)
+            for previous, name in zip(path, path[1:]):
+                joins.append((name, self.relationship(previous, name), name != alias_name))
+                joined.append(name)
+
+        with self._lock:
+            self._joins[alias_names] = joins
+        return joins
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+from collections import namedtuple
+from os import path
+from mgoutils.dateutils import START_PARAM, END_PARAM, SOURCE_START_PREFIX
+
+WINDOW_PARAMS = (START_PARAM, END_PARAM)
+SOURCE_DIRECTORY = path.dirname(path.dirname(path.abspath(__file__)))
+PYFORMAT_PARAM = re.compile(r'%\((\w+)\)s')
+PREPARABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'VALUES')
+
+
+def is_window_param(name):
+    return name in WINDOW_PARAMS or name.startswith(SOURCE_START_PREFIX)
+
+
+# a statement compiled with the date window as bound parameters.
+# params holds every other bound value, which only depends on the metadata
+class CompiledStatement(namedtuple('CompiledStatement', ['description', 'sql', 'params'])):
+    __slots__ = ()
+
+    @classmethod
+    def compile(cls, description, query, engine):
+        compiled = query.compile(dialect=engine.dialect)
+        params = dict(
+                (name, value)
+                for name, value in compiled.params.items()
+                if not is_window_param(name))
+        return cls(description, str(compiled), params)
+
+    # the bound values for a window. sources without a start of their own in
+    # the window read from its start
+    def bind(self, window):
+        params = dict(self.params)
+        for name in PYFORMAT_PARAM.findall(self.sql):
+            if name.startswith(SOURCE_START_PREFIX):
+                params[name] = window[START_PARAM]
+        params.update(window)
+        return params
+
+    @property
+    def preparable(self):
+        return self.sql.lstrip().split(None, 1)[0].upper() in PREPARABLE
+
+    @property
+    def prepared_name(self):
+        return 'mgo_{}'.format(hashlib.sha1(self.sql.encode('utf-8')).hexdigest()[:16])
+
+    def execute(self, connection, window, prepare=False):
+        params = self.bind(window)
+        connection = connection.execution_options(autocommit=True)
+        if not (prepare and self.preparable):
+            return connection.execute(self.sql, params)
+
+        # server side prepared statements live as long as the session, so
+        # remember on the dbapi connection which ones are already prepared
+        names = []
+
+        def positional(match):
+            if match.group(1) not in names:
+                names.append(match.group(1))
+            return '${}'.format(names.index(match.group(1)) + 1)
+
+        prepared_sql = PYFORMAT_PARAM.sub(positional, self.sql)
+        prepared = connection.info.setdefault('mgo_prepared', set())
+        if self.prepared_name not in prepared:
+            connection.execute(
+                    'PREPARE {} AS {}'.format(self.prepared_name, prepared_sql), {})
+            prepared.add(self.prepared_name)
+
+        if not names:
+            return connection.execute('EXECUTE {}'.format(self.prepared_name), {})
+        return connection.execute(
+                'EXECUTE {} ({})'.format(
+                    self.prepared_name,
+                    ', '.join('%({})s'.format(n) for n in names)),
+                params)
+
+
+# hash of the mgo sources, so a new release never reuses statements compiled
+# by the previous code
+def source_fingerprint():
+    sha = hashlib.sha1()
+    for directory, _, file_names in sorted(os.walk(SOURCE_DIRECTORY)):
+        for file_name in sorted(file_names):
+            if file_name.endswith('.py'):
+                with open(path.join(directory, file_name), 'rb') as f:
+                    sha.update(f.read())
+    return sha.hexdigest()
+
+
+class GDWSQLCache(object):
+    """Compiled load statements stored as json files named after the hash of
+    everything they were generated from."""
+    def __init__(self, directory):
+        self.directory = directory
+
+    @staticmethod
+    def key(*parts):
+        sha = hashlib.sha1()
+        for part in parts:
+            if not isinstance(part, bytes):
+                part = '{}'.format(part).encode('utf-8')
+            sha.update(part)
+            sha.update(b'\0')
+        return sha.hexdigest()
+
+    def cache_file(self, key):
+        return path.join(self.directory, '{}.json'.format(key))
+
+    def get(self, key):
+        try:
+            with open(self.cache_file(key)) as f:
+                return [CompiledStatement(*s) for s in json.load(f)]
+        except (IOError, ValueError):
+            return None
+
+    def put(self, key, statements):
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            pass
+        # dates bound as strings are cast back by postgres
+        content = json.dumps([list(s) for s in statements], default=str)
+        tmp_path = '{}.{}.tmp'.format(self.cache_file(key), os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.rename(tmp_path, self.cache_file(key))
+
+    def invalidate(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
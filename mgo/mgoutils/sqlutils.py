@@ -1,4 +1,73 @@
+import hashlib
+from sqlalchemy import Text, cast
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql import func
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+
 def compile_sql(query, engine):
     return str(query.compile(
         dialect=engine.dialect,
         compile_kwargs={"literal_binds": True}))
+
+
+# longer postgres identifiers are truncated
+MAX_IDENTIFIER_LENGTH = 63
+
+
+# a table name built from other names, cut to what postgres keeps and made
+# unique again with a hash of the whole name
+def table_identifier(name):
+    if len(name) <= MAX_IDENTIFIER_LENGTH:
+        return name
+    digest = hashlib.md5(name.encode('utf-8')).hexdigest()[:8]
+    return '{}_{}'.format(name[:MAX_IDENTIFIER_LENGTH - len(digest) - 1], digest)
+
+
+# md5 of the row made of these columns. nulls hash differently than empty values
+def row_hash(columns):
+    return func.md5(cast(func.row(*columns), Text))
+
+
+# postgres INSERT ... ON CONFLICT, which this sqlalchemy version does not have.
+# update maps column names to the sql text of their new value (the proposed
+# row is EXCLUDED). without update, conflicting rows are left alone
+class InsertOnConflict(Executable, ClauseElement):
+    def __init__(self, insert, conflict_columns, update=None, where=None):
+        self.insert = insert
+        self.conflict_columns = conflict_columns
+        self.update = update or {}
+        self.where = where
+
+
+@compiles(InsertOnConflict)
+def compile_insert_on_conflict(element, compiler, **kw):
+    sql = '{} ON CONFLICT ({})'.format(
+            compiler.process(element.insert, **kw),
+            ', '.join(element.conflict_columns))
+    if not element.update:
+        return sql + ' DO NOTHING'
+
+    sql += ' DO UPDATE SET {}'.format(', '.join(
+            '{} = {}'.format(column, value)
+            for column, value in sorted(element.update.items())))
+    if element.where is not None:
+        sql += ' WHERE {}'.format(element.where)
+    return sql
+
+
+# CREATE [TEMPORARY|UNLOGGED] TABLE ... AS <select>, keeping the bound
+# parameters of the select
+class CreateTableAs(Executable, ClauseElement):
+    def __init__(self, table, select, prefix=None):
+        self.table = table
+        self.select = select
+        self.prefix = prefix
+
+
+@compiles(CreateTableAs)
+def compile_create_table_as(element, compiler, **kw):
+    return 'CREATE {}TABLE {} AS {}'.format(
+            '{} '.format(element.prefix) if element.prefix else '',
+            element.table,
+            compiler.process(element.select, **kw))
@@ -0,0 +1,50 @@
+import sqlalchemy
+from sqlalchemy import Column, BigInteger, DateTime, Float, String, Text, func, text
+from mgoutils.catalog import catalog
+
+# area where mgo keeps its own bookkeeping tables
+STATE_AREA = 'mgo'
+STATE_SCHEMA = catalog.areas[STATE_AREA]['schema']
+
+metadata = sqlalchemy.MetaData(schema=STATE_SCHEMA)
+
+# date chunks of a backfill that are already loaded
+checkpoints = sqlalchemy.Table(
+        'gdw_checkpoint', metadata,
+        Column('target', String, primary_key=True),
+        Column('chunk_start', DateTime, primary_key=True),
+        Column('chunk_end', DateTime, primary_key=True),
+        Column('loaded_at', DateTime, nullable=False, server_default=func.now()))
+
+# max modified date already loaded from each source alias of a target
+watermarks = sqlalchemy.Table(
+        'gdw_watermark', metadata,
+        Column('target', String, primary_key=True),
+        Column('source_alias', String, primary_key=True),
+        Column('modified_max', DateTime, nullable=False),
+        Column('updated_at', DateTime, nullable=False, server_default=func.now()))
+
+# one row per executed statement, see mgoutils.instrument
+run_history = sqlalchemy.Table(
+        'gdw_run_history', metadata,
+        Column('id', BigInteger, primary_key=True),
+        Column('target', String, nullable=False),
+        Column('phase', String, nullable=False),
+        Column('statement', String),
+        Column('chunk_start', DateTime),
+        Column('chunk_end', DateTime),
+        Column('started_at', DateTime, nullable=False),
+        Column('seconds', Float, nullable=False),
+        Column('rowcount', BigInteger),
+        Column('plan', Text))
+
+
+def state_engine():
+    return catalog.engines[catalog.areas[STATE_AREA]['database']]
+
+
+def create_state_tables(engine=None):
+    engine = engine or state_engine()
+    engine.execute(text('CREATE SCHEMA IF NOT EXISTS {};'.format(STATE_SCHEMA))
+                   .execution_options(autocommit=True))
+    metadata.create_all(engine, checkfirst=True)
@@ -0,0 +1,161 @@
+from mgoutils.relationships import JOIN_COLUMN
+
+# the keys mgo reads from the metadata files, by section
+ALIAS_KEYS = {
+    None: ('area', 'table', 'load', 'delete', 'date', 'where', 'is_deleted',
+           'relationships', 'partition', 'psa'),
+    'load': ('how', 'type', 'object_key', 'priority', 'priority_which',
+             'staging_alias', 'primary_key', 'hash_columns', 'swap',
+             'swap_lock_timeout', 'incremental', 'lookback'),
+    'delete': ('how', 'what'),
+    'date': ('modified', 'columns', 'state'),
+    'partition': ('column', 'interval', 'ahead'),
+    'psa': ('system', 'table', 'header')}
+TRANSFORM_KEYS = ('from', 'select', 'where', 'group_by', 'having', 'materialize')
+FROM_KEYS = ('alias', 'merge', 'by', 'as', 'how')
+RELATIONSHIP_KEYS = ('join_on',)
+LOAD_HOWS = ('insert', 'upsert', 'dimension')
+MERGE_TYPES = ('union all', 'union', 'modifications')
+MATERIALIZE_KINDS = ('inline', 'temp', 'unlogged')
+
+
+# checks every alias and transform file of a bundle before it is written:
+# - keys mgo does not know, usually typos that would be silently ignored
+# - areas missing from areas.yaml
+# - aliases read by transforms, staging aliases and relationships that have
+#   no alias or transform file
+# - relationships without join_on or joining columns of other aliases
+class GDWMetadataValidator():
+    def __init__(self, bundle):
+        self.bundle = bundle
+        self.areas = bundle.documents.get('areas.yaml') or {}
+        self.alias_names = set(
+                bundle.names('.alias.yaml') + bundle.names('.transform.yaml'))
+
+    def alias(self, alias_name):
+        return self.bundle.documents.get('{}.alias.yaml'.format(alias_name)) or {}
+
+    def unknown_keys(self, file_name, document, known, section=None):
+        if not isinstance(document, dict):
+            yield '{}: {} must be a mapping'.format(file_name, section or 'the file')
+            return
+        for key in sorted(set(document) - set(known)):
+            yield '{}: unknown key {}'.format(
+                    file_name, key if section is None else '{}.{}'.format(section, key))
+
+    def missing_alias(self, file_name, alias_name, used_as):
+        if alias_name not in self.alias_names:
+            yield '{}: {} {} has no alias or transform file'.format(file_name, used_as, alias_name)
+
+    def alias_errors(self, alias_name):
+        file_name = '{}.alias.yaml'.format(alias_name)
+        alias = self.bundle.documents[file_name] or {}
+        for error in self.unknown_keys(file_name, alias, ALIAS_KEYS[None]):
+            yield error
+        if not isinstance(alias, dict):
+            return
+        for section, known in ALIAS_KEYS.items():
+            if section is not None and section in alias:
+                for error in self.unknown_keys(file_name, alias[section], known, section):
+                    yield error
+
+        if 'area' in alias:
+            if alias['area'] not in self.areas:
+                yield '{}: unknown area {}'.format(file_name, alias['area'])
+            if 'table' not in alias:
+                yield '{}: alias in area {} without a table'.format(file_name, alias['area'])
+
+        load_definition = alias.get('load') or {}
+        if isinstance(load_definition, dict):
+            if load_definition.get('how', 'insert') not in LOAD_HOWS:
+                yield '{}: unknown load.how {}'.format(file_name, load_definition['how'])
+            staging_alias = load_definition.get('staging_alias')
+            if staging_alias:
+                for error in self.missing_alias(file_name, staging_alias, 'staging alias'):
+                    yield error
+
+        relationships = alias.get('relationships') or {}
+        if not isinstance(relationships, dict):
+            yield '{}: relationships must be a mapping'.format(file_name)
+            return
+        basename = alias_name.split('/')[-1]
+        for related_name, relationship in sorted(relationships.items()):
+            for error in self.missing_alias(file_name, related_name, 'related alias'):
+                yield error
+            section = 'relationships.{}'.format(related_name)
+            for error in self.unknown_keys(file_name, relationship, RELATIONSHIP_KEYS, section):
+                yield error
+            if not isinstance(relationship, dict):
+                continue
+            join_on = relationship.get('join_on')
+            if not join_on:
+                yield '{}: {} has no join_on'.format(file_name, section)
+                continue
+            # join_on only compares columns of the two aliases
+            prefixes = (basename, related_name.split('/')[-1])
+            for prefix, column in JOIN_COLUMN.findall(join_on):
+                if prefix not in prefixes:
+                    yield '{}: {} joins {}.{}, not a column of {} or {}'.format(
+                            file_name, section, prefix, column, alias_name, related_name)
+
+    def transform_errors(self, alias_name):
+        file_name = '{}.transform.yaml'.format(alias_name)
+        transforms = self.bundle.documents[file_name] or {}
+        for error in self.unknown_keys(file_name, transforms, TRANSFORM_KEYS):
+            yield error
+        if not isinstance(transforms, dict):
+            return
+
+        for key in ('from', 'select'):
+            if key not in transforms:
+                yield '{}: no {}'.format(file_name, key)
+        if transforms.get('materialize', 'inline') not in MATERIALIZE_KINDS:
+            yield '{}: unknown materialize {}'.format(file_name, transforms['materialize'])
+        if transforms.get('materialize', 'inline') != 'inline' and self.alias(alias_name).get('area'):
+            yield '{}: only transforms without a table can be materialized'.format(file_name)
+
+        for column in transforms.get('select') or []:
+            if not isinstance(column, dict) or len(column) != 1:
+                yield '{}: every select entry must be one name: expression'.format(file_name)
+
+        froms = transforms.get('from') or []
+        if not isinstance(froms, list):
+            froms = [froms]
+        for single_from in froms:
+            if isinstance(single_from, str):
+                from_aliases = [single_from]
+            elif isinstance(single_from, list):
+                from_aliases = single_from
+            elif isinstance(single_from, dict):
+                for error in self.unknown_keys(file_name, single_from, FROM_KEYS, 'from'):
+                    yield error
+                merge_type = single_from.get('merge', 'union all')
+                if merge_type not in MERGE_TYPES:
+                    yield '{}: unknown merge {}'.format(file_name, merge_type)
+                if merge_type == 'modifications' and not single_from.get('by'):
+                    yield '{}: merge modifications without by'.format(file_name)
+                from_aliases = single_from.get('alias') or []
+                if isinstance(from_aliases, str):
+                    from_aliases = [from_aliases]
+                if not from_aliases:
+                    yield '{}: from without alias'.format(file_name)
+            else:
+                yield '{}: from entries must be an alias, a list or a mapping'.format(file_name)
+                continue
+            for from_alias in from_aliases:
+                for error in self.missing_alias(file_name, from_alias, 'from alias'):
+                    yield error
+
+    def errors(self):
+        errors = []
+        if 'areas.yaml' not in self.bundle.documents:
+            errors.append('no areas.yaml')
+        for area_name, area in sorted(self.areas.items()):
+            for key in ('database', 'schema'):
+                if key not in (area or {}):
+                    errors.append('areas.yaml: area {} without {}'.format(area_name, key))
+        for alias_name in self.bundle.names('.alias.yaml'):
+            errors += self.alias_errors(alias_name)
+        for alias_name in self.bundle.names('.transform.yaml'):
+            errors += self.transform_errors(alias_name)
+        return errors
@@ -0,0 +1,187 @@
+import logging
+import time
+from multiprocessing.pool import ThreadPool
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+from cmdlineutil import CronJob
+import de_common.scriptutil as scriptutil
+from mgoutils.catalog import catalog
+from mgoutils.dateutils import default_start, default_end, parse_date
+from mgoutils.instrument import GDWInstrument
+from mgoutils.state import create_state_tables
+from load import GDWLoad
+
+__author__ = 'jvalenzuela'
+DISPLAY_NAME = scriptutil.get_display_name(__file__)
+TOOL_NAME = scriptutil.get_tool_name(DISPLAY_NAME)
+_logger = logging.getLogger(TOOL_NAME)
+
+
+class CronGDWRun(CronJob):
+    def __init__(self):
+        super(CronGDWRun, self).__init__()
+        self.config = self.props
+
+    name = TOOL_NAME
+    display_name = DISPLAY_NAME
+
+    options = [
+        (('-s', '--start'), dict(type=str, dest='start_datetime', required=False)),
+        (('-e', '--end'), dict(type=str, dest='end_datetime', required=False)),
+        (('-w', '--workers'), dict(type=int, dest='workers', default=4)),
+        (('-d', '--dry-run'), dict(type=bool, dest='dry_run', default=False)),
+        (('-p', '--prepare'), dict(type=bool, dest='prepare', default=False)),
+        (('-x', '--explain-analyze'), dict(type=bool, dest='explain_analyze', default=False)),
+        (('-f', '--metrics-file'), dict(type=str, dest='metrics_file', default=None)),
+        (('-r', '--history'), dict(type=bool, dest='history', default=False))]
+
+    def _run_impl(self):
+        catalog.configure(self.config)
+        if self.opts.history:
+            create_state_tables()
+        scheduler = GDWScheduler(
+                self.config,
+                self.opts.start_datetime,
+                self.opts.end_datetime,
+                workers=self.opts.workers,
+                instrument_options=dict(
+                    explain=self.opts.explain_analyze,
+                    metrics_file=self.opts.metrics_file,
+                    history=self.opts.history))
+        scheduler.run(dry_run=self.opts.dry_run, prepare=self.opts.prepare)
+
+
+# load every target in the metadata directory. a target is loaded once all
+# the targets writing the aliases it reads from are loaded. independent
+# targets run at the same time, sharing the catalog and the engine pool
+class GDWScheduler():
+    def __init__(self, config, start=None, end=None, workers=4, instrument_options=None):
+        self.config = config
+        self.start = parse_date(start or default_start())
+        self.end = parse_date(end or default_end())
+        self.workers = workers
+        self.instrument_options = instrument_options or {}
+
+    # returns {target: set of targets it depends on}
+    def dependency_graph(self):
+        targets = [
+                alias_name for alias_name in catalog.alias_names('transform')
+                if not catalog.aliases[alias_name].is_transform]
+
+        # a target writes its own table and its staging table
+        writers = {}
+        for target in targets:
+            writers[target] = target
+            staging_alias = catalog.aliases[target].get('load', {}).get('staging_alias')
+            if staging_alias:
+                writers[staging_alias] = target
+
+        graph = {}
+        for target in targets:
+            graph[target] = set(
+                    writers[alias_name]
+                    for alias_name in catalog.read_alias_names(target)
+                    if writers.get(alias_name, target) != target)
+        return graph
+
+    def check_cycles(self, graph):
+        pending = dict((target, set(deps)) for target, deps in graph.items())
+        while pending:
+            ready = [target for target, deps in pending.items() if not deps]
+            if not ready:
+                raise RuntimeError('Dependency cycle between targets: {}'
+                        .format(', '.join(sorted(pending))))
+            for target in ready:
+                del pending[target]
+            for deps in pending.values():
+                deps.difference_update(ready)
+
+    # the chain of dependent targets with the longest total wall time
+    def critical_path(self, graph, wall_times):
+        longest = {}
+
+        def path_to(target):
+            if target not in longest:
+                best = (0, [])
+                for dep in graph[target]:
+                    if dep in wall_times:
+                        best = max(best, path_to(dep))
+                longest[target] = (best[0] + wall_times[target], best[1] + [target])
+            return longest[target]
+
+        paths = [path_to(target) for target in wall_times]
+        return max(paths) if paths else (0, [])
+
+    def load_target(self, target, dry_run, prepare):
+        started = time.time()
+        try:
+            instrument = GDWInstrument(target, **self.instrument_options)
+            gdw_load = GDWLoad(
+                    target, self.config, self.start, self.end,
+                    instrument=instrument)
+            gdw_load.run(dry_run=dry_run, prepare=prepare)
+            error = None
+        except Exception as e:
+            _logger.exception("Load of {} failed".format(target))
+            error = e
+        return target, time.time() - started, error
+
+    def run(self, dry_run=False, prepare=False):
+        graph = self.dependency_graph()
+        self.check_cycles(graph)
+
+        pending = dict(graph)
+        running = set()
+        wall_times = {}
+        failed = set()
+        skipped = set()
+        finished = Queue()
+        pool = ThreadPool(self.workers)
+        started = time.time()
+        try:
+            while pending or running:
+                for target, deps in sorted(pending.items()):
+                    if deps & (failed | skipped):
+                        _logger.warning("Skipping {}: a dependency failed".format(target))
+                        skipped.add(target)
+                        del pending[target]
+                    elif deps <= set(wall_times):
+                        _logger.info("Starting load of {}".format(target))
+                        pool.apply_async(
+                                self.load_target,
+                                (target, dry_run, prepare),
+                                callback=finished.put)
+                        running.add(target)
+                        del pending[target]
+
+                if not running:
+                    continue
+
+                target, wall_time, error = finished.get()
+                running.remove(target)
+                if error is None:
+                    wall_times[target] = wall_time
+                    _logger.info("Loaded {} in {:.1f}s".format(target, wall_time))
+                else:
+                    failed.add(target)
+        finally:
+            pool.close()
+            pool.join()
+
+        total, path = self.critical_path(graph, wall_times)
+        _logger.info("Loaded {} targets in {:.1f}s. Critical path ({:.1f}s): {}"
+                .format(len(wall_times), time.time() - started, total,
+                        ' -> '.join(path)))
+
+        if failed or skipped:
+            raise RuntimeError('Failed targets: {}. Skipped targets: {}'
+                    .format(', '.join(sorted(failed)) or 'none',
+                            ', '.join(sorted(skipped)) or 'none'))
+        return wall_times
+
+
+if __name__ == '__main__':
+    app = CronGDWRun()
+    app.run()
@@ -0,0 +1,259 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from os import path
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, TCPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, TCPServer
+from cmdlineutil import CronJob
+import de_common.scriptutil as scriptutil
+from mgoutils.catalog import catalog, METADATA_DIRECTORY
+from load import GDWLoad
+from delete import GDWDelete
+from transform import run_transform
+
+__author__ = 'jvalenzuela'
+DISPLAY_NAME = scriptutil.get_display_name(__file__)
+TOOL_NAME = scriptutil.get_tool_name(DISPLAY_NAME)
+_logger = logging.getLogger(TOOL_NAME)
+
+
+class CronGDWService(CronJob):
+    def __init__(self):
+        super(CronGDWService, self).__init__()
+        self.config = self.props
+
+    name = TOOL_NAME
+    display_name = DISPLAY_NAME
+
+    options = [
+        (('-H', '--host'), dict(type=str, dest='host', default='127.0.0.1')),
+        (('-P', '--port'), dict(type=int, dest='port', default=8765)),
+        (('-u', '--socket'), dict(type=str, dest='socket', default=None)),
+        (('-i', '--interval'), dict(type=float, dest='interval', default=5))]
+
+    def _run_impl(self):
+        catalog.configure(self.config)
+        service = GDWService(self.config)
+        watcher = GDWMetadataWatcher(service, interval=self.opts.interval)
+        watcher.start()
+        if self.opts.socket:
+            server = UnixHTTPServer(self.opts.socket, GDWRequestHandler)
+            _logger.info("Listening on {}".format(self.opts.socket))
+        else:
+            server = ThreadingHTTPServer((self.opts.host, self.opts.port), GDWRequestHandler)
+            _logger.info("Listening on {}:{}".format(self.opts.host, self.opts.port))
+        server.service = service
+        try:
+            server.serve_forever()
+        finally:
+            watcher.stop()
+            server.server_close()
+            catalog.engines.dispose()
+
+
+# runs the requests with the warm catalog of the process: engines, reflected
+# tables and compiled plans are shared by all of them. the tables altered
+# since are reflected again when a request comes and none is running, as a
+# running one may still look its tables up. a request is a json object with
+# the target, the
+# window (yesterday as of the request by default) and the options of the
+# command line:
+#   POST /load       {"target": "warehouse/sales", "start": "2018-03-01",
+#                     "end": "2018-03-02", "dry_run": false, "prepare": true}
+#   POST /transform  {"target": ..., "start": ..., "end": ..., "insert_table": ...}
+#                    without insert_table the response has the SQL statements
+#   POST /delete     {"target": ..., "start": ..., "end": ..., "dry_run": false}
+#   GET  /status
+class GDWService():
+    commands = ('load', 'transform', 'delete')
+
+    def __init__(self, config):
+        self.config = config
+        self.started = time.time()
+        self.requests = 0
+        self.running = 0
+        # metadata files changed since the catalog last reloaded them
+        self.changed = set()
+        self._lock = threading.Lock()
+
+    def reload(self, changed):
+        with self._lock:
+            self.changed.update(changed)
+
+    # the target of a request must have an alias or a transform file
+    def known(self, alias_name):
+        return (alias_name in catalog.alias_names('alias')
+                or alias_name in catalog.alias_names('transform'))
+
+    def load(self, request):
+        gdw_load = GDWLoad(
+                request['target'], self.config,
+                request.get('start'),
+                request.get('end'),
+                swap=request.get('swap', False),
+                watermark=request.get('watermark', False))
+        gdw_load.run(
+                dry_run=request.get('dry_run', False),
+                prepare=request.get('prepare', False))
+
+    def transform(self, request):
+        statements = run_transform(
+                request['target'], self.config,
+                request.get('start'),
+                request.get('end'),
+                insert_table=request.get('insert_table'))
+        if statements:
+            return {'sql': statements}
+
+    def delete(self, request):
+        gdw_delete = GDWDelete(
+                request['target'],
+                request.get('start'),
+                request.get('end'))
+        gdw_delete.run(dry_run=request.get('dry_run', False))
+
+    def status(self):
+        return {
+                'uptime': round(time.time() - self.started, 1),
+                'requests': self.requests,
+                'running': self.running,
+                'aliases': len(catalog.aliases),
+                'plans': len(catalog.plans),
+                'tables': len(catalog.metadata.tables)}
+
+    def handle(self, command, request):
+        started = time.time()
+        with self._lock:
+            self.requests += 1
+            # changed metadata files are read and tables altered since the
+            # last request reflected again, only when no other request is
+            # running. none starts meanwhile
+            if not self.running:
+                if self.changed:
+                    _logger.info("Reloading metadata: {}".format(', '.join(sorted(self.changed))))
+                    catalog.reload(self.changed)
+                    self.changed = set()
+                stale = catalog.refresh()
+                if stale:
+                    _logger.info("Tables changed: {}".format(', '.join(sorted(stale))))
+            self.running += 1
+        try:
+            result = getattr(self, command)(request) or {}
+        finally:
+            with self._lock:
+                self.running -= 1
+        result['seconds'] = round(time.time() - started, 3)
+        return result
+
+
+class GDWRequestHandler(BaseHTTPRequestHandler):
+    def respond(self, code, body):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        if self.path.strip('/') == 'status':
+            self.respond(200, self.server.service.status())
+        else:
+            self.respond(404, {'status': 'error', 'error': 'unknown path'})
+
+    def do_POST(self):
+        command = self.path.strip('/')
+        if command not in GDWService.commands:
+            self.respond(404, {'status': 'error', 'error': 'unknown command'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            request = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+        except ValueError as e:
+            self.respond(400, {'status': 'error', 'error': str(e)})
+            return
+
+        target = request.get('target') if isinstance(request, dict) else None
+        if not target:
+            self.respond(400, {'status': 'error', 'error': 'missing target'})
+            return
+        if not self.server.service.known(target):
+            self.respond(400, {'status': 'error', 'error': 'unknown target {}'.format(target)})
+            return
+
+        try:
+            result = self.server.service.handle(command, request)
+        except Exception as e:
+            _logger.exception("{} of {} failed".format(command, request.get('target')))
+            self.respond(500, {'status': 'error', 'error': str(e)})
+        else:
+            result['status'] = 'ok'
+            self.respond(200, result)
+
+    def log_message(self, format, *args):
+        _logger.info(format % args)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if path.exists(self.server_address):
+            os.remove(self.server_address)
+        TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+    def get_request(self):
+        request, _ = self.socket.accept()
+        return request, ('local', 0)
+
+
+# polls the metadata directory and tells the service which files changed
+class GDWMetadataWatcher(threading.Thread):
+    def __init__(self, service, interval=5):
+        super(GDWMetadataWatcher, self).__init__()
+        self.service = service
+        self.daemon = True
+        self.interval = interval
+        self._stopped = threading.Event()
+        self.mtimes = self.scan()
+
+    def scan(self):
+        mtimes = {}
+        for directory, _, file_names in os.walk(METADATA_DIRECTORY):
+            for file_name in file_names:
+                if file_name.endswith('.yaml'):
+                    file_path = path.join(directory, file_name)
+                    mtimes[path.relpath(file_path, METADATA_DIRECTORY)] = path.getmtime(file_path)
+        return mtimes
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            mtimes = self.scan()
+            changed = [
+                    file_name
+                    for file_name in set(mtimes) | set(self.mtimes)
+                    if mtimes.get(file_name) != self.mtimes.get(file_name)]
+            self.mtimes = mtimes
+            if changed:
+                self.service.reload(changed)
+
+    def stop(self):
+        self._stopped.set()
+
+
+if __name__ == '__main__':
+    app = CronGDWService()
+    app.run()
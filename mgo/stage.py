@@ -0,0 +1,165 @@
+import gzip
+import logging
+import time
+import datetime
+from os import path
+from multiprocessing.pool import ThreadPool
+from cmdlineutil import CronJob
+import de_common.scriptutil as scriptutil
+from mgoutils.catalog import catalog
+from mgoutils.copyutils import CopyReader, copy_from_stream
+from mgoutils.dateutils import default_start, default_end, parse_date, range_days, window_params
+from mgoutils.sqlcache import CompiledStatement
+from delete import GDWDelete
+
+__author__ = 'jvalenzuela'
+DISPLAY_NAME = scriptutil.get_display_name(__file__)
+TOOL_NAME = scriptutil.get_tool_name(DISPLAY_NAME)
+_logger = logging.getLogger(TOOL_NAME)
+
+
+class CronGDWStage(CronJob):
+    def __init__(self):
+        super(CronGDWStage, self).__init__()
+        self.config = self.props
+        self.target_alias = self.opts.target
+
+    name = TOOL_NAME
+    display_name = DISPLAY_NAME
+
+    options = [
+        (('-t', '--target'), dict(type=str, dest='target', required=True)),
+        (('-s', '--start'), dict(type=str, dest='start_datetime', required=False)),
+        (('-e', '--end'), dict(type=str, dest='end_datetime', required=False)),
+        (('-y', '--system'), dict(type=str, dest='source_system', default=None)),
+        (('-j', '--parallel'), dict(type=int, dest='parallel', default=4)),
+        (('-d', '--dry-run'), dict(type=bool, dest='dry_run', default=False))]
+
+    def _run_impl(self):
+        catalog.configure(self.config)
+        gdw_stage = GDWStage(
+                self.target_alias,
+                self.opts.start_datetime,
+                self.opts.end_datetime,
+                source_system=self.opts.source_system,
+                parallel=self.opts.parallel)
+        gdw_stage.run(dry_run=self.opts.dry_run)
+
+
+# load the PSA extract files of a stage area alias with COPY. the alias says
+# where its files are:
+#   psa:
+#       system: chase
+#       table: RACT0010     # defaults to the alias table
+#       header: false
+# every date is loaded in a transaction of its own, on its own connection:
+# the delete of that date and the COPY of its file, so a bad file leaves
+# its date as it was. dates load in parallel. a stage alias deleting
+# everything loads the whole window in one transaction instead
+class GDWStage():
+    def __init__(self, target_alias_name, start=None, end=None,
+                 source_system=None, parallel=4):
+        self.target_alias = catalog.aliases[target_alias_name]
+        self.target_table = self.target_alias.sql_table
+        self.start = parse_date(start or default_start())
+        self.end = parse_date(end or default_end())
+        self.parallel = parallel
+
+        psa = self.target_alias.get('psa', {})
+        self.source_system = source_system or psa.get('system')
+        if not self.source_system:
+            raise RuntimeError('No PSA system given for {}'.format(self.target_alias.name))
+        self.source_table = psa.get('table', self.target_alias['table'])
+        self.header = psa.get('header', False)
+
+    @property
+    def engine(self):
+        return catalog.engine_from_alias(self.target_alias.name)
+
+    # (day, file name) of every date of the window, None if it has no file
+    def stage_files(self):
+        for day in range_days(self.start, self.end):
+            file_name = catalog.stage_file(self.source_system, self.source_table, day)
+            if path.exists(file_name):
+                yield day, file_name
+            else:
+                _logger.warning("No PSA file {}".format(file_name))
+                yield day, None
+
+    def delete(self, raw_connection, start, end):
+        gdw_delete = GDWDelete(self.target_alias.name, start, end)
+        window = window_params(start, end)
+        cursor = raw_connection.cursor()
+        try:
+            for delete_sql in gdw_delete.generate_delete():
+                _logger.info("Executing DELETE process in database")
+                statement = CompiledStatement.compile('DELETE', delete_sql, self.engine)
+                cursor.execute(statement.sql, statement.bind(window))
+        finally:
+            cursor.close()
+
+    def load_file(self, raw_connection, file_name):
+        columns = self.target_table.column_names
+        with gzip.open(file_name, 'rb') as stream:
+            reader = CopyReader(stream, len(columns), file_name, header=self.header)
+            copy_from_stream(raw_connection, self.target_table, columns, reader)
+        _logger.info(reader.report())
+        return reader.rows, reader.bytes, reader.elapsed
+
+    # delete [start, end] and copy the files in one transaction
+    def load_window(self, start, end, file_names):
+        raw_connection = self.engine.raw_connection()
+        try:
+            self.delete(raw_connection, start, end)
+            results = [self.load_file(raw_connection, file_name)
+                       for file_name in file_names]
+            raw_connection.commit()
+        except Exception:
+            raw_connection.rollback()
+            raise
+        finally:
+            raw_connection.close()
+        return results
+
+    def load_day(self, day_file):
+        day, file_name = day_file
+        day_start = datetime.datetime.combine(day.date(), datetime.time())
+        day_end = day_start + datetime.timedelta(days=1, microseconds=-1)
+        return self.load_window(
+                max(day_start, self.start), min(day_end, self.end),
+                [file_name] if file_name else [])
+
+    def run(self, dry_run=False):
+        stage_files = list(self.stage_files())
+        file_names = [file_name for _, file_name in stage_files if file_name]
+        if dry_run:
+            for file_name in file_names:
+                _logger.info("Dry run. {} not loaded into {}"
+                        .format(file_name, self.target_table))
+            return
+
+        started = time.time()
+        if GDWDelete(self.target_alias.name).deletes_everything:
+            results = self.load_window(self.start, self.end, file_names)
+        else:
+            pool = ThreadPool(self.parallel)
+            try:
+                results = sum(pool.map(self.load_day, stage_files), [])
+            finally:
+                pool.close()
+                pool.join()
+
+        rows = sum(r[0] for r in results)
+        size = sum(r[1] for r in results)
+        elapsed = max(time.time() - started, 1e-6)
+        _logger.info("Loaded {} rows ({:.1f} MB) from {} files into {} in {:.1f}s "
+                     "({:.0f} rows/s, {:.2f} MB/s)"
+                .format(rows, size / 1024.0 / 1024, len(file_names),
+                        self.target_table, elapsed,
+                        rows / elapsed, size / elapsed / 1024 / 1024))
+        return rows
+
+
+if __name__ == '__main__':
+    app = CronGDWStage()
+    app.run()
@@ -1,12 +1,17 @@
 import logging
-import yaml
+from collections import namedtuple
 from cmdlineutil import CronJob
 import de_common.scriptutil as scriptutil
 from mgoutils.catalog import GDWTable, catalog
-from mgoutils.merges import find_joins, merge_tables
-from mgoutils.sqlutils import compile_sql
-from mgoutils.dateutils import DEFAULT_START, DEFAULT_END, filter_date_range, parse_date
-from sqlalchemy import text
+from mgoutils.merges import merge_tables, join_columns
+from mgoutils.validation import MATERIALIZE_KINDS
+from mgoutils.sqlutils import compile_sql, CreateTableAs, table_identifier
+from mgoutils.dateutils import default_start, default_end, filter_date_range, parse_date, window_params
+from mgoutils.instrument import GDWInstrument
+from mgoutils.federation import GDWFederation
+from mgoutils.sqlcache import CompiledStatement
+from mgoutils.state import STATE_AREA
+from sqlalchemy import Column, text
 from sqlalchemy.sql import select, literal_column, and_
 import sqlalchemy
 
@@ -33,48 +38,108 @@ class CronGDWTransform(CronJob):
 
     def _run_impl(self):
         catalog.configure(self.config)
-        gdw_transform = GDWTransform(
+        statements = run_transform(
                 self.target_alias, self.config,
                 self.opts.start_datetime,
-                self.opts.end_datetime)
-        sql = gdw_transform.generate_sql()
-        engine = gdw_transform.engine
-
-        if self.opts.insert_table:
-            schema, table_name = self.opts.insert_table.split('.')
-            target_table = GDWTable(
-                    table_name,
-                    catalog.metadata,
-                    schema=schema,
-                    autoload=True,
-                    autoload_with=engine
-                    )
-
-            insert_sql = (
-                    target_table
-                    .insert()
-                    .from_select(gdw_transform.col_names(), sql))
-            _logger.info("Executing INSERT process in database")
-            engine.execute(insert_sql.execution_options(autocommit=True))
-        else:
-            _logger.info("Dry run. SQL statement not run:")
-            print(compile_sql(sql, engine))
+                self.opts.end_datetime,
+                insert_table=self.opts.insert_table)
+        for statement in statements:
+            print(statement)
+
+
+# insert the transform of target_alias_name into insert_table (schema.table).
+# when no table is given nothing runs and the SQL statements are returned
+def run_transform(target_alias_name, config, start=None, end=None, insert_table=None):
+    gdw_transform = GDWTransform(target_alias_name, config, start, end)
+    local_tables = {}
+    if gdw_transform.target_alias.area:
+        local_tables = GDWFederation(
+                target_alias_name,
+                gdw_transform.start,
+                gdw_transform.end).run(dry_run=not insert_table)
+    with catalog.table_scope(
+            target_alias_name, local_tables, gdw_transform.target_alias.engine):
+        return execute_transform(gdw_transform, insert_table)
+
+
+def execute_transform(gdw_transform, insert_table=None):
+    target_alias_name = gdw_transform.target_alias.name
+    sql = gdw_transform.generate_sql()
+    engine = gdw_transform.engine
+
+    if insert_table:
+        schema, table_name = insert_table.split('.')
+        target_table = GDWTable(
+                table_name,
+                catalog.metadata,
+                schema=schema,
+                autoload=True,
+                autoload_with=engine
+                )
+
+        insert_sql = (
+                target_table
+                .insert()
+                .from_select(gdw_transform.col_names(), sql))
+        _logger.info("Executing INSERT process in database")
+        instrument = GDWInstrument(target_alias_name)
+        window = window_params(gdw_transform.start, gdw_transform.end)
+        # materialized temp tables only live in the connection building them
+        with engine.connect() as connection:
+            for materialize_sql in gdw_transform.plan.materialized:
+                instrument.execute(
+                        CompiledStatement.compile('MATERIALIZE', materialize_sql, engine),
+                        connection, window)
+            instrument.execute(
+                    CompiledStatement.compile('INSERT', insert_sql, engine),
+                    connection, window)
+            for drop_sql in gdw_transform.plan.dropped:
+                instrument.execute(
+                        CompiledStatement.compile('DROP', drop_sql, engine),
+                        connection, window)
+        return []
+
+    _logger.info("Dry run. SQL statement not run:")
+    for window_filter in gdw_transform.plan.filters:
+        _logger.info("Date window on {}".format(window_filter))
+    return ([compile_sql(materialize_sql, engine)
+             for materialize_sql in gdw_transform.plan.materialized] +
+            [compile_sql(sql, engine)])
+
+
+# a compiled transform: every source, column, join and filter resolved once.
+# plans are cached in the catalog by (target, start, end, scope) so nested
+# transforms and repeated calls share the same sqlalchemy objects for the
+# whole run
+# materialized holds the statements building the materialized transforms it
+# reads (nested ones first) and table the table of its own, if materialized.
+# dropped the statements dropping the unlogged ones once the load is done.
+# filters says where the date window was placed, in it and its nested transforms
+GDWTransformPlan = namedtuple('GDWTransformPlan', [
+    'target', 'start', 'end', 'froms', 'columns', 'joins',
+    'where', 'group_by', 'having', 'sql', 'engine',
+    'materialized', 'table', 'filters', 'dropped'])
+
+GDWFrom = namedtuple('GDWFrom', [
+    'alias', 'select', 'where', 'merge_type',
+    'state_date_columns', 'is_deleted_clause', 'as_alias', 'how'])
 
 
 class GDWTransform(CronJob):
     def __init__(self, target_alias_name, config=None, start=None, end=None):
         self.target_alias = catalog.aliases[target_alias_name]
         self._transforms = None
-        self.start = parse_date(start or DEFAULT_START)
-        self.end = parse_date(end or DEFAULT_END)
+        self.start = parse_date(start or default_start())
+        self.end = parse_date(end or default_end())
 
     @property
     def transforms(self):
         if self._transforms is None:
-            with open(
-                    'metadata/{}.transform.yaml'
-                    .format(self.target_alias.name)) as f:
-                self._transforms = yaml.load(f)
+            transforms = catalog.read_metadata(
+                    '{}.transform.yaml'.format(self.target_alias.name))
+            if transforms is None:
+                raise IOError('No transform file for {}'.format(self.target_alias.name))
+            self._transforms = transforms
         return self._transforms
 
     @property
@@ -83,15 +148,193 @@ class GDWTransform(CronJob):
 
     @property
     def engine(self):
-        return catalog.engine_from_alias(self.from_used_alias_names())
+        return self.plan.engine
+
+    @property
+    def plan(self):
+        key = (self.target_alias.name, self.start, self.end, catalog.scope)
+        plan = catalog.plans.get(key)
+        if plan is None:
+            with catalog.lock:
+                plan = catalog.plans.get(key)
+                if plan is None:
+                    plan = self.compile()
+                    catalog.plans[key] = plan
+        return plan
+
+    # transforms without a table are inlined as a subquery by default. with
+    # materialize: temp or unlogged they are built once per load into a table
+    # that is indexed on its relationship join columns and analyzed
+    @property
+    def materialize(self):
+        materialize = self.transforms.get('materialize', 'inline')
+        if materialize not in MATERIALIZE_KINDS:
+            raise RuntimeError('Unknown materialize {} for {}'
+                    .format(materialize, self.target_alias.name))
+        if materialize != 'inline' and not self.target_alias.is_transform:
+            raise RuntimeError('Only transforms without a table can be materialized: {}'
+                    .format(self.target_alias.name))
+        return materialize
+
+    # temp tables only live in the connection of the load. unlogged ones are
+    # named after the load reading them too (the scope of the catalog), so
+    # two targets loaded at once never drop each other's table, and dropped
+    # after its last statement
+    def materialized_table(self, columns):
+        name = self.target_alias.name.replace('/', '__')
+        if self.materialize == 'temp':
+            return GDWTable(name, sqlalchemy.MetaData(),
+                            *[Column(c) for c in columns])
+        if catalog.scope:
+            name = table_identifier('{}__{}'.format(catalog.scope.replace('/', '__'), name))
+        return GDWTable(name, sqlalchemy.MetaData(),
+                        *[Column(c) for c in columns],
+                        schema=catalog.areas[STATE_AREA]['schema'])
+
+    # join columns of the relationships with this transform, declared in its
+    # own alias file or in the alias files of the other side
+    def join_columns(self):
+        basename = self.target_alias.basename
+        relationships = catalog.relationships
+        columns = []
+        for related_name in sorted(relationships.neighbours.get(self.target_alias.name, ())):
+            relationship = relationships.relationship(self.target_alias.name, related_name)
+            columns += [c for c in join_columns(relationship['join_on'], basename)
+                        if c not in columns]
+        return columns
+
+    def generate_materialize(self, query, columns):
+        table = self.materialized_table(columns)
+        statements = []
+        if self.materialize == 'temp':
+            statements.append(text('DROP TABLE IF EXISTS pg_temp.{};'.format(table.name)))
+            statements.append(CreateTableAs(table, query, prefix='TEMPORARY'))
+        else:
+            statements.append(text('CREATE SCHEMA IF NOT EXISTS {};'.format(table.schema)))
+            statements.append(text('DROP TABLE IF EXISTS {};'.format(table)))
+            statements.append(CreateTableAs(table, query, prefix='UNLOGGED'))
+        for column in self.join_columns():
+            if column in columns:
+                statements.append(text('CREATE INDEX ON {} ({});'.format(table, column)))
+        statements.append(text('ANALYZE {};'.format(table)))
+        return table, statements
+
+    # where the window filters on date.modified go. only the driving from is
+    # filtered, the joined ones keep all their rows:
+    # - a single source, in the where of the transform
+    # - every branch of an union
+    # - every source of a modifications merge, when finding the changed keys
+    def window_filters(self, froms):
+        driving_from = froms[0]
+        if driving_from.merge_type == 'modifications':
+            placement = 'in the changed keys of {}'.format(driving_from.as_alias)
+        elif len(driving_from.alias) > 1:
+            placement = 'on its branch of the union {}'.format(driving_from.as_alias)
+        else:
+            placement = 'in the where of {}'.format(self.target_alias.name)
+
+        filters = []
+        for alias_name in driving_from.alias:
+            alias = catalog.aliases[alias_name]
+            if alias.modified_date_column:
+                filters.append('{}.{} {}'.format(
+                        alias_name, alias.modified_date_column, placement))
+        return filters
+
+    def compile(self):
+        self.materialized = []
+        self.dropped = []
+        self.filters = []
+        froms, joins = self.resolve_joins(self.resolve_from_definitions())
+        self.filters += self.window_filters(froms)
+        columns = tuple(self.col_names_expressions(froms))
+        from_clause = self.generate_from(froms, joins)
+        where_clause = self.generate_where(from_clause, froms)
+        group_by_clause = self.generate_group_by()
+        having_clause = self.generate_having()
+
+        query = (
+                select(self.generate_select(columns))
+                .select_from(from_clause))
+        if where_clause is not None:
+                query = query.where(where_clause)
+        if group_by_clause is not None:
+                query = query.group_by(group_by_clause)
+        if having_clause is not None:
+                query = query.having(having_clause)
+
+        engine = catalog.engine_from_alias(
+                [alias for f in froms for alias in f.alias])
+
+        table = None
+        if self.materialize != 'inline':
+            table, statements = self.generate_materialize(
+                    query, [column_name for column_name, _ in columns])
+            self.materialized += statements
+            if self.materialize == 'unlogged':
+                self.dropped.append(text('DROP TABLE IF EXISTS {};'.format(table)))
+
+        return GDWTransformPlan(
+                target=self.target_alias.name,
+                start=self.start,
+                end=self.end,
+                froms=froms,
+                columns=columns,
+                joins=joins,
+                where=where_clause,
+                group_by=group_by_clause,
+                having=having_clause,
+                sql=query,
+                engine=engine,
+                materialized=tuple(self.materialized),
+                table=table,
+                filters=tuple(self.filters),
+                dropped=tuple(self.dropped))
 
     def from_definitions(self):
-        """convert this part of the from into a dictionary
-        we want to have these fields in the dictionary
+        return self.plan.froms
+
+    # the relationship of every part of the from with the ones joined before
+    # it, see GDWRelationshipGraph. the bridge aliases a relationship goes
+    # through are added to the from, joined like the part that needs them
+    def resolve_joins(self, froms):
+        steps = catalog.relationships.joins([f.as_alias for f in froms])
+        by_alias = dict((f.as_alias, f) for f in froms)
+        resolved_froms = [froms[0]]
+        joins = []
+        bridges = []
+        for alias_name, relationship, bridge in steps:
+            if bridge:
+                bridges.append((alias_name, relationship))
+                continue
+            from_definition = by_alias[alias_name]
+            for bridge_name, bridge_relationship in bridges:
+                resolved_froms.append(self.bridge_from(bridge_name, from_definition.how))
+                joins.append(bridge_relationship)
+            bridges = []
+            resolved_froms.append(from_definition)
+            joins.append(relationship)
+        return tuple(resolved_froms), tuple(joins)
+
+    def bridge_from(self, alias_name, how):
+        alias = catalog.aliases[alias_name]
+        return GDWFrom(
+                alias=(alias_name,),
+                select=sqlalchemy.alias(alias.sql_table, alias.basename),
+                where=alias.where,
+                merge_type='union all',
+                state_date_columns=alias.state_date_columns,
+                is_deleted_clause=alias.is_deleted_column,
+                as_alias=alias_name,
+                how=how)
+
+    def resolve_from_definitions(self):
+        """convert each part of the from into a GDWFrom
+        we want to have these fields in the definition
         - alias(list of alias)
         - how(how to merge the source alias. Could be union, union_all, etc.)
         - as(rename to a different name. you will use this name in the select part)"""
-        def get_alias_dict(single_from):
+        def get_alias_dict(single_from, driving):
             if isinstance(single_from, str):
                 single_from = {
                         'alias': [single_from],
@@ -103,23 +346,36 @@ class GDWTransform(CronJob):
                         'how': 'inner',
                         'as': single_from[0]}
             elif isinstance(single_from['alias'], str):
-                single_from['alias'] = [single_from['alias']]
+                # the definitions are shared with the catalog, never changed
+                single_from = dict(single_from, alias=[single_from['alias']])
 
             alias_names = single_from['alias']
 
-            # if some aliases have no table, try to get the transform sql as
-            # we allow to specify either existing tables or other transforms
-            # then save it to the catalog so we can use it as normal
+            # if some aliases have no table, use the compiled plan of their
+            # transform as we allow to specify either existing tables or other
+            # transforms. then save it to the catalog, in the scope of the
+            # load, so we can use it as normal
             for alias in alias_names:
-                if catalog.aliases[alias].sql_table is None:
-                    gdw_transform = GDWTransform(
+                if catalog.aliases[alias].is_transform:
+                    nested_plan = GDWTransform(
                             alias, catalog.config,
                             self.start,
-                            self.end)
-                    sql_table = gdw_transform.generate_sql()
-                    catalog.aliases[alias].sql_table = sql_table
-                    catalog.aliases[alias].engine = gdw_transform.engine
-                # TODO filter the date range
+                            self.end).plan
+                    # a materialized transform read twice is still built once
+                    built = set(id(statement) for statement in self.materialized)
+                    self.materialized += [
+                            statement for statement in nested_plan.materialized
+                            if id(statement) not in built]
+                    dropped = set(id(statement) for statement in self.dropped)
+                    self.dropped += [
+                            statement for statement in nested_plan.dropped
+                            if id(statement) not in dropped]
+                    catalog.set_scoped_table(
+                            alias,
+                            nested_plan.table if nested_plan.table is not None
+                            else nested_plan.sql,
+                            nested_plan.engine)
+                    self.filters += [f for f in nested_plan.filters if f not in self.filters]
 
             aliases = [catalog.aliases[a] for a in alias_names]
 
@@ -134,105 +390,113 @@ class GDWTransform(CronJob):
                         merge_type,
                         by=single_from.get('by'),
                         as_alias=as_alias,
-                        start=self.start, end=self.end)
+                        start=self.start, end=self.end,
+                        push_window=driving)
                 where = None
             else:
                 as_alias = single_from.get('as', alias_names[0])
                 rename_to = as_alias.split('/')[-1]
-                source_sql = sqlalchemy.alias(aliases[0].sql_table, rename_to),
+                source_sql = sqlalchemy.alias(aliases[0].sql_table, rename_to)
                 where = aliases[0].where
                 state_date_columns = aliases[0].state_date_columns
                 is_deleted_clause = aliases[0].is_deleted_column
 
-            return {
-                    'alias': alias_names,
-                    'select': source_sql,
-                    'where': where,
-                    'merge_type': merge_type,
-                    'state_date_columns': state_date_columns,
-                    'is_deleted_clause': is_deleted_clause,
-                    'as': as_alias,
-                    'how': single_from.get('how', 'inner'),
-                    }
+            return GDWFrom(
+                    alias=tuple(alias_names),
+                    select=source_sql,
+                    where=where,
+                    merge_type=merge_type,
+                    state_date_columns=state_date_columns,
+                    is_deleted_clause=is_deleted_clause,
+                    as_alias=as_alias,
+                    how=single_from.get('how', 'inner'))
 
-        if not isinstance(self.transforms['from'], list):
-            self.transforms['from'] = [self.transforms['from']]
+        froms = self.transforms['from']
+        if not isinstance(froms, list):
+            froms = [froms]
 
-        for t in self.transforms['from']:
-            result = get_alias_dict(t)
-            yield result
+        return tuple(
+                get_alias_dict(t, driving=(pos == 0))
+                for pos, t in enumerate(froms))
 
     def from_used_alias_names(self):
-        return [alias for i in self.from_definitions() for alias in i['alias']]
+        return [alias for i in self.from_definitions() for alias in i.alias]
+
+    def col_names_expressions(self, from_definitions=None):
+        if from_definitions is None:
+            for column in self.plan.columns:
+                yield column
+            return
 
-    def col_names_expressions(self):
         for c in self.transforms['select']:
             column_name = c.keys()[0]
             column_expression = c.values()[0]
             yield column_name, column_expression
 
-        from_definitions = list(self.from_definitions())
         driving_from = from_definitions[0]
-        driving_alias_name = driving_from['as']
+        driving_alias_name = driving_from.as_alias
 
-        state_date_columns = driving_from['state_date_columns']
+        state_date_columns = driving_from.state_date_columns
         if state_date_columns:
             yield 'gdw_state_start', '{}.{}'.format(driving_alias_name, state_date_columns[0])
             yield 'gdw_state_end', '{}.{}'.format(driving_alias_name, state_date_columns[1])
 
-        is_deleted_clause = driving_from['is_deleted_clause']
+        is_deleted_clause = driving_from.is_deleted_clause
         if state_date_columns:
             yield 'gdw_is_deleted', is_deleted_clause
 
     def col_names(self):
         return [i[0] for i in self.col_names_expressions()]
 
-    def generate_from(self):
-        from_definitions = list(self.from_definitions())
-        aliases = [catalog.aliases[f['as']] for f in from_definitions]
-        joins = [join['join_on'] for join in find_joins(aliases)]
-        from_clause = from_definitions[0]['select']
+    def generate_from(self, from_definitions=None, joins=None):
+        if from_definitions is None:
+            from_definitions = self.plan.froms
+            joins = self.plan.joins
+        from_clause = from_definitions[0].select
 
         for from_definition, join in zip(from_definitions[1:], joins):
-            alias = catalog.aliases[from_definition['as']]
-            on_clause = text(join)
+            alias = catalog.aliases[from_definition.as_alias]
+            on_clause = text(join['join_on'])
             if alias.where:
                 on_clause = and_(on_clause, alias.where)
             from_clause = from_clause.join(
-                    from_definition['select'],
+                    from_definition.select,
                     onclause=on_clause,
-                    isouter=from_definition['how'])
+                    isouter=from_definition.how)
         return from_clause
 
-    def generate_select(self):
+    def generate_select(self, columns=None):
+        if columns is None:
+            columns = self.plan.columns
         result = []
-        for column_name, column_expression in self.col_names_expressions():
+        for column_name, column_expression in columns:
             result.append(
                     literal_column(column_expression)
                     .label(column_name))
         return result
 
-    def generate_where(self, from_clause):
+    def generate_where(self, from_clause, from_definitions=None):
+        if from_definitions is None:
+            from_definitions = self.plan.froms
         filters = []
 
         transform_where = self.transforms.get('where')
         if transform_where:
             filters.append(text(transform_where))
 
-        from_definitions = list(self.from_definitions())
         driving_from = from_definitions[0]
-        driving_alias_name = driving_from['alias']
-        if len(driving_alias_name) == 1 and driving_from['merge_type'] != 'modifications':
+        driving_alias_name = driving_from.alias
+        if len(driving_alias_name) == 1 and driving_from.merge_type != 'modifications':
             driving_alias_name = driving_alias_name[0]
             driving_alias = catalog.aliases[driving_alias_name]
             if driving_alias.where is not None:
                 filters.append(driving_alias.where)
 
             if driving_alias.modified_date_column:
-                modification_date = driving_from['select'].c[driving_alias.modified_date_column]
+                modification_date = driving_from.select.c[driving_alias.modified_date_column]
                 filter_modifications = filter_date_range(
                         from_clause.corresponding_column(modification_date),
-                        self.start, self.end)
+                        self.start, self.end, source=driving_alias_name)
                 filters.append(filter_modifications)
 
         if filters:
@@ -253,25 +517,7 @@ class GDWTransform(CronJob):
             return None
 
     def generate_sql(self):
-        select_clause = self.generate_select()
-        from_clause = self.generate_from()
-        query = (
-                select(select_clause)
-                .select_from(from_clause))
-
-        where_clause = self.generate_where(from_clause)
-        if where_clause is not None:
-                query = query.where(where_clause)
-
-        group_by_clause = self.generate_group_by()
-        if group_by_clause is not None:
-                query = query.group_by(group_by_clause)
-
-        having_clause = self.generate_having()
-        if having_clause is not None:
-                query = query.having(having_clause)
-
-        return query
+        return self.plan.sql
 
 
 if __name__ == '__main__':
@@ -1,6 +1,10 @@
 from cmdlineutil.tieredconfig import load_tiered_config
+import os
+import shutil
 import sys
+import tempfile
 from os.path import abspath, dirname, join, pardir
+import yaml
 import pandas as pd
 from nose.tools import with_setup
 from contextlib import contextmanager
@@ -14,6 +18,39 @@ from transform import CronGDWTransform
 
 CONFIG_FILE = abspath(join(dirname(__file__), pardir,
                            'tieredconf', 'secrets.properties'))
+METADATA_DIRECTORY = abspath(join(dirname(__file__), pardir, 'metadata'))
+
+
+# the catalog reads the metadata directory of the working directory. this
+# gives it a temporary one with the areas and databases of the repository,
+# a testing area on the schema of setup_func and the given documents
+# ({file name relative to the metadata directory: content})
+@contextmanager
+def temp_metadata(documents):
+    directory = tempfile.mkdtemp(prefix='mgo_test_')
+    metadata_directory = join(directory, 'metadata')
+    shutil.copytree(METADATA_DIRECTORY, metadata_directory)
+    documents = dict(documents)
+    with open(join(METADATA_DIRECTORY, 'areas.yaml')) as f:
+        areas = yaml.safe_load(f)
+    areas['testing'] = {'database': 'bloodmoondb', 'schema': 'testing'}
+    documents.setdefault('areas.yaml', areas)
+    for file_name, document in documents.items():
+        file_path = join(metadata_directory, file_name)
+        if not os.path.isdir(dirname(file_path)):
+            os.makedirs(dirname(file_path))
+        with open(file_path, 'w') as f:
+            yaml.safe_dump(document, f, default_flow_style=False)
+
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        catalog.__init__()
+        yield catalog
+    finally:
+        os.chdir(cwd)
+        catalog.__init__()
+        shutil.rmtree(directory, ignore_errors=True)
 
 
 def setup_func():
@@ -0,0 +1,11 @@
+from mgoutils.catalog import GDWPlanCache
+
+
+def test_plan_cache_drops_the_least_recently_used():
+    plans = GDWPlanCache(maxsize=2)
+    plans['a'] = 1
+    plans['b'] = 2
+    assert plans.get('a') == 1
+    plans['c'] = 3
+    assert list(plans) == ['a', 'c']
+    assert plans.get('b') is None
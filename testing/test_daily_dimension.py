@@ -0,0 +1,115 @@
+import datetime
+from nose.tools import with_setup, assert_raises
+from sqlalchemy.exc import DBAPIError
+from testing import setup_func, teardown_func, temp_metadata, CONFIG_FILE
+from cmdlineutil.tieredconfig import load_tiered_config
+from load import GDWLoad
+
+D = datetime.datetime
+DAY_1, DAY_2, DAY_3 = datetime.date(2018, 3, 1), datetime.date(2018, 3, 2), datetime.date(2018, 3, 3)
+
+METADATA = {
+    'testing/customer_snapshot.alias.yaml': {
+        'area': 'testing',
+        'table': 'customer_snapshot'},
+    'testing/customer.alias.yaml': {
+        'area': 'testing',
+        'table': 'customer',
+        'load': {
+            'how': 'dimension',
+            'type': 'daily',
+            'object_key': 'customer_id'}},
+    'testing/customer.transform.yaml': {
+        'from': 'testing/customer_snapshot',
+        'select': [
+            {'customer_id': 'customer_snapshot.customer_id'},
+            {'segment': 'customer_snapshot.segment'}]}}
+
+TABLES = """
+CREATE TABLE testing.customer_snapshot (customer_id int, segment text);
+CREATE TABLE testing.customer (
+    customer_id int, segment text, gdw_row_hash text,
+    gdw_valid_from date, gdw_valid_to date);
+"""
+
+
+def load_day(config, engine, day, snapshot):
+    engine.execute('TRUNCATE TABLE testing.customer_snapshot')
+    for customer_id, segment in snapshot:
+        engine.execute('INSERT INTO testing.customer_snapshot VALUES (%s, %s)',
+                       customer_id, segment)
+    start = D.combine(day, datetime.time())
+    GDWLoad('testing/customer', config, start,
+            start + datetime.timedelta(days=1, microseconds=-1)).run()
+
+
+def versions(engine):
+    return engine.execute(
+            'SELECT customer_id, segment, gdw_valid_from, gdw_valid_to '
+            'FROM testing.customer ORDER BY customer_id, gdw_valid_from').fetchall()
+
+
+def as_of(engine, day):
+    return engine.execute(
+            'SELECT customer_id, segment FROM testing.customer_as_of(%s) '
+            'ORDER BY customer_id', day).fetchall()
+
+
+@with_setup(setup_func, teardown_func)
+def test_daily_unchanged_changed_and_deleted_days():
+    config = load_tiered_config(CONFIG_FILE)
+    with temp_metadata(METADATA) as catalog:
+        catalog.configure(config)
+        engine = catalog.engines['bloodmoondb']
+        engine.execute(TABLES)
+
+        load_day(config, engine, DAY_1, [(1, 'retail'), (2, 'retail')])
+        # nothing changed, nothing written
+        load_day(config, engine, DAY_2, [(1, 'retail'), (2, 'retail')])
+        assert versions(engine) == [
+                (1, 'retail', DAY_1, None),
+                (2, 'retail', DAY_1, None)]
+
+        # customer 1 changes, customer 2 is missing from the snapshot
+        load_day(config, engine, DAY_3, [(1, 'wholesale')])
+        assert versions(engine) == [
+                (1, 'retail', DAY_1, DAY_3),
+                (1, 'wholesale', DAY_3, None),
+                (2, 'retail', DAY_1, DAY_3)]
+        assert as_of(engine, DAY_2) == [(1, 'retail'), (2, 'retail')]
+        assert as_of(engine, DAY_3) == [(1, 'wholesale')]
+
+
+@with_setup(setup_func, teardown_func)
+def test_daily_last_day_again_replaces_it():
+    config = load_tiered_config(CONFIG_FILE)
+    with temp_metadata(METADATA) as catalog:
+        catalog.configure(config)
+        engine = catalog.engines['bloodmoondb']
+        engine.execute(TABLES)
+
+        load_day(config, engine, DAY_1, [(1, 'retail'), (2, 'retail')])
+        load_day(config, engine, DAY_2, [(1, 'wholesale')])
+        # the second snapshot was incomplete, customer 2 is back
+        load_day(config, engine, DAY_2, [(1, 'wholesale'), (2, 'retail')])
+        assert versions(engine) == [
+                (1, 'retail', DAY_1, DAY_2),
+                (1, 'wholesale', DAY_2, None),
+                (2, 'retail', DAY_1, None)]
+
+
+@with_setup(setup_func, teardown_func)
+def test_daily_earlier_day_is_refused():
+    config = load_tiered_config(CONFIG_FILE)
+    with temp_metadata(METADATA) as catalog:
+        catalog.configure(config)
+        engine = catalog.engines['bloodmoondb']
+        engine.execute(TABLES)
+
+        load_day(config, engine, DAY_1, [(1, 'retail')])
+        load_day(config, engine, DAY_2, [(1, 'wholesale')])
+        expected = versions(engine)
+        with assert_raises(DBAPIError):
+            load_day(config, engine, DAY_1, [(1, 'online')])
+        # the later history is untouched
+        assert versions(engine) == expected
@@ -0,0 +1,96 @@
+import datetime
+from sqlalchemy import Column, Date, DateTime
+from sqlalchemy.dialects import postgresql
+from mgoutils.dateutils import filter_date_range, range_chunks, align_to_chunks
+
+START = datetime.datetime(2018, 3, 1)
+END = datetime.datetime(2018, 3, 2, 23, 59, 59, 999999)
+
+
+def compile_filter(column, start, end):
+    return str(filter_date_range(column, start, end).compile(dialect=postgresql.dialect()))
+
+
+def test_filter_date_range_date_column_by_day():
+    sql = compile_filter(Column('sale_date', Date), START, END)
+    assert sql == 'sale_date BETWEEN CAST(%(gdw_start)s AS DATE) AND CAST(%(gdw_end)s AS DATE)'
+
+
+def test_filter_date_range_single_day_keeps_the_day():
+    # start == end used to be an equality, BETWEEN the same day is the same
+    sql = compile_filter(Column('sale_date', Date), START, START)
+    assert sql == 'sale_date BETWEEN CAST(%(gdw_start)s AS DATE) AND CAST(%(gdw_end)s AS DATE)'
+
+
+def test_filter_date_range_timestamp_column_full_window():
+    sql = compile_filter(Column('modified', DateTime), START, END)
+    assert sql == 'modified BETWEEN %(gdw_start)s AND %(gdw_end)s'
+
+
+def test_filter_date_range_open_ends():
+    assert compile_filter(Column('modified', DateTime), START, None) == 'modified >= %(gdw_start)s'
+    assert compile_filter(Column('modified', DateTime), None, END) == 'modified <= %(gdw_end)s'
+
+
+def test_filter_date_range_any_column():
+    sql = compile_filter([Column('created', DateTime), Column('modified', DateTime)], START, END)
+    assert sql == ('created BETWEEN %(gdw_start)s AND %(gdw_end)s'
+                   ' OR modified BETWEEN %(gdw_start)s AND %(gdw_end)s')
+
+
+def day_end(year, month, day):
+    return datetime.datetime(year, month, day, 23, 59, 59, 999999)
+
+
+def test_range_chunks_days():
+    chunks = list(range_chunks(START, END))
+    assert chunks == [(START, day_end(2018, 3, 1)),
+                      (datetime.datetime(2018, 3, 2), END)]
+
+
+def test_range_chunks_cut_to_the_window():
+    start = datetime.datetime(2018, 2, 27, 6)
+    end = datetime.datetime(2018, 3, 13, 12)
+    assert list(range_chunks(start, end, 'week')) == [
+            (start, day_end(2018, 3, 4)),
+            (datetime.datetime(2018, 3, 5), day_end(2018, 3, 11)),
+            (datetime.datetime(2018, 3, 12), end)]
+    assert list(range_chunks(start, end, 'month')) == [
+            (start, day_end(2018, 2, 28)),
+            (datetime.datetime(2018, 3, 1), end)]
+
+
+def test_range_chunks_less_than_a_day_apart():
+    # end is on the next day but less than 24 hours after start
+    start = datetime.datetime(2018, 3, 1, 6)
+    end = datetime.datetime(2018, 3, 2, 3)
+    assert list(range_chunks(start, end)) == [
+            (start, day_end(2018, 3, 1)),
+            (datetime.datetime(2018, 3, 2), end)]
+
+
+def test_range_chunks_single_day():
+    assert list(range_chunks(START, day_end(2018, 3, 1), 'month')) == [
+            (START, day_end(2018, 3, 1))]
+
+
+def test_filter_date_range_source_start():
+    sql = str(filter_date_range(Column('modified', DateTime), START, END, source='sales/orders')
+              .compile(dialect=postgresql.dialect()))
+    assert sql == 'modified BETWEEN %(gdw_start__sales_orders)s AND %(gdw_end)s'
+
+
+def test_align_to_chunks_whole_windows():
+    start = datetime.datetime(2018, 2, 27, 6)
+    end = datetime.datetime(2018, 3, 13, 12)
+    assert align_to_chunks(start, end) == (datetime.datetime(2018, 2, 27), day_end(2018, 3, 13))
+    # 2018-02-26 is a monday, 2018-03-18 a sunday
+    assert align_to_chunks(start, end, 'week') == (datetime.datetime(2018, 2, 26), day_end(2018, 3, 18))
+    assert align_to_chunks(start, end, 'month') == (datetime.datetime(2018, 2, 1), day_end(2018, 3, 31))
+
+
+def test_align_to_chunks_same_chunks_from_another_start():
+    end = day_end(2018, 3, 31)
+    first = list(range_chunks(*align_to_chunks(datetime.datetime(2018, 3, 7, 6), end, 'week')))
+    second = list(range_chunks(*align_to_chunks(datetime.datetime(2018, 3, 6), end, 'week')))
+    assert first == second
@@ -0,0 +1,41 @@
+import json
+from os.path import dirname, join
+from mgoutils.explain import estimated_rows, nested_loop_warnings, relation_names
+
+FIXTURES = join(dirname(__file__), 'fixtures')
+
+
+def read_plan(file_name):
+    with open(join(FIXTURES, file_name)) as f:
+        return json.load(f)[0]
+
+
+def test_nested_loop_over_an_append_on_the_inner_side():
+    # the union of sales.order_lines and archive.order_lines is scanned for
+    # every order, the union of channels is materialized once
+    plan = read_plan('nested_loop_union.json')
+    assert list(nested_loop_warnings(plan)) == [
+            'nested loop over the union of sales.order_lines, archive.order_lines']
+
+
+def test_nested_loop_over_a_subquery_scan():
+    plan = read_plan('nested_loop_union.json')
+    inner = plan['Plan']['Plans'][0]['Plans'][1]
+    plan['Plan']['Plans'][0]['Plans'][1] = {
+            'Node Type': 'Subquery Scan',
+            'Parent Relationship': 'Inner',
+            'Alias': 'order_lines',
+            'Plans': [dict(inner, **{'Parent Relationship': 'Subquery'})]}
+    assert list(nested_loop_warnings(plan)) == [
+            'nested loop over the union of sales.order_lines, archive.order_lines']
+
+
+def test_relation_names_in_plan_order():
+    plan = read_plan('nested_loop_union.json')
+    assert relation_names(plan['Plan']['Plans'][0]) == [
+            'sales.orders', 'sales.channels', 'sales.channels_archive',
+            'sales.order_lines', 'archive.order_lines']
+
+
+def test_estimated_rows_of_an_insert_are_its_input_rows():
+    assert estimated_rows(read_plan('nested_loop_union.json')) == 1520
@@ -0,0 +1,26 @@
+from testing import temp_metadata
+from mgoutils.federation import GDWFederation
+
+METADATA = {
+    'testing/orders.alias.yaml': {
+        'area': 'testing', 'table': 'orders', 'date': {'modified': 'modified'}},
+    'testing/customers.alias.yaml': {
+        'area': 'testing', 'table': 'customers', 'date': {'modified': 'modified'}},
+    'testing/returns.alias.yaml': {
+        'area': 'testing', 'table': 'returns', 'date': {'modified': 'modified'}},
+    'testing/order_returns.transform.yaml': {
+        'from': ['testing/returns', 'testing/orders'],
+        'select': [{'order_id': 'returns.order_id'}]},
+    'testing/sales.alias.yaml': {'area': 'testing', 'table': 'sales'},
+    'testing/sales.transform.yaml': {
+        'from': ['testing/order_returns', 'testing/customers'],
+        'select': [{'order_id': 'order_returns.order_id'}]}}
+
+
+def test_windowed_alias_names_only_the_driving_froms():
+    # customers is joined by sales and orders by order_returns, both are
+    # copied whole
+    with temp_metadata(METADATA):
+        federation = GDWFederation('testing/sales', None, None)
+        assert federation.windowed_alias_names() == set(
+                ['testing/order_returns', 'testing/returns'])
@@ -0,0 +1,52 @@
+from testing import temp_metadata
+from indexes import GDWIndexAdvisor
+
+METADATA = {
+    'testing/customer.alias.yaml': {
+        'area': 'testing',
+        'table': 'customer',
+        'date': {'modified': 'modified'},
+        'load': {'how': 'dimension', 'type': 'daily', 'object_key': 'customer_id'}}}
+
+
+def existing_index(columns, predicate=None, unique=False, method='btree'):
+    return {'name': '_'.join(columns), 'method': method, 'unique': unique,
+            'predicate': predicate, 'columns': list(columns)}
+
+
+# an advisor reading the given indexes of testing.customer, no statistics
+def advisor(*indexes):
+    gdw_advisor = GDWIndexAdvisor('testing/customer')
+    key = ('bloodmoondb', 'testing')
+    gdw_advisor._indexes[key] = {'customer': list(indexes)}
+    gdw_advisor._correlations[key] = {}
+    return gdw_advisor
+
+
+def test_wanted_indexes_of_a_daily_dimension():
+    with temp_metadata(METADATA):
+        wanted = advisor().wanted()
+        assert [(w.columns, w.method, w.where) for w in wanted] == [
+                (('modified',), 'btree', None),
+                (('customer_id',), 'btree', 'gdw_valid_to IS NULL')]
+
+
+def test_partial_index_only_covers_the_same_predicate():
+    with temp_metadata(METADATA):
+        gdw_advisor = advisor(
+                existing_index(['modified'], predicate='(gdw_valid_to IS NULL)'),
+                existing_index(['customer_id'], predicate='(gdw_valid_to IS NULL)'))
+        assert [w.columns for w in gdw_advisor.missing()] == [('modified',)]
+
+        gdw_advisor = advisor(existing_index(['modified', 'customer_id']))
+        assert [w.columns for w in gdw_advisor.missing()] == [('customer_id',)]
+
+
+def test_ddl():
+    with temp_metadata(METADATA):
+        gdw_advisor = advisor()
+        assert [gdw_advisor.ddl(index) for index in gdw_advisor.wanted()] == [
+                'CREATE INDEX CONCURRENTLY IF NOT EXISTS customer_modified_idx '
+                'ON testing.customer USING btree (modified);',
+                'CREATE INDEX CONCURRENTLY IF NOT EXISTS customer_customer_id_idx '
+                'ON testing.customer USING btree (customer_id) WHERE gdw_valid_to IS NULL;']
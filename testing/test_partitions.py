@@ -0,0 +1,64 @@
+import datetime
+from mgoutils.partitions import GDWPartitioning
+
+D = datetime.datetime
+
+
+class FakeTable(object):
+    name = 'sales'
+    schema = 'dw'
+
+    def __str__(self):
+        return 'dw.sales'
+
+
+class FakeAlias(dict):
+    date_columns = ['sale_date']
+    sql_table = FakeTable()
+
+
+def partitioning(**definition):
+    return GDWPartitioning(FakeAlias(partition=definition))
+
+
+def test_bounds_day():
+    assert partitioning(interval='day').bounds(D(2018, 3, 1, 6), D(2018, 3, 2, 23, 59)) == [
+            (D(2018, 3, 1), D(2018, 3, 2)),
+            (D(2018, 3, 2), D(2018, 3, 3))]
+
+
+def test_bounds_week_starts_on_monday():
+    # 2018-03-01 is a thursday
+    assert partitioning(interval='week').bounds(D(2018, 3, 1), D(2018, 3, 5)) == [
+            (D(2018, 2, 26), D(2018, 3, 5)),
+            (D(2018, 3, 5), D(2018, 3, 12))]
+
+
+def test_bounds_month_across_the_year():
+    assert partitioning(interval='month').bounds(D(2017, 12, 15), D(2018, 1, 1), ahead=1) == [
+            (D(2017, 12, 1), D(2018, 1, 1)),
+            (D(2018, 1, 1), D(2018, 2, 1)),
+            (D(2018, 2, 1), D(2018, 3, 1))]
+
+
+def test_generate_create_includes_the_partitions_ahead():
+    statements = partitioning(interval='day', ahead=2).generate_create(
+            D(2018, 3, 1), D(2018, 3, 1, 23, 59, 59, 999999))
+    assert [str(s) for s in statements] == [
+            "CREATE TABLE IF NOT EXISTS dw.sales_p{0} PARTITION OF dw.sales "
+            "FOR VALUES FROM ('{1}') TO ('{2}');".format(
+                lower.strftime('%Y%m%d'), lower, lower + datetime.timedelta(days=1))
+            for lower in [D(2018, 3, 1), D(2018, 3, 2), D(2018, 3, 3)]]
+
+
+def test_column_defaults_to_the_first_date_column():
+    assert partitioning(interval='day').column == 'sale_date'
+    assert partitioning(column='load_date').column == 'load_date'
+
+
+def test_covers_whole_partitions():
+    day_end = datetime.timedelta(days=1, microseconds=-1)
+    monthly = partitioning(interval='month')
+    assert monthly.covers_whole_partitions(D(2018, 3, 1), D(2018, 3, 31) + day_end)
+    assert not monthly.covers_whole_partitions(D(2018, 3, 1), D(2018, 3, 30) + day_end)
+    assert not monthly.covers_whole_partitions(D(2018, 3, 2), D(2018, 3, 31) + day_end)
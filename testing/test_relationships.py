@@ -0,0 +1,55 @@
+from mgoutils.relationships import GDWRelationshipGraph
+
+
+class FakeAlias(dict):
+    area = 'dw'
+
+
+class FakeCatalog(object):
+    def __init__(self, relationships):
+        self.aliases = dict(
+                (alias_name, FakeAlias(relationships=dict(
+                    (related_name, {'join_on': '{} = {}'.format(alias_name, related_name)})
+                    for related_name in related)))
+                for alias_name, related in relationships.items())
+
+    def alias_names(self, kind):
+        return sorted(self.aliases)
+
+
+# orders - customers - regions - countries, orders - stores - countries
+GRAPH = GDWRelationshipGraph(FakeCatalog({
+    'dw/orders': ['dw/customers', 'dw/stores'],
+    'dw/customers': ['dw/regions'],
+    'dw/regions': ['dw/countries'],
+    'dw/stores': ['dw/countries'],
+    'dw/countries': []}))
+
+
+def test_shortest_path_direct_relationship():
+    assert GRAPH.shortest_path(['dw/orders'], 'dw/customers') == ['dw/orders', 'dw/customers']
+
+
+def test_shortest_path_through_bridges():
+    assert GRAPH.shortest_path(['dw/orders'], 'dw/countries') == [
+            'dw/orders', 'dw/stores', 'dw/countries']
+    # a bridge excluded (a later part of the from) is never gone through
+    assert GRAPH.shortest_path(['dw/orders'], 'dw/countries', excluded=['dw/stores']) == [
+            'dw/orders', 'dw/customers', 'dw/regions', 'dw/countries']
+
+
+def test_shortest_path_ties_go_to_the_alias_joined_first():
+    assert GRAPH.shortest_path(['dw/regions', 'dw/stores'], 'dw/countries') == [
+            'dw/regions', 'dw/countries']
+    assert GRAPH.shortest_path(['dw/stores', 'dw/regions'], 'dw/countries') == [
+            'dw/stores', 'dw/countries']
+
+
+def test_shortest_path_none_without_relationship():
+    graph = GDWRelationshipGraph(FakeCatalog({'dw/orders': [], 'dw/customers': []}))
+    assert graph.shortest_path(['dw/orders'], 'dw/customers') is None
+
+
+def test_joins_bridges_before_the_alias_that_needs_them():
+    assert [(name, bridge) for name, _, bridge in GRAPH.joins(['dw/orders', 'dw/regions'])] == [
+            ('dw/customers', True), ('dw/regions', False)]
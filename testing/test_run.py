@@ -0,0 +1,65 @@
+from nose.tools import assert_raises
+from testing import temp_metadata
+from run import GDWScheduler
+
+GRAPH = {
+    'dw/orders': set(),
+    'dw/customers': set(),
+    'dw/order_lines': set(['dw/orders']),
+    'mart/sales': set(['dw/order_lines', 'dw/customers'])}
+
+
+def test_check_cycles_accepts_a_dag():
+    GDWScheduler(None).check_cycles(GRAPH)
+
+
+def test_check_cycles_names_the_targets_in_the_cycle():
+    graph = dict(GRAPH)
+    graph['dw/orders'] = set(['mart/sales'])
+    with assert_raises(RuntimeError) as raised:
+        GDWScheduler(None).check_cycles(graph)
+    message = str(raised.exception)
+    assert 'dw/orders' in message and 'mart/sales' in message
+    assert 'dw/customers' not in message
+
+
+def test_critical_path_longest_chain():
+    wall_times = {'dw/orders': 10, 'dw/customers': 25, 'dw/order_lines': 20, 'mart/sales': 5}
+    total, path = GDWScheduler(None).critical_path(GRAPH, wall_times)
+    assert total == 35
+    assert path == ['dw/orders', 'dw/order_lines', 'mart/sales']
+
+
+def test_critical_path_leaves_out_targets_not_loaded():
+    # dw/order_lines failed, its dependents were skipped
+    wall_times = {'dw/orders': 10, 'dw/customers': 25}
+    assert GDWScheduler(None).critical_path(GRAPH, wall_times) == (25, ['dw/customers'])
+    assert GDWScheduler(None).critical_path(GRAPH, {}) == (0, [])
+
+
+BRIDGE_METADATA = {
+    'testing/orders.alias.yaml': {
+        'area': 'testing', 'table': 'orders',
+        'relationships': {'testing/customers': {
+            'join_on': 'orders.customer_id = customers.customer_id'}}},
+    'testing/customers.alias.yaml': {
+        'area': 'testing', 'table': 'customers',
+        'relationships': {'testing/regions': {
+            'join_on': 'customers.region_id = regions.region_id'}}},
+    'testing/customers.transform.yaml': {
+        'from': 'testing/customer_history',
+        'select': [{'customer_id': 'customer_history.customer_id'}]},
+    'testing/customer_history.alias.yaml': {'area': 'testing', 'table': 'customer_history'},
+    'testing/regions.alias.yaml': {'area': 'testing', 'table': 'regions'},
+    'testing/sales.alias.yaml': {'area': 'testing', 'table': 'sales'},
+    'testing/sales.transform.yaml': {
+        'from': ['testing/orders', 'testing/regions'],
+        'select': [{'region_id': 'regions.region_id'}]}}
+
+
+def test_dependency_graph_waits_for_the_bridge_aliases():
+    # testing/sales joins regions through customers, loaded first
+    with temp_metadata(BRIDGE_METADATA):
+        graph = GDWScheduler(None).dependency_graph()
+    assert graph['testing/sales'] == set(['testing/customers'])
+    assert graph['testing/customers'] == set()
@@ -0,0 +1,85 @@
+import datetime
+from nose.tools import with_setup
+from testing import setup_func, teardown_func, temp_metadata, CONFIG_FILE
+from cmdlineutil.tieredconfig import load_tiered_config
+from load import GDWLoad
+
+D = datetime.datetime
+
+METADATA = {
+    'testing/customer_history.alias.yaml': {
+        'area': 'testing',
+        'table': 'customer_history',
+        'is_deleted': 'is_deleted',
+        'date': {'modified': 'modified', 'state': ['valid_from', 'valid_to']}},
+    'testing/customer_stage.alias.yaml': {
+        'area': 'testing',
+        'table': 'customer_stage'},
+    'testing/customer.alias.yaml': {
+        'area': 'testing',
+        'table': 'customer',
+        'load': {
+            'how': 'dimension',
+            'type': 'scd2',
+            'object_key': 'customer_id',
+            'priority': 'gdw_state_start',
+            'staging_alias': 'testing/customer_stage'}},
+    'testing/customer.transform.yaml': {
+        'from': 'testing/customer_history',
+        'select': [
+            {'customer_id': 'customer_history.customer_id'},
+            {'segment': 'customer_history.segment'}]}}
+
+TABLES = """
+CREATE TABLE testing.customer_history (
+    customer_id int, segment text, is_deleted boolean,
+    valid_from timestamp, valid_to timestamp, modified timestamp);
+CREATE TABLE testing.customer_stage (
+    customer_id int, segment text,
+    gdw_state_start timestamp, gdw_state_end timestamp, gdw_is_deleted boolean,
+    gdw_state_dts_range tsrange[]);
+CREATE TABLE testing.customer (
+    customer_id int, segment text,
+    gdw_state_start timestamp, gdw_state_end timestamp, gdw_is_deleted boolean);
+"""
+
+
+def load_day(config, day):
+    GDWLoad('testing/customer', config, day,
+            day + datetime.timedelta(days=1, microseconds=-1)).run()
+
+
+def versions(engine):
+    return engine.execute(
+            'SELECT customer_id, segment, gdw_state_start, gdw_state_end '
+            'FROM testing.customer ORDER BY customer_id, gdw_state_start').fetchall()
+
+
+@with_setup(setup_func, teardown_func)
+def test_scd2_reloading_an_older_window_keeps_later_versions():
+    config = load_tiered_config(CONFIG_FILE)
+    with temp_metadata(METADATA) as catalog:
+        catalog.configure(config)
+        engine = catalog.engines['bloodmoondb']
+        engine.execute(TABLES)
+
+        # customer 1 becomes retail on the first day and wholesale on the
+        # second. every history row is modified on the day it starts
+        engine.execute(
+                "INSERT INTO testing.customer_history VALUES "
+                "(1, 'retail', false, '2018-03-01 10:00', NULL, '2018-03-01 10:00')")
+        load_day(config, D(2018, 3, 1))
+        engine.execute(
+                "INSERT INTO testing.customer_history VALUES "
+                "(1, 'wholesale', false, '2018-03-02 09:00', NULL, '2018-03-02 09:00')")
+        load_day(config, D(2018, 3, 2))
+
+        expected = [
+                (1, 'retail', D(2018, 3, 1, 10), D(2018, 3, 2, 9)),
+                (1, 'wholesale', D(2018, 3, 2, 9), None)]
+        assert versions(engine) == expected
+
+        # the first day again: its version comes back with the same end and
+        # the version of the second day survives
+        load_day(config, D(2018, 3, 1))
+        assert versions(engine) == expected
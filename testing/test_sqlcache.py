@@ -0,0 +1,26 @@
+import datetime
+from mgoutils.dateutils import window_params
+from mgoutils.sqlcache import CompiledStatement
+
+START = datetime.datetime(2018, 3, 1)
+END = datetime.datetime(2018, 3, 2)
+SQL = ('INSERT INTO dw.sales SELECT * FROM src.orders '
+       'WHERE modified BETWEEN %(gdw_start__src_orders)s AND %(gdw_end)s '
+       'AND status = %(status_1)s')
+
+
+def test_bind_sources_default_to_the_window_start():
+    statement = CompiledStatement('INSERT', SQL, {'status_1': 'paid'})
+    assert statement.bind(window_params(START, END)) == {
+            'gdw_start': START,
+            'gdw_start__src_orders': START,
+            'gdw_end': END,
+            'status_1': 'paid'}
+
+
+def test_bind_source_start():
+    source_start = datetime.datetime(2018, 3, 1, 12)
+    statement = CompiledStatement('INSERT', SQL, {'status_1': 'paid'})
+    params = statement.bind(window_params(START, END, {'src/orders': source_start}))
+    assert params['gdw_start__src_orders'] == source_start
+    assert params['gdw_start'] == START
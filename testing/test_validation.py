@@ -0,0 +1,58 @@
+from mgoutils.bundle import GDWMetadataBundle
+from mgoutils.validation import GDWMetadataValidator
+
+AREAS = {'warehouse': {'database': 'bloodmoondb', 'schema': 'warehouse'}}
+
+
+def validate(documents):
+    documents = dict(documents)
+    documents.setdefault('areas.yaml', AREAS)
+    bundle = GDWMetadataBundle(documents, dict((name, (0, 0)) for name in documents))
+    return GDWMetadataValidator(bundle).errors()
+
+
+def test_valid_metadata():
+    assert validate({
+        'warehouse/orders.alias.yaml': {
+            'area': 'warehouse', 'table': 'orders',
+            'relationships': {'warehouse/customers': {
+                'join_on': 'orders.customer_id = customers.customer_id'}}},
+        'warehouse/customers.alias.yaml': {'area': 'warehouse', 'table': 'customers'},
+        'mart/sales.transform.yaml': {
+            'from': ['warehouse/orders', 'warehouse/customers'],
+            'select': [{'customer_id': 'orders.customer_id'}]}}) == []
+
+
+def test_unknown_keys_and_areas():
+    assert validate({
+        'warehouse/orders.alias.yaml': {
+            'area': 'staging', 'table': 'orders',
+            'laod': {'how': 'insert'},
+            'date': {'modifed': 'modified'}}}) == [
+        'warehouse/orders.alias.yaml: unknown key laod',
+        'warehouse/orders.alias.yaml: unknown key date.modifed',
+        'warehouse/orders.alias.yaml: unknown area staging']
+
+
+def test_missing_aliases_and_bad_joins():
+    errors = validate({
+        'warehouse/orders.alias.yaml': {
+            'area': 'warehouse', 'table': 'orders',
+            'relationships': {'warehouse/customers': {
+                'join_on': 'orders.customer_id = clients.customer_id'}}},
+        'mart/sales.transform.yaml': {
+            'from': {'alias': 'warehouse/returns', 'merge': 'modifications'},
+            'select': [{'order_id': 'orders.order_id'}],
+            'materialize': 'view'}})
+    assert errors == [
+        'warehouse/orders.alias.yaml: related alias warehouse/customers has no alias or transform file',
+        'warehouse/orders.alias.yaml: relationships.warehouse/customers joins clients.customer_id, '
+        'not a column of warehouse/orders or warehouse/customers',
+        'mart/sales.transform.yaml: unknown materialize view',
+        'mart/sales.transform.yaml: merge modifications without by',
+        'mart/sales.transform.yaml: from alias warehouse/returns has no alias or transform file']
+
+
+def test_no_areas():
+    bundle = GDWMetadataBundle({}, {})
+    assert GDWMetadataValidator(bundle).errors() == ['no areas.yaml']